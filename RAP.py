@@ -1,9 +1,35 @@
 
 import sys
+import os
+import argparse
+import copy
+import csv
+import glob
+import hashlib
+import json
+import re
 import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+    TimeoutError as FutureTimeout
 import ply.yacc as yacc
 import ply.lex as lex
 
+# The columnar backend needs numpy; without it only SQLite is offered
+try:
+    import columnar
+except ImportError:
+    columnar = None
+
+# Directory for the generated LALR parse tables
+PARSER_CACHE_DIR = os.environ.get(
+    'RAV_PARSER_CACHE',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '__pycache__'))
+
+
 # RAPParser class encapsulating the parser and lexer to avoid issues with other parsers
 
 
@@ -20,10 +46,57 @@ class RAPParser:
     ] + list(reserved.values())
 
     def __init__(self):
-        # Build lexer and parser
-        self.lexer = lex.lex(module=self)
-        self.parser = yacc.yacc(
-            module=self, start='query', debug=False, write_tables=False)
+        # Lexer and parser are built on first use, see build()
+        self.lexer = None
+        self.parser = None
+        self.build_lock = threading.Lock()
+        # Idle parsers for concurrent parses, see acquire()
+        self.pool = []
+        self.pool_lock = threading.Lock()
+
+    # Hash of everything the LALR tables are generated from; names the
+    # cached table file, so a grammar change never loads stale tables
+    @classmethod
+    def grammar_hash(cls):
+        parts = [yacc.__version__, 'query', repr(cls.tokens),
+                 repr(getattr(cls, 'precedence', None))]
+        for name in sorted(dir(cls)):
+            if name.startswith('p_') and name != 'p_error':
+                parts.append(name + ':' + (getattr(cls, name).__doc__ or ''))
+        return hashlib.sha256('\n'.join(parts).encode()).hexdigest()[:16]
+
+    @classmethod
+    def table_path(cls):
+        return os.path.join(PARSER_CACHE_DIR, f"rap_parsetab_{cls.grammar_hash()}.pickle")
+
+    # Build the lexer and load the parse tables, generating and persisting
+    # them if there is no cached copy for this grammar. The tables are
+    # written to a temporary file and renamed into place, so processes
+    # starting together never read a half-written file.
+    def build(self):
+        with self.build_lock:
+            if self.parser is not None:
+                return
+            self.lexer = lex.lex(module=self)
+            path = self.table_path()
+            if os.path.exists(path):
+                self.parser = yacc.yacc(
+                    module=self, start='query', debug=False, picklefile=path)
+                return
+            try:
+                os.makedirs(PARSER_CACHE_DIR, exist_ok=True)
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                self.parser = yacc.yacc(
+                    module=self, start='query', debug=False, picklefile=tmp_path)
+                os.replace(tmp_path, path)
+                # drop tables generated for earlier versions of the grammar
+                for stale in glob.glob(os.path.join(PARSER_CACHE_DIR, "rap_parsetab_*.pickle")):
+                    if stale != path:
+                        os.remove(stale)
+            except OSError:
+                if self.parser is None:
+                    self.parser = yacc.yacc(
+                        module=self, start='query', debug=False, write_tables=False)
 
     t_SEMI = r';'
     t_AND = r'[Aa][Nn][Dd]'
@@ -255,9 +328,43 @@ class RAPParser:
     def p_error(self, p):
         raise TypeError(f"Syntax error: '{getattr(p, 'value', None)}'")
 
+    # PLY parsers and lexers keep the state of the parse in progress on
+    # themselves, so each parse uses a clone of the lexer and a parser of its
+    # own. Parsers are shallow copies sharing the read-only parse tables and
+    # are kept in a pool for reuse.
+    def acquire(self):
+        if self.parser is None:
+            self.build()
+        with self.pool_lock:
+            if self.pool:
+                return self.pool.pop()
+        return copy.copy(self.parser)
+
+    def release(self, parser):
+        with self.pool_lock:
+            self.pool.append(parser)
+
     # --- Public method to parse input ---
     def parse(self, data):
-        return self.parser.parse(data, lexer=self.lexer)
+        return self.parse_tokens(self.tokenize(data))
+
+    # Tokens of a query, read with a clone of the lexer
+    def tokenize(self, data):
+        if self.parser is None:
+            self.build()
+        lexer = self.lexer.clone()
+        lexer.input(data)
+        return list(iter(lexer.token, None))
+
+    # Parse tokens returned by tokenize(), without lexing the query again
+    def parse_tokens(self, tokens):
+        remaining = iter(tokens)
+        parser = self.acquire()
+        try:
+            return parser.parse(lexer=self.lexer.clone(),
+                                tokenfunc=lambda: next(remaining, None))
+        finally:
+            self.release(parser)
 
 
 # data = '''project[dname](
@@ -274,44 +381,90 @@ class RAPParser:
 # from Node import *
 # from RALexer import tokens
 
+# Affinity SQLite gives a column declared with type decl, by the rules that
+# columnar.declared_affinity also applies. None is no affinity. A date column
+# is mapped to the VARCHAR domain but has NUMERIC affinity.
+def type_affinity(decl):
+    decl = (decl or '').upper()
+    if 'INT' in decl:
+        return 'INTEGER'
+    if 'CHAR' in decl or 'CLOB' in decl or 'TEXT' in decl:
+        return 'TEXT'
+    if 'BLOB' in decl or decl == '':
+        return None
+    if 'REAL' in decl or 'FLOA' in decl or 'DOUB' in decl:
+        return 'REAL'
+    return 'NUMERIC'
+
+
+# Read relation names, attributes, domains and column affinities from an
+# open connection. Returns (relations, attributes, domains, affinities) in
+# the shape SQLite3 keeps them.
+def load_catalog(conn):
+    relations = []
+    attributes = {}
+    domains = {}
+    affinities = {}
+    query = "select name from sqlite_schema where type='table'"
+    c = conn.cursor()
+    c.execute(query)
+    records = c.fetchall()
+    for record in records:
+        relations.append(record[0].upper())
+    for rname in relations:
+        query = "select name,type from pragma_table_info('"+rname+"')"
+        c.execute(query)
+        records = c.fetchall()
+        attrs = []
+        doms = []
+        affs = []
+        for record in records:
+            attrs.append(record[0].upper())
+            affs.append(type_affinity(record[1]))
+            col_type = record[1].upper()
+            if col_type.startswith("INT") or col_type.startswith("NUM"):
+                doms.append("INTEGER")
+            elif col_type.startswith("DEC"):
+                doms.append("DECIMAL")
+            elif col_type.startswith("CHAR") or col_type.startswith("VARCHAR") or col_type.startswith("TEXT"):
+                doms.append("VARCHAR")
+            else:
+                doms.append("VARCHAR")
+        attributes[rname] = attrs
+        domains[rname] = doms
+        affinities[rname] = affs
+    c.close()
+    return relations, attributes, domains, affinities
+
+
 class SQLite3():
 
     def __init__(self):
         self.relations = []
         self.attributes = {}
         self.domains = {}
+        self.affinities = {}
         self.conn = None
+        self.handle = None
+        self.dbfile = None
+        self.version = None
+        self.statistics = None
 
     def open(self, dbfile):
         self.conn = sqlite3.connect(dbfile)
-        query = "select name from sqlite_schema where type='table'"
-        c = self.conn.cursor()
-        c.execute(query)
-        records = c.fetchall()
-        for record in records:
-            self.relations.append(record[0].upper())
-        for rname in self.relations:
-            query = "select name,type from pragma_table_info('"+rname+"')"
-            c.execute(query)
-            records = c.fetchall()
-            attrs = []
-            doms = []
-            for record in records:
-                attrs.append(record[0].upper())
-                col_type = record[1].upper()
-                if col_type.startswith("INT") or col_type.startswith("NUM"):
-                    doms.append("INTEGER")
-                elif col_type.startswith("DEC"):
-                    doms.append("DECIMAL")
-                elif col_type.startswith("CHAR") or col_type.startswith("VARCHAR") or col_type.startswith("TEXT"):
-                    doms.append("VARCHAR")
-                else:
-                    doms.append("VARCHAR")
-            self.attributes[rname] = attrs
-            self.domains[rname] = doms
+        self.dbfile = os.path.abspath(dbfile)
+        st = os.stat(self.dbfile)
+        self.version = (st.st_mtime_ns, st.st_size)
+        self.relations, self.attributes, self.domains, self.affinities = \
+            load_catalog(self.conn)
 
     def close(self):
-        self.conn.close()
+        # Connections borrowed from a DatabaseHandle go back to its pool
+        if self.handle is not None:
+            self.handle.release(self.conn)
+        else:
+            self.conn.close()
+        self.conn = None
 
     def relationExists(self, rname):
         return rname in self.relations
@@ -322,6 +475,9 @@ class SQLite3():
     def getDomains(self, rname):
         return self.domains[rname]
 
+    def getAffinities(self, rname):
+        return self.affinities[rname]
+
     def displayDatabaseSchema(self):
         print("*********************************************")
         for rname in self.relations:
@@ -335,27 +491,18 @@ class SQLite3():
                     print(aname+":"+atype+",", end="")
         print("*********************************************")
 
-    def displayQueryResults(self, query, tree):
-        print("\nANSWER(", end="")
-        nCols = len(tree.get_attributes())
-        for i, col in enumerate(tree.get_attributes()):
-            if i == (nCols-1):
-                print(col+":"+tree.get_domains()[i]+")")
-            else:
-                print(col+":"+tree.get_domains()[i]+",", end="")
-        # execute the query against sqlite3 database
+    # Stream the result of query to out (stdout by default) in one of
+    # RESULT_FORMATS, FETCH_BATCH rows at a time, so memory stays bounded
+    # however large the result is. The row count and elapsed time are
+    # reported at the end. Returns the number of rows written.
+    def displayQueryResults(self, query, tree, out=None, fmt='table'):
+        start = time.perf_counter()
         c = self.conn.cursor()
-        # print("Executing query:",query)
         c.execute(query)
-        records = c.fetchall()
-        rowCount = len(records)
-        print("Number of tuples = "+str(rowCount)+"\n")
-        for record in records:
-            for val in record:
-                print(str(val)+":", end="")
-            print()
-        print()
+        rowCount = write_results(iter(lambda: c.fetchmany(FETCH_BATCH), []),
+                                 tree, out, fmt, start)
         c.close()
+        return rowCount
 
     def isQueryResultEmpty(self, query):
         c = self.conn.cursor()
@@ -364,6 +511,290 @@ class SQLite3():
         return len(records) == 0
 
 
+# ---------------------- Result output ----------------------
+# Writers for the formats the CLI can stream results in. Each one writes a
+# header when it is created and then one fetchmany batch per write_rows call,
+# joined into a single write.
+
+FETCH_BATCH = 1000
+OUTPUT_BUFFER = 1 << 20
+
+
+# The classic RA answer: ANSWER(attr:domain,...) and one val:val: line per row
+class TableWriter():
+
+    def __init__(self, out, attributes, domains):
+        self.out = out
+        out.write("\nANSWER(" + ",".join(
+            a + ":" + d for a, d in zip(attributes, domains)) + ")\n\n")
+
+    def write_rows(self, records):
+        self.out.write("".join(
+            "".join(str(val) + ":" for val in record) + "\n"
+            for record in records))
+
+
+class DelimitedWriter():
+
+    def __init__(self, out, attributes, domains, delimiter=','):
+        self.writer = csv.writer(out, delimiter=delimiter, lineterminator="\n")
+        self.writer.writerow(attributes)
+
+    def write_rows(self, records):
+        self.writer.writerows(records)
+
+
+class TabWriter(DelimitedWriter):
+
+    def __init__(self, out, attributes, domains):
+        DelimitedWriter.__init__(self, out, attributes, domains, '\t')
+
+
+# One JSON object per row, keyed by attribute name
+class JsonLinesWriter():
+
+    def __init__(self, out, attributes, domains):
+        self.out = out
+        self.attributes = attributes
+
+    def write_rows(self, records):
+        self.out.write("".join(
+            json.dumps(dict(zip(self.attributes, record)), default=str) + "\n"
+            for record in records))
+
+
+RESULT_FORMATS = {'table': TableWriter, 'csv': DelimitedWriter,
+                  'tsv': TabWriter, 'jsonl': JsonLinesWriter}
+
+
+# Stream batches of rows of tree's result to out in fmt, then report the row
+# count and the time since start. Returns the row count.
+def write_results(batches, tree, out=None, fmt='table', start=None):
+    if out is None:
+        out = sys.stdout
+    if start is None:
+        start = time.perf_counter()
+    writer = RESULT_FORMATS[fmt](out, tree.get_attributes(), tree.get_domains())
+    rowCount = 0
+    for records in batches:
+        writer.write_rows(records)
+        rowCount += len(records)
+    out.flush()
+    elapsed = time.perf_counter() - start
+    # Keep the summary out of machine-readable output on stdout
+    report = sys.stderr if out is sys.stdout and fmt != 'table' else sys.stdout
+    print("\nNumber of tuples = "+str(rowCount) +
+          " (%.3f s)\n" % elapsed, file=report)
+    return rowCount
+
+
+# ---------------------- Serving mode ----------------------
+# RAV_DB_MODE sets how the app's connections reach a database file:
+#   disk:   read-only connections to the file with SQLite's defaults
+#   mmap:   the file opened immutable (no locking or change detection on
+#           each read) and memory-mapped, with SERVING_PRAGMAS
+#   memory: the file read once through an immutable connection and copied
+#           with the backup API into an in-memory database that all of its
+#           connections share, with SERVING_PRAGMAS
+# A file that changes on disk is still picked up: its next checkout opens
+# fresh connections, after copying it again in memory mode.
+
+DB_MODES = ['disk', 'mmap', 'memory']
+DB_MODE = os.environ.get('RAV_DB_MODE', 'disk')
+SERVING_PRAGMAS = [
+    'mmap_size = 268435456',    # map up to 256 MB of the file (mmap mode)
+    'cache_size = -16384',      # up to 16 MB of page cache per connection
+    'temp_store = MEMORY',      # sorts, DISTINCT and temp b-trees in RAM
+]
+
+
+# A DatabaseHandle owns everything that can be shared between requests for a
+# single .db file: the schema catalog and a pool of read-only connections.
+# The catalog is loaded once and reloaded only when the file changes on disk.
+class DatabaseHandle():
+
+    def __init__(self, dbfile, pool_size=4):
+        self.dbfile = os.path.abspath(dbfile)
+        self.pool_size = pool_size
+        self.pool = []
+        self.lock = threading.Lock()
+        self.catalog = None
+        self.version = None
+        self.statistics = None
+        # connections to the current version of the file, which the pool
+        # may keep; others are closed when they are released
+        self.connections = set()
+        self.connected_version = None
+        self.replica = None
+        self.replica_uri = None
+        self.refresh_lock = threading.Lock()
+
+    def file_version(self):
+        st = os.stat(self.dbfile)
+        return (st.st_mtime_ns, st.st_size)
+
+    def connect(self):
+        if DB_MODE == 'memory':
+            uri = self.replica_uri + '&mode=ro'
+        elif DB_MODE == 'mmap':
+            uri = f"file:{self.dbfile}?mode=ro&immutable=1"
+        else:
+            uri = f"file:{self.dbfile}?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        if DB_MODE != 'disk':
+            for pragma in SERVING_PRAGMAS:
+                conn.execute(f"PRAGMA {pragma}")
+        with self.lock:
+            self.connections.add(conn)
+        return conn
+
+    # Start over with new connections for a new version of the file, and in
+    # memory mode a new in-memory copy of it. Connections that are checked
+    # out keep the copy they started with until they are released.
+    def refresh(self, version):
+        with self.refresh_lock:
+            if self.connected_version == version:
+                return
+            replica, uri = None, None
+            if DB_MODE == 'memory':
+                name = hashlib.sha1(f"{self.dbfile}:{version}".encode()).hexdigest()[:16]
+                uri = f"file:/rav-{name}?vfs=memdb"
+                replica = sqlite3.connect(uri, uri=True, check_same_thread=False)
+                source = sqlite3.connect(f"file:{self.dbfile}?mode=ro&immutable=1", uri=True)
+                try:
+                    source.backup(replica)
+                finally:
+                    source.close()
+            with self.lock:
+                pool, self.pool = self.pool, []
+                self.connections = set()
+                old_replica, self.replica = self.replica, replica
+                self.replica_uri = uri
+                self.connected_version = version
+            for conn in pool:
+                conn.close()
+            if old_replica is not None:
+                old_replica.close()
+
+    def get_catalog(self):
+        version = self.file_version()
+        with self.lock:
+            if self.catalog is not None and self.version == version:
+                return self.catalog, self.version
+        self.refresh(version)
+        conn = self.acquire()
+        try:
+            catalog = load_catalog(conn)
+        finally:
+            self.release(conn)
+        with self.lock:
+            self.catalog = catalog
+            self.version = version
+        return catalog, version
+
+    # Bytes held by the in-memory copy of the file, or None without one
+    def replica_bytes(self):
+        with self.lock:
+            replica = self.replica
+        if replica is None:
+            return None
+        with self.refresh_lock:
+            page_count = replica.execute("PRAGMA page_count").fetchone()[0]
+            page_size = replica.execute("PRAGMA page_size").fetchone()[0]
+        return page_count * page_size
+
+    # Table statistics for the optimizer, dropped when the file changes
+    def get_statistics(self, version):
+        with self.lock:
+            if self.statistics is None or self.statistics.version != version:
+                self.statistics = TableStatistics(version)
+            return self.statistics
+
+    def acquire(self):
+        with self.lock:
+            if self.pool:
+                return self.pool.pop()
+        return self.connect()
+
+    def release(self, conn):
+        with self.lock:
+            if conn in self.connections and len(self.pool) < self.pool_size:
+                self.pool.append(conn)
+                return
+            self.connections.discard(conn)
+        conn.close()
+
+    # Return a SQLite3 object that shares the cached catalog and borrows a
+    # pooled connection; db.close() hands the connection back.
+    def checkout(self):
+        (relations, attributes, domains, affinities), version = self.get_catalog()
+        db = SQLite3()
+        db.relations = relations
+        db.attributes = attributes
+        db.domains = domains
+        db.affinities = affinities
+        db.conn = self.acquire()
+        db.handle = self
+        db.dbfile = self.dbfile
+        db.version = version
+        return db
+
+    def close(self):
+        with self.lock:
+            pool, self.pool = self.pool, []
+            self.connections = set()
+            replica, self.replica = self.replica, None
+            self.connected_version = None
+            self.version = None
+        for conn in pool:
+            conn.close()
+        if replica is not None:
+            replica.close()
+
+
+# Process-wide registry of DatabaseHandle objects, one per database file
+db_handles = {}
+db_handles_lock = threading.Lock()
+
+
+def get_db_handle(dbfile):
+    path = os.path.abspath(dbfile)
+    with db_handles_lock:
+        handle = db_handles.get(path)
+        if handle is None:
+            handle = DatabaseHandle(path)
+            db_handles[path] = handle
+    return handle
+
+
+def open_db(dbfile):
+    return get_db_handle(dbfile).checkout()
+
+
+# Open every database in folder ahead of the first request, which in memory
+# mode copies each one into memory. Returns [(name, file bytes, bytes in
+# memory or None)].
+def load_databases(folder):
+    report = []
+    for name in sorted(os.listdir(folder)):
+        if not name.endswith('.db'):
+            continue
+        handle = get_db_handle(os.path.join(folder, name))
+        handle.get_catalog()
+        report.append((name, os.path.getsize(handle.dbfile), handle.replica_bytes()))
+    return report
+
+
+def print_memory_report(report):
+    print(f"Database mode: {DB_MODE}")
+    for name, file_bytes, memory_bytes in report:
+        held = f"{memory_bytes / 1024:10,.0f} KB in memory" if memory_bytes is not None else ""
+        print(f"  {name:24}{file_bytes / 1024:10,.0f} KB on disk  {held}")
+    total = sum(memory_bytes or 0 for _, _, memory_bytes in report)
+    if total:
+        print(f"  {'total':24}{'':24}{total / 1024:10,.0f} KB in memory")
+
+
 class Node:
 
     def __init__(self, ntype, lc, rc):
@@ -380,6 +811,10 @@ class Node:
         self.attributes = None		# holds schema attributes at node
         self.domains = None		# holds schema domains of attributes at node
         self.join_columns = []		# holds common column names for join
+        # output column order for join/times chains reordered by the optimizer
+        self.output_order = None
+        # row cap on a product sampled by the resource limits, if any
+        self.sample_limit = None
 
         # added for AGGREGATE
         self.aggregate_project_list = []
@@ -413,6 +848,12 @@ class Node:
     def get_join_columns(self):
         return self.join_columns
 
+    def get_output_order(self):
+        return self.output_order
+
+    def get_sample_limit(self):
+        return self.sample_limit
+
     def get_aggregate_project_list(self):
         return self.aggregate_project_list
 
@@ -449,6 +890,12 @@ class Node:
     def set_join_columns(self, jc):
         self.join_columns = jc
 
+    def set_output_order(self, order):
+        self.output_order = order
+
+    def set_sample_limit(self, limit):
+        self.sample_limit = limit
+
     def set_aggregate_project_list(self, apl):
         self.aggregate_project_list = apl
 
@@ -512,6 +959,9 @@ class Node:
         elif self.node_type in ["union", "minus", "join", "intersect", "times"]:
             print(" "*n, end="")
             print("NODE TYPE: "+self.node_type+"  ")
+            if self.node_type == "times" and self.conditions:
+                print(" "*n, end="")
+                print("Join conditions are : " + str(self.conditions))
             if self.relation_name != None:
                 print(" "*n, end="")
                 print("Relation Name is : " + self.relation_name)
@@ -554,14 +1004,12 @@ class Node:
             pass
 
 
-# Global variable used for setting temporary table names
-count = 0
-
-# Instantiate the RAPParser class
+# Instantiate the RAPParser class; tables are loaded on the first parse
 rap_parser = RAPParser()
 
 
-def execute_file(filename, db):
+# Run the query in a file. Returns False if it was stopped by a limit.
+def execute_file(filename, db, out=None, fmt='table', backend='sqlite', time_limit=0):
     try:
         with open(filename) as f:
             data = f.read().splitlines()
@@ -572,8 +1020,7 @@ def execute_file(filename, db):
             set_temp_table_names(tree)
             msg = semantic_checks(tree, db)
             if msg == 'OK':
-                query = generateSQL(tree, db)
-                db.displayQueryResults(query, tree)
+                return display_limited_results(tree, db, out, fmt, backend, time_limit)
             else:
                 print(msg)
         except Exception as inst:
@@ -581,11 +1028,173 @@ def execute_file(filename, db):
     except FileNotFoundError:
         print("FileNotFoundError: A file with name '" +
               filename + "' cannot be found")
+    return True
 
 
+# Run a checked tree and stream its result to out, within the product limit
+# and time_limit seconds (0 for none). Notes and errors go to stderr. Returns
+# False if the query was stopped, in which case out holds partial results.
+def display_limited_results(tree, db, out=None, fmt='table', backend='sqlite',
+                            time_limit=0):
+    try:
+        for note in limit_products(tree, db):
+            print(note, file=sys.stderr)
+        if backend == 'numpy':
+            run_with_time_limit(db, display_columnar_results, tree, db, out, fmt,
+                                time_limit=time_limit)
+            return True
+        query = generateSQL(tree, db)
+        run_with_time_limit(db, db.displayQueryResults, query, tree, out, fmt,
+                            time_limit=time_limit)
+        return True
+    except QueryLimitExceeded as e:
+        print(e, file=sys.stderr)
+        return False
+
+
+# displayQueryResults for the columnar backend, which writes the evaluated
+# table in FETCH_BATCH slices
+def display_columnar_results(tree, db, out=None, fmt='table'):
+    start = time.perf_counter()
+    table = evaluate_columnar(tree, db)
+    batches = (table.rows(i, i + FETCH_BATCH) for i in range(0, len(table), FETCH_BATCH))
+    return write_results(batches, tree, out, fmt, start)
+
+
+# ---------------------- Batch mode ----------------------
+# Query files are split into their ;-terminated queries, which are all
+# compiled to SQL up front in this process and then run on a pool of worker
+# processes, each with its own read-only connection to the database. Only
+# the summary of each query (status, rows, time) comes back.
+
+BATCH_COLUMNS = ['FILE', 'QUERY', 'STATUS', 'ROWS', 'TIME_MS', 'MESSAGE']
+BATCH_DOMAINS = ['VARCHAR', 'INTEGER', 'VARCHAR', 'INTEGER', 'DECIMAL', 'VARCHAR']
+
+# Read-only connection of a batch worker process
+batch_conn = None
+
+
+# Split the text of a query file into its queries. Lines starting with #
+# are comments, and a ; inside a string literal does not end a query.
+def split_queries(text):
+    text = " ".join(filter(lambda x: len(x) > 0 and x[0] != "#",
+                           text.splitlines()))
+    queries = []
+    current = ''
+    in_string = False
+    for ch in text:
+        current += ch
+        if ch == "'":
+            in_string = not in_string
+        elif ch == ';' and not in_string:
+            queries.append(current.strip())
+            current = ''
+    if current.strip():
+        queries.append(current.strip())
+    return queries
+
+
+# Compile every query of the files. Returns one entry per query, holding
+# either its SQL or the status and message it failed with.
+def compile_batch(filenames, db, optimize=False):
+    entries = []
+    for filename in filenames:
+        try:
+            with open(filename) as f:
+                queries = split_queries(f.read())
+        except OSError as e:
+            entries.append({'file': filename, 'query': 0, 'status': 'ERROR',
+                            'message': str(e)})
+            continue
+        for i, query in enumerate(queries):
+            entry = {'file': filename, 'query': i + 1}
+            try:
+                tree, msg = compile_query(query, db, optimize)
+                if tree is None:
+                    entry.update(status='ERROR', message=msg)
+                else:
+                    limit_products(tree, db)
+                    entry['sql'] = generateSQL(tree, db)
+            except QueryLimitExceeded as e:
+                entry.update(status='LIMIT', message=str(e))
+            except Exception as inst:
+                entry.update(status='ERROR', message=str(inst.args[0]))
+            entries.append(entry)
+    return entries
+
+
+def open_batch_worker(dbfile):
+    global batch_conn
+    batch_conn = sqlite3.connect(f"file:{os.path.abspath(dbfile)}?mode=ro",
+                                 uri=True)
+
+
+# Run one query on the worker's connection under the time limit, counting
+# its rows in batches. Returns (status, rows, time in ms, message).
+def run_batch_query(sql):
+    job = QueryJob(None, QUERY_TIME_LIMIT)
+    batch_conn.set_progress_handler(job.progress, PROGRESS_STEP)
+    rows = 0
+    try:
+        c = batch_conn.execute(sql)
+        while True:
+            records = c.fetchmany(FETCH_BATCH)
+            if not records:
+                break
+            rows += len(records)
+        c.close()
+    except sqlite3.Error as e:
+        if job.timed_out:
+            return 'LIMIT', rows, job.elapsed() * 1000, time_limit_message()
+        return 'ERROR', rows, job.elapsed() * 1000, str(e)
+    finally:
+        batch_conn.set_progress_handler(None, PROGRESS_STEP)
+    return 'OK', rows, job.elapsed() * 1000, ''
+
+
+# Run the queries of the files against dbfile on worker processes and
+# write one summary row per query to out in fmt. Returns the entries.
+def run_batch(filenames, dbfile, out=None, fmt='table', workers=None,
+              optimize=False):
+    if out is None:
+        out = sys.stdout
+    start = time.perf_counter()
+    db = SQLite3()
+    db.open(dbfile)
+    try:
+        entries = compile_batch(filenames, db, optimize)
+    finally:
+        db.close()
+
+    writer = RESULT_FORMATS[fmt](out, BATCH_COLUMNS, BATCH_DOMAINS)
+    with ProcessPoolExecutor(max_workers=workers, initializer=open_batch_worker,
+                             initargs=(dbfile,)) as pool:
+        futures = [pool.submit(run_batch_query, entry['sql'])
+                   if 'sql' in entry else None for entry in entries]
+        # Summaries are written in file order as soon as they are ready
+        for entry, future in zip(entries, futures):
+            if future is not None:
+                status, rows, ms, message = future.result()
+                entry.update(status=status, rows=rows, time_ms=round(ms, 3),
+                             message=message)
+            writer.write_rows([[entry['file'], entry['query'], entry['status'],
+                                entry.get('rows'), entry.get('time_ms'),
+                                entry['message']]])
+    out.flush()
+
+    failed = sum(1 for entry in entries if entry['status'] != 'OK')
+    report = sys.stderr if out is sys.stdout and fmt != 'table' else sys.stdout
+    print("\n" + str(len(entries)) + " queries, " + str(failed) + " failed" +
+          " (%.3f s)\n" % (time.perf_counter() - start), file=report)
+    return entries
+
+
+# Prompts are only shown at a terminal, so queries can be piped in and the
+# results piped out
 def read_input():
+    interactive = sys.stdin.isatty()
     result = ''
-    data = input('RA: ').strip()
+    data = input('RA: ' if interactive else '').strip()
     while True:
         if ';' in data:
             i = data.index(';')
@@ -593,18 +1202,32 @@ def read_input():
             break
         else:
             result += data + ' '
-            data = input('> ').strip()
+            data = input('> ' if interactive else '').strip()
     return result
 
 
-def set_temp_table_names(tree):
+# Name the operator nodes TEMP_0, TEMP_1, ... from left to right. The counter is
+# local to one tree, so concurrent compilations never share it.
+def set_temp_table_names(tree, counter=None):
+    if counter is None:
+        counter = [0]
     if tree != None and tree.get_node_type() != 'relation':
-        global count
-        set_temp_table_names(tree.get_left_child())
-        tree.set_relation_name('TEMP_' + str(count))
-        count += 1
+        set_temp_table_names(tree.get_left_child(), counter)
+        tree.set_relation_name('TEMP_' + str(counter[0]))
+        counter[0] += 1
         if tree.right_child != None:
-            set_temp_table_names(tree.get_right_child())
+            set_temp_table_names(tree.get_right_child(), counter)
+
+# Reorder the computed attributes/domains of a join or times node to the
+# output order recorded by the join-ordering optimizer, if any
+def apply_output_order(tree):
+    order = tree.get_output_order()
+    attrs = tree.get_attributes()
+    if order is None or sorted(order) != sorted(attrs):
+        return
+    doms = tree.get_domains()
+    tree.set_domains([doms[attrs.index(attr)] for attr in order])
+    tree.set_attributes(list(order))
 
 # perform semantic checks; set tree.attributes and tree.domains along the way
 # return "OK" or ERROR message
@@ -685,6 +1308,7 @@ def semantic_checks(tree, db):
 
         tree.set_attributes(t_attrs)
         tree.set_domains(t_doms)
+        apply_output_order(tree)
         return 'OK'
 
     if tree.get_node_type() in ['union', 'intersect', 'minus']:
@@ -744,6 +1368,7 @@ def semantic_checks(tree, db):
         tree.set_join_columns(jcols)
         tree.set_attributes(j_attrs)
         tree.set_domains(j_doms)
+        apply_output_order(tree)
         return 'OK'
 
     if tree.get_node_type() == 'project':
@@ -888,11 +1513,933 @@ def semantic_checks(tree, db):
     return 'OK'
 
 
+# ---------------------- Optimizer ----------------------
+# Rule-based rewrites of a checked tree before SQL generation: selections are
+# pushed towards the leaves, select-over-times predicates spanning both sides
+# become join conditions of the product, and projections are pushed below
+# products. The rewritten tree is re-checked, so every node carries correct
+# attributes, domains and TEMP names for generateSQL and the visualization.
+
+AGGREGATE_TYPES = ['aggregate1', 'aggregate2', 'aggregate3']
+
+
+# Aggregates, and joins directly over an aggregate, get special treatment in
+# generateSQL; the optimizer never moves operators into or out of them.
+def is_opaque(tree):
+    if tree.get_node_type() in AGGREGATE_TYPES:
+        return True
+    if tree.get_node_type() == 'join':
+        return tree.get_left_child().get_node_type() in AGGREGATE_TYPES or \
+            tree.get_right_child().get_node_type() in AGGREGATE_TYPES
+    return False
+
+
+def condition_columns(condition):
+    cols = []
+    if condition[0] == 'col':
+        cols.append(condition[1])
+    if condition[3] == 'col':
+        cols.append(condition[4])
+    return cols
+
+
+def rename_condition(condition, mapping):
+    renamed = list(condition)
+    if renamed[0] == 'col':
+        renamed[1] = mapping[renamed[1]]
+    if renamed[3] == 'col':
+        renamed[4] = mapping[renamed[4]]
+    return renamed
+
+
+def make_select(tree, conditions):
+    if not conditions:
+        return tree
+    n = Node("select", tree, None)
+    n.set_conditions(conditions)
+    return n
+
+
+# Return a tree equivalent to select[conditions](tree) with every condition
+# evaluated as close to the leaves as possible.
+def push_selections(tree, conditions):
+    ntype = tree.get_node_type()
+
+    if ntype == 'select':
+        return push_selections(tree.get_left_child(),
+                               conditions + tree.get_conditions())
+
+    if ntype == 'relation':
+        return make_select(tree, conditions)
+
+    if is_opaque(tree):
+        tree.set_left_child(push_selections(tree.get_left_child(), []))
+        if tree.get_right_child() is not None:
+            tree.set_right_child(push_selections(tree.get_right_child(), []))
+        return make_select(tree, conditions)
+
+    if ntype == 'project':
+        if is_opaque(tree.get_left_child()):
+            tree.set_left_child(push_selections(tree.get_left_child(), []))
+            return make_select(tree, conditions)
+        tree.set_left_child(push_selections(tree.get_left_child(), conditions))
+        return tree
+
+    if ntype == 'rename':
+        mapping = dict(zip(tree.get_attributes(),
+                           tree.get_left_child().get_attributes()))
+        tree.set_left_child(push_selections(
+            tree.get_left_child(),
+            [rename_condition(c, mapping) for c in conditions]))
+        return tree
+
+    lattrs = tree.get_left_child().get_attributes()
+    rattrs = tree.get_right_child().get_attributes()
+    left = []
+    right = []
+    keep = []
+
+    if ntype == 'times':
+        out_attrs = tree.get_attributes()
+        side = {}
+        for i, attr in enumerate(lattrs):
+            side[out_attrs[i]] = ('L', attr)
+        for i, attr in enumerate(rattrs):
+            side[out_attrs[len(lattrs) + i]] = ('R', attr)
+        spanning = []
+        for condition in conditions:
+            sides = set(side[col][0] for col in condition_columns(condition))
+            mapping = {col: side[col][1]
+                       for col in condition_columns(condition)}
+            if sides == {'L'}:
+                left.append(rename_condition(condition, mapping))
+            elif sides == {'R'}:
+                right.append(rename_condition(condition, mapping))
+            elif sides == {'L', 'R'}:
+                spanning.append(condition)
+            else:
+                keep.append(condition)
+        # With an equality across both sides the product is really a join;
+        # the spanning predicates become its join conditions
+        if any(c[2] == '=' for c in spanning):
+            tree.set_conditions((tree.get_conditions() or []) + spanning)
+        else:
+            keep += spanning
+
+    elif ntype == 'join':
+        for condition in conditions:
+            cols = condition_columns(condition)
+            in_left = all(col in lattrs for col in cols)
+            in_right = all(col in rattrs for col in cols)
+            if in_left:
+                left.append(condition)
+            if in_right:
+                right.append(condition)
+            if not cols or not (in_left or in_right):
+                keep.append(condition)
+
+    else:
+        # union, intersect and minus: the predicate can be applied to both
+        # inputs; the right input is matched by column position
+        mapping = dict(zip(tree.get_attributes(), rattrs))
+        left = conditions
+        right = [rename_condition(c, mapping) for c in conditions]
+
+    tree.set_left_child(push_selections(tree.get_left_child(), left))
+    tree.set_right_child(push_selections(tree.get_right_child(), right))
+    return make_select(tree, keep)
+
+
+# Narrow the inputs of a product to the columns needed above it. Columns
+# present on both sides are kept so the _L/_R output names do not change.
+def narrow_product_inputs(tree, needed):
+    lattrs = tree.get_left_child().get_attributes()
+    rattrs = tree.get_right_child().get_attributes()
+    out_attrs = tree.get_attributes()
+    needed = set(needed)
+    for condition in tree.get_conditions() or []:
+        needed.update(condition_columns(condition))
+    common = set(lattrs) & set(rattrs)
+
+    lneed = [attr for i, attr in enumerate(lattrs)
+             if out_attrs[i] in needed or attr in common]
+    rneed = [attr for i, attr in enumerate(rattrs)
+             if out_attrs[len(lattrs) + i] in needed or attr in common]
+
+    if lneed and len(lneed) < len(lattrs):
+        tree.set_left_child(make_project(tree.get_left_child(), lneed))
+    if rneed and len(rneed) < len(rattrs):
+        tree.set_right_child(make_project(tree.get_right_child(), rneed))
+
+
+def make_project(tree, columns):
+    # Narrowing an existing project does not add another duplicate elimination
+    if tree.get_node_type() == 'project':
+        tree.set_columns(columns)
+        return tree
+    n = Node("project", tree, None)
+    n.set_columns(columns)
+    return n
+
+
+# Push projections below products (times nodes, including those that became
+# joins). Natural joins are left alone: a new project above a base relation
+# adds a GROUP BY and takes away SQLite's ability to use the table's indexes.
+def push_projections(tree):
+    if tree is None or tree.get_node_type() == 'relation':
+        return tree
+
+    if tree.get_node_type() == 'project' and not is_opaque(tree.get_left_child()):
+        needed = set(tree.get_columns())
+        node = tree.get_left_child()
+        while node.get_node_type() == 'select':
+            for condition in node.get_conditions():
+                needed.update(condition_columns(condition))
+            node = node.get_left_child()
+        if node.get_node_type() == 'times':
+            narrow_product_inputs(node, needed)
+
+    push_projections(tree.get_left_child())
+    push_projections(tree.get_right_child())
+    return tree
+
+
+# Optimize a tree that passed semantic_checks. The input tree is left intact;
+# if a rewrite ever fails to re-check, the original tree is returned.
+def optimize_tree(tree, db):
+    optimized = push_selections(copy.deepcopy(tree), [])
+    if semantic_checks(optimized, db) != 'OK':
+        return tree
+    optimized = push_projections(optimized)
+    set_temp_table_names(optimized)
+    if semantic_checks(optimized, db) != 'OK':
+        return tree
+    optimized = order_joins(optimized, db)
+    set_temp_table_names(optimized)
+    if semantic_checks(optimized, db) != 'OK':
+        return tree
+    return optimized
+
+
+# ---------------------- Join ordering ----------------------
+# Chains of natural joins (and products whose inputs share no column names)
+# are reordered left-deep by a greedy search over estimated intermediate
+# sizes. Estimates come from sqlite_stat1 when the database has been
+# ANALYZEd, otherwise from COUNT(*) and COUNT(DISTINCT col) on base tables.
+
+class TableStatistics():
+
+    def __init__(self, version=None):
+        self.version = version
+        self.rows = {}
+        self.distinct = {}
+        self.index_info = {}
+        self.stat1 = None
+        self.lock = threading.Lock()
+
+    # sqlite_stat1 rows as {table: (rows, {leading index column: distinct})}
+    def load_stat1(self, db):
+        stat1 = {}
+        c = db.conn.cursor()
+        try:
+            records = c.execute(
+                "SELECT tbl, idx, stat FROM sqlite_stat1").fetchall()
+        except sqlite3.Error:
+            records = []
+        for tbl, idx, stat in records:
+            numbers = [int(x) for x in stat.split() if x.isdigit()]
+            if not numbers:
+                continue
+            rows, distinct = stat1.get(tbl.upper(), (numbers[0], {}))
+            rows = max(rows, numbers[0])
+            if idx is not None and len(numbers) > 1 and numbers[1] > 0:
+                info = c.execute(
+                    "select name from pragma_index_info(?)", (idx,)).fetchall()
+                if info:
+                    distinct[info[0][0].upper()] = numbers[0] // numbers[1]
+            stat1[tbl.upper()] = (rows, distinct)
+        c.close()
+        return stat1
+
+    def get_stat1(self, db):
+        with self.lock:
+            if self.stat1 is None:
+                self.stat1 = self.load_stat1(db)
+            return self.stat1
+
+    def row_count(self, db, rname):
+        stat1 = self.get_stat1(db)
+        if rname in stat1:
+            return stat1[rname][0]
+        with self.lock:
+            if rname not in self.rows:
+                c = db.conn.cursor()
+                self.rows[rname] = c.execute(
+                    f"SELECT COUNT(*) FROM {rname}").fetchone()[0]
+                c.close()
+            return self.rows[rname]
+
+    # Indexes of a table as (index name, leading column, collation)
+    def indexes(self, db, rname):
+        with self.lock:
+            if rname not in self.index_info:
+                c = db.conn.cursor()
+                found = []
+                for record in c.execute(
+                        "select name from pragma_index_list(?)", (rname,)).fetchall():
+                    cols = c.execute(
+                        "select name, coll from pragma_index_xinfo(?) where key = 1 order by seqno",
+                        (record[0],)).fetchall()
+                    if cols and cols[0][0] is not None:
+                        found.append(
+                            (record[0], cols[0][0].upper(), cols[0][1].upper()))
+                c.close()
+                self.index_info[rname] = found
+            return self.index_info[rname]
+
+    def distinct_count(self, db, rname, col):
+        stat1 = self.get_stat1(db)
+        if rname in stat1 and col in stat1[rname][1]:
+            return stat1[rname][1][col]
+        with self.lock:
+            if (rname, col) not in self.distinct:
+                c = db.conn.cursor()
+                self.distinct[(rname, col)] = c.execute(
+                    f"SELECT COUNT(DISTINCT {col}) FROM {rname}").fetchone()[0]
+                c.close()
+            return self.distinct[(rname, col)]
+
+
+def get_table_statistics(db):
+    if db.handle is not None:
+        return db.handle.get_statistics(db.version)
+    if db.statistics is None:
+        db.statistics = TableStatistics(db.version)
+    return db.statistics
+
+
+# Base relation column a node's column comes from, as (relation, column), or
+# None for computed columns. Set operations have two sources; with
+# approximate=True the left input stands in for both.
+def column_origin(tree, col, approximate=False):
+    ntype = tree.get_node_type()
+    if ntype == 'relation':
+        return (tree.get_relation_name(), col)
+    if ntype in ['select', 'project']:
+        return column_origin(tree.get_left_child(), col, approximate)
+    if ntype == 'rename':
+        attrs = tree.get_attributes()
+        child_attrs = tree.get_left_child().get_attributes()
+        return column_origin(tree.get_left_child(),
+                             child_attrs[attrs.index(col)], approximate)
+    if ntype in ['join', 'times']:
+        lattrs = tree.get_left_child().get_attributes()
+        rattrs = tree.get_right_child().get_attributes()
+        if ntype == 'times' and col not in lattrs + rattrs:
+            # _L/_R suffixed name of a column present on both sides
+            if col.endswith('_L'):
+                return column_origin(tree.get_left_child(), col[:-2], approximate)
+            return column_origin(tree.get_right_child(), col[:-2], approximate)
+        if col in lattrs:
+            return column_origin(tree.get_left_child(), col, approximate)
+        return column_origin(tree.get_right_child(), col, approximate)
+    if ntype in ['union', 'intersect', 'minus'] and approximate:
+        return column_origin(tree.get_left_child(), col, approximate)
+    return None
+
+
+# SQLite affinity of a node's column, from the declared type of the base
+# column it comes from; None when it cannot be traced to one
+def column_affinity(tree, col, db):
+    origin = column_origin(tree, col)
+    if origin is None or not db.relationExists(origin[0]):
+        return None
+    attrs = db.getAttributes(origin[0])
+    if origin[1] not in attrs:
+        return None
+    return db.getAffinities(origin[0])[attrs.index(origin[1])]
+
+
+# How condition_to_sql compares a condition whose columns have the
+# affinities given by affinity: 'nocase' with COLLATE NOCASE, when both
+# sides are columns or strings and every column has TEXT affinity; 'lower'
+# as LOWER(a) op LOWER(b) when they are but a column may not (NOCASE would
+# let SQLite compare it as a number, where LOWER() has always compared
+# text); None for an ordinary comparison with a number.
+def comparison_mode(condition, affinity):
+    if condition[0] not in ['col', 'str'] or condition[3] not in ['col', 'str']:
+        return None
+    if all(affinity(col) == 'TEXT' for col in condition_columns(condition)):
+        return 'nocase'
+    return 'lower'
+
+
+# Distinct values of a column at a node, traced down to its base relation;
+# None when the column is computed (aggregates) and cannot be traced
+def column_distinct(tree, col, stats, db):
+    origin = column_origin(tree, col, approximate=True)
+    if origin is None:
+        return None
+    return stats.distinct_count(db, origin[0], origin[1])
+
+
+# Fraction of rows kept by one select condition; ndv(col) gives the number
+# of distinct values of a column (or None when unknown)
+def condition_selectivity(condition, ndv):
+    op = condition[2]
+    cols = condition_columns(condition)
+    if op == '=':
+        known = [ndv(col) for col in cols if ndv(col)]
+        return 1.0 / max(known) if known else 0.1
+    if op == '<>':
+        return 0.9
+    return 1.0 / 3
+
+
+def estimate_rows(tree, stats, db):
+    ntype = tree.get_node_type()
+
+    def ndv(col):
+        return column_distinct(tree, col, stats, db)
+
+    if ntype == 'relation':
+        return max(1, stats.row_count(db, tree.get_relation_name()))
+    if ntype == 'select':
+        rows = estimate_rows(tree.get_left_child(), stats, db)
+        for condition in tree.get_conditions():
+            rows *= condition_selectivity(condition, ndv)
+        return max(1, rows)
+    if ntype in ['project', 'rename']:
+        return estimate_rows(tree.get_left_child(), stats, db)
+    if ntype in AGGREGATE_TYPES:
+        return estimate_rows(tree.get_left_child(), stats, db) \
+            if ntype != 'aggregate1' else 1
+    lrows = estimate_rows(tree.get_left_child(), stats, db)
+    rrows = estimate_rows(tree.get_right_child(), stats, db)
+    if ntype == 'times':
+        rows = lrows * rrows
+        for condition in tree.get_conditions() or []:
+            rows *= condition_selectivity(condition, ndv)
+        return max(1, rows)
+    if ntype == 'join':
+        rows = lrows * rrows
+        for col in tree.get_join_columns():
+            known = [n for n in [
+                column_distinct(tree.get_left_child(), col, stats, db),
+                column_distinct(tree.get_right_child(), col, stats, db)] if n]
+            rows /= max(known) if known else min(lrows, rrows)
+        return max(1, rows)
+    if ntype == 'union':
+        return lrows + rrows
+    if ntype == 'intersect':
+        return min(lrows, rrows)
+    return lrows
+
+
+# A node that can be reordered with its neighbours: a plain natural join, or
+# a product of two inputs without common column names
+def is_chain_node(tree):
+    if tree.get_node_type() == 'join':
+        return not is_opaque(tree)
+    if tree.get_node_type() == 'times':
+        lattrs = tree.get_left_child().get_attributes()
+        rattrs = tree.get_right_child().get_attributes()
+        return not (set(lattrs) & set(rattrs))
+    return False
+
+
+def collect_chain(tree, inputs, predicates):
+    if is_chain_node(tree):
+        collect_chain(tree.get_left_child(), inputs, predicates)
+        collect_chain(tree.get_right_child(), inputs, predicates)
+        predicates += tree.get_conditions() or []
+    else:
+        inputs.append(tree)
+
+
+# Estimated result of combining two intermediate results, each given as
+# (rows, {column: distinct values}), applying the predicates that become
+# evaluable at this step. Returns the combined (rows, distinct) pair.
+def combine_estimates(left, right, predicates):
+    lrows, lndv = left
+    rrows, rndv = right
+    rows = lrows * rrows
+    for col in set(lndv) & set(rndv):
+        rows /= max(lndv[col], rndv[col], 1)
+    ndv = dict(lndv)
+    for col, n in rndv.items():
+        ndv[col] = min(ndv.get(col, n), n)
+    for condition in predicates:
+        rows *= condition_selectivity(condition, ndv.get)
+    rows = max(1, rows)
+    return rows, {col: min(n, rows) for col, n in ndv.items()}
+
+
+def newly_applicable(predicates, lcols, rcols):
+    available = set(lcols) | set(rcols)
+    return [p for p in predicates
+            if set(condition_columns(p)) <= available
+            and not set(condition_columns(p)) <= set(lcols)
+            and not set(condition_columns(p)) <= set(rcols)]
+
+
+# Sum of estimated intermediate sizes for the chain as it is currently shaped
+def chain_cost(tree, leaf_estimates, predicates):
+    if not is_chain_node(tree):
+        return leaf_estimates[id(tree)], 0
+    left, lcost = chain_cost(tree.get_left_child(), leaf_estimates, predicates)
+    right, rcost = chain_cost(
+        tree.get_right_child(), leaf_estimates, predicates)
+    combined = combine_estimates(
+        left, right, newly_applicable(predicates, left[1], right[1]))
+    return combined, lcost + rcost + combined[0]
+
+
+# Greedy left-deep order: start from the cheapest pair, then keep adding the
+# input that gives the smallest intermediate result
+def greedy_join_order(inputs, estimates, predicates):
+    best = None
+    for i in range(len(inputs)):
+        for j in range(len(inputs)):
+            if i == j:
+                continue
+            combined = combine_estimates(
+                estimates[i], estimates[j],
+                newly_applicable(predicates, estimates[i][1], estimates[j][1]))
+            if best is None or combined[0] < best[0][0]:
+                best = (combined, [i, j])
+    (current, order) = best
+    cost = current[0]
+    while len(order) < len(inputs):
+        step = None
+        for k in range(len(inputs)):
+            if k in order:
+                continue
+            combined = combine_estimates(
+                current, estimates[k],
+                newly_applicable(predicates, current[1], estimates[k][1]))
+            if step is None or combined[0] < step[0][0]:
+                step = (combined, k)
+        current = step[0]
+        order.append(step[1])
+        cost += current[0]
+    return order, cost
+
+
+def build_join_chain(inputs, order, predicates):
+    tree = inputs[order[0]]
+    cols = set(tree.get_attributes())
+    remaining = list(predicates)
+    for k in order[1:]:
+        right = inputs[k]
+        rcols = set(right.get_attributes())
+        ready = newly_applicable(remaining, cols, rcols)
+        remaining = [p for p in remaining if p not in ready]
+        if cols & rcols:
+            tree = make_select(Node("join", tree, right), ready)
+        else:
+            tree = Node("times", tree, right)
+            if ready:
+                tree.set_conditions(ready)
+        cols |= rcols
+    return make_select(tree, remaining)
+
+
+# Reorder every join chain of a checked tree when the estimated cost of the
+# greedy order is clearly lower. The result must be re-checked by the caller.
+def order_joins(tree, db, stats=None):
+    if tree is None or tree.get_node_type() == 'relation':
+        return tree
+    if stats is None:
+        stats = get_table_statistics(db)
+
+    if not is_chain_node(tree):
+        tree.set_left_child(order_joins(tree.get_left_child(), db, stats))
+        if tree.get_right_child() is not None:
+            tree.set_right_child(order_joins(
+                tree.get_right_child(), db, stats))
+        return tree
+
+    inputs = []
+    predicates = []
+    collect_chain(tree, inputs, predicates)
+    inputs = [order_joins(node, db, stats) for node in inputs]
+    if len(inputs) < 3:
+        return tree
+
+    estimates = []
+    leaf_estimates = {}
+    for node in inputs:
+        rows = estimate_rows(node, stats, db)
+        ndv = {}
+        for col in node.get_attributes():
+            n = column_distinct(node, col, stats, db)
+            ndv[col] = min(n, rows) if n else rows
+        estimates.append((rows, ndv))
+        leaf_estimates[id(node)] = (rows, ndv)
+
+    _, current_cost = chain_cost(tree, leaf_estimates, predicates)
+    order, cost = greedy_join_order(inputs, estimates, predicates)
+    if order == list(range(len(inputs))) or cost >= 0.9 * current_cost:
+        return tree
+
+    rebuilt = build_join_chain(inputs, order, predicates)
+    top = rebuilt
+    while top.get_node_type() == 'select':
+        top = top.get_left_child()
+    top.set_output_order(list(tree.get_attributes()))
+    return rebuilt
+
+
+# ---------------------- Query plans ----------------------
+# EXPLAIN QUERY PLAN output for generated SQL, one dict per plan row:
+#   kind: 'scan' (full scan of a table or subquery), 'search' (index lookup),
+#         'temp-btree' (sorting for GROUP BY/DISTINCT/ORDER BY/UNION...),
+#         or 'other' (MATERIALIZE, CO-ROUTINE, COMPOUND QUERY, ...)
+#   table, index, automatic, covering, columns: details parsed from the row
+
+PLAN_SCAN = re.compile(
+    r"^SCAN (?:TABLE )?(\S+)(?: AS \S+)?(?: USING (COVERING )?INDEX (\S+))?")
+PLAN_SEARCH = re.compile(
+    r"^SEARCH (?:TABLE )?(\S+)(?: AS \S+)? USING (AUTOMATIC )?(?:PARTIAL )?(COVERING )?"
+    r"(?:INDEX|PRIMARY KEY|INTEGER PRIMARY KEY)(?: ([^\s(]\S*))?(?: \((.*)\))?")
+
+
+def parse_plan_row(record):
+    detail = record[3]
+    row = {'id': record[0], 'parent': record[1], 'detail': detail,
+           'kind': 'other', 'table': None, 'index': None,
+           'automatic': False, 'covering': False, 'columns': []}
+    match = PLAN_SCAN.match(detail)
+    if match and not detail.startswith("SCAN CONSTANT"):
+        row['kind'] = 'scan'
+        row['table'] = match.group(1)
+        row['covering'] = match.group(2) is not None
+        row['index'] = match.group(3)
+        return row
+    match = PLAN_SEARCH.match(detail)
+    if match:
+        row['kind'] = 'search'
+        row['table'] = match.group(1)
+        row['automatic'] = match.group(2) is not None
+        row['covering'] = match.group(3) is not None
+        row['index'] = match.group(4)
+        if match.group(5):
+            row['columns'] = [term.split('=')[0].split('>')[0].split('<')[0].strip().upper()
+                              for term in match.group(5).split(' AND ')]
+        return row
+    if detail.startswith("USE TEMP B-TREE") or "USING TEMP B-TREE" in detail:
+        row['kind'] = 'temp-btree'
+    return row
+
+
+def explain_query_plan(query, db):
+    c = db.conn.cursor()
+    records = c.execute("EXPLAIN QUERY PLAN " + query).fetchall()
+    c.close()
+    return [parse_plan_row(record) for record in records]
+
+
+# Plan row kinds shown as badges on tree nodes, most expensive first
+PLAN_BADGES = ['automatic-index', 'scan', 'temp-btree', 'index']
+
+
+def plan_badge(row):
+    if row['kind'] == 'search':
+        if row['automatic']:
+            return {'kind': 'automatic-index',
+                    'text': f"auto index {row['table']}({', '.join(row['columns'])})"}
+        return {'kind': 'index', 'text': f"index {row['table']}"}
+    if row['kind'] == 'scan':
+        return {'kind': 'scan', 'text': f"scan {row['table']}"}
+    if row['kind'] == 'temp-btree':
+        return {'kind': 'temp-btree',
+                'text': "temp b-tree " + row['detail'].split(" FOR ")[-1].split(" USING ")[0]}
+    return None
+
+
+# Plan rows indented by their depth in the plan, as the sqlite3 shell does
+def format_query_plan(plan):
+    depth = {0: -1}
+    lines = []
+    for row in plan:
+        depth[row['id']] = depth.get(row['parent'], -1) + 1
+        lines.append("  " * depth[row['id']] + row['detail'])
+    return lines
+
+
+# Attach the plan of every node's generated SQL to the JSON tree as 'plan'
+# (formatted rows) and 'plan_badges'. A node's plan covers its whole subtree,
+# so badges are only given for rows that its operator children's plans do not
+# already contain; reading a relation is always a scan and gets no badges.
+def annotate_query_plans(json_tree, db):
+    def annotate(json_node, node):
+        if json_node is None:
+            return Counter()
+        compiled = tree_registry.lookup(json_tree, json_node['node_id'], db)
+        sql = compiled.sql if compiled is not None else generateSQL(node, db)
+        plan = explain_query_plan(sql, db)
+        json_node['plan'] = format_query_plan(plan)
+        json_node['plan_badges'] = []
+        inherited = annotate(json_node.get('left_child'), node.get_left_child()) + \
+            annotate(json_node.get('right_child'), node.get_right_child())
+        rows = Counter((row['kind'], row['detail']) for row in plan)
+        if node.get_node_type() == 'relation':
+            return Counter()
+        new_rows = rows - inherited
+        for row in plan:
+            key = (row['kind'], row['detail'])
+            badge = plan_badge(row)
+            if new_rows[key] > 0 and badge is not None:
+                json_node['plan_badges'].append(badge)
+                new_rows[key] -= 1
+        json_node['plan_badges'].sort(key=lambda b: PLAN_BADGES.index(b['kind']))
+        return rows
+
+    annotate(json_tree, json_to_node(json_tree))
+    return json_tree
+
+
+# ---------------------- Index eligibility ----------------------
+# Which select predicates SQLite can answer from an index. String predicates
+# compare with COLLATE NOCASE and need an index with NOCASE collation on the
+# column; numeric ones can use any ordinary index. Indexes are never created
+# while serving queries; index_advisor.py recommends them, and creates them
+# when asked to.
+
+
+# (node, condition, column domains) for every predicate in the tree
+def tree_predicates(tree, found=None):
+    if found is None:
+        found = []
+    if tree is None:
+        return found
+    if tree.get_node_type() == 'select':
+        child = tree.get_left_child()
+        doms = dict(zip(child.get_attributes(), child.get_domains()))
+        for condition in tree.get_conditions():
+            found.append((child, condition, doms))
+    elif tree.get_node_type() == 'times' and tree.get_conditions():
+        doms = dict(zip(tree.get_attributes(), tree.get_domains()))
+        for condition in tree.get_conditions():
+            found.append((tree, condition, doms))
+    tree_predicates(tree.get_left_child(), found)
+    tree_predicates(tree.get_right_child(), found)
+    return found
+
+
+def condition_text(condition):
+    left = f"'{condition[1]}'" if condition[0] == 'str' else condition[1]
+    right = f"'{condition[4]}'" if condition[3] == 'str' else condition[4]
+    return f"{left} {condition[2]} {right}"
+
+
+# Report, for every predicate, whether it can use an index. Returns a list of
+# {'condition', 'column', 'eligible', 'reason'} dicts in tree order.
+def index_eligibility_report(tree, db):
+    stats = get_table_statistics(db)
+    report = []
+    for node, condition, doms in tree_predicates(tree):
+        entry = {'condition': condition_text(condition), 'column': None,
+                 'eligible': False}
+        report.append(entry)
+        if condition[2] == '<>':
+            entry['reason'] = "'<>' cannot be answered from an index"
+            continue
+        cols = condition_columns(condition)
+        if not cols:
+            entry['reason'] = "no column in predicate"
+            continue
+        mode = comparison_mode(condition, lambda col: column_affinity(node, col, db))
+        if mode == 'lower':
+            entry['reason'] = "a column without TEXT affinity compared with a column or " \
+                "string is compared as text with LOWER(), which no index can answer"
+            continue
+        reasons = []
+        for col in cols:
+            origin = column_origin(node, col)
+            if origin is None:
+                reasons.append(f"{col} is computed or comes from a set operation")
+                continue
+            entry['column'] = f"{origin[0]}.{origin[1]}"
+            needed = 'NOCASE' if mode == 'nocase' else 'BINARY'
+            matching = [idx for idx in stats.indexes(db, origin[0])
+                        if idx[1] == origin[1]]
+            usable = [idx for idx in matching if idx[2] == needed]
+            if usable:
+                entry['eligible'] = True
+                reasons = [f"index {usable[0][0]} on {origin[0]}.{origin[1]} ({needed})"]
+                break
+            if matching:
+                reasons.append(
+                    f"index {matching[0][0]} on {origin[0]}.{origin[1]} is {matching[0][2]}, "
+                    f"the comparison needs {needed}")
+            else:
+                reasons.append(f"no index on {origin[0]}.{origin[1]}")
+        entry['reason'] = "; ".join(reasons)
+    return report
+
+
+def print_index_report(report):
+    for entry in report:
+        mark = "INDEX" if entry['eligible'] else "SCAN "
+        print(f"{mark}  {entry['condition']:<30} {entry['reason']}")
+
+
 # given the relational algebra expression tree, generate an equivalent
 # sqlite3 query.
 
 
-def generateSQL(tree, db):
+# Structural signature of a subtree. Two subtrees with the same signature
+# produce the same rows; TEMP_n names are only aliases and are left out.
+# Signatures are digests, so a parent's signature does not grow with (or
+# re-escape) the text of its children's.
+def node_signature(tree, memo):
+    key = id(tree)
+    if key in memo:
+        return memo[key]
+    if tree.get_node_type() == 'relation':
+        sig = repr(('relation', tree.get_relation_name()))
+    else:
+        sig = hashlib.sha1(repr((
+            tree.get_node_type(), tree.get_columns(),
+            tree.get_conditions(), tree.get_join_columns(),
+            tree.get_output_order(), tree.get_sample_limit(),
+            tree.get_aggregate_project_list(),
+            tree.get_aggregate_groupby_list(),
+            tree.get_aggregate_having_condition(),
+            node_signature(tree.get_left_child(), memo)
+            if tree.get_left_child() else None,
+            node_signature(tree.get_right_child(), memo)
+            if tree.get_right_child() else None)).encode()).hexdigest()
+    memo[key] = sig
+    return sig
+
+
+# Common-subexpression elimination for generateSQL. Operator subtrees that are
+# generated more than once are emitted a single time as a WITH clause entry
+# and referenced by name everywhere else.
+class CommonSubexpressions():
+
+    def __init__(self, tree):
+        self.memo = {}
+        self.names = {}
+        self.definitions = []
+        self.shared = set()
+
+        counts = {}
+        self.count_nodes(tree, counts)
+        self.shared = set(sig for sig, n in counts.items() if n > 1)
+
+        # A repeated subtree that only occurs inside another shared subtree is
+        # generated once, as part of that subtree's definition
+        generated = {}
+        self.count_generated(tree, generated, set())
+        self.shared = set(sig for sig in self.shared if generated[sig] > 1)
+
+    def count_nodes(self, tree, counts):
+        if tree is None or tree.get_node_type() == 'relation':
+            return
+        sig = node_signature(tree, self.memo)
+        counts[sig] = counts.get(sig, 0) + 1
+        self.count_nodes(tree.get_left_child(), counts)
+        self.count_nodes(tree.get_right_child(), counts)
+
+    def count_generated(self, tree, generated, seen):
+        if tree is None or tree.get_node_type() == 'relation':
+            return
+        sig = node_signature(tree, self.memo)
+        generated[sig] = generated.get(sig, 0) + 1
+        if sig in self.shared:
+            if sig in seen:
+                return
+            seen.add(sig)
+        self.count_generated(tree.get_left_child(), generated, seen)
+        self.count_generated(tree.get_right_child(), generated, seen)
+
+    def is_shared(self, tree):
+        return tree.get_node_type() != 'relation' and \
+            node_signature(tree, self.memo) in self.shared
+
+    # Name of the CTE for a shared subtree, generating its definition the
+    # first time it is referenced. Definitions are recorded after their own
+    # dependencies, so the WITH clause never references a later entry.
+    def reference(self, tree, db):
+        sig = node_signature(tree, self.memo)
+        if sig not in self.names:
+            sql = apply_sample_limit(tree, generate_node_sql(tree, db, self))
+            name = f"CTE_{len(self.names)}"
+            self.names[sig] = name
+            self.definitions.append((name, sql))
+        return self.names[sig]
+
+    def with_clause(self):
+        if not self.definitions:
+            return ""
+        materialized = "MATERIALIZED " if sqlite3.sqlite_version_info >= (
+            3, 35, 0) else ""
+        entries = [f"{name} AS {materialized}({sql})"
+                   for name, sql in self.definitions]
+        return "WITH " + ", ".join(entries) + " "
+
+
+def generateSQL(tree, db, ctes=None):
+    if ctes is None:
+        ctes = CommonSubexpressions(tree)
+        query = apply_sample_limit(tree, generate_node_sql(tree, db, ctes))
+        return ctes.with_clause() + query
+    if ctes.is_shared(tree):
+        return f"SELECT * FROM {ctes.reference(tree, db)}"
+    return apply_sample_limit(tree, generate_node_sql(tree, db, ctes))
+
+
+# A sampled product only passes on its first sample_limit rows. SQLite
+# produces product rows lazily, so the rest are never computed. The LIMIT is
+# nested one level down so that paging can still append its own.
+def apply_sample_limit(tree, sql):
+    if tree.get_sample_limit() is None:
+        return sql
+    return f"SELECT * FROM (SELECT * FROM ({sql}) LIMIT {int(tree.get_sample_limit())})"
+
+
+# SQL text of one select condition [lot, lop, op, rot, rop]. column_ref maps
+# a column name to the SQL expression that references it (default: as is);
+# column_affinity maps a column name to its affinity (see comparison_mode),
+# and without it every column is taken to possibly hold numbers.
+def condition_to_sql(condition, column_ref=None, column_affinity=None):
+    c1 = condition[1]
+    c4 = condition[4]
+    op = condition[2]
+    left_type = condition[0]
+    right_type = condition[3]
+    mode = comparison_mode(condition, column_affinity or (lambda col: None))
+    if column_ref is not None:
+        if left_type == 'col':
+            c1 = column_ref(c1)
+        if right_type == 'col':
+            c4 = column_ref(c4)
+
+    # Case-insensitive string comparison for ALL operators if either side is
+    # string or column. COLLATE NOCASE leaves the column itself bare, so the
+    # predicate can still be answered from a NOCASE index on it.
+    if mode is not None:
+        if left_type == 'str':
+            c1 = f"'{c1}'"
+        if right_type == 'str':
+            c4 = f"'{c4}'"
+        if mode == 'lower':
+            return f"LOWER({c1}) {op} LOWER({c4})"
+        return f"{c1} {op} {c4} COLLATE NOCASE"
+    else:
+        # Fallback: original logic
+        if left_type == 'str':
+            c1 = f"'{c1}'"
+        if right_type == 'str':
+            c4 = f"'{c4}'"
+        return f"{c1} {op} {c4}"
+
+
+def generate_node_sql(tree, db, ctes):
     # print("Tree before generatesql")
     # tree.print_tree(0)
     if tree.get_node_type() == 'relation':
@@ -906,8 +2453,8 @@ def generateSQL(tree, db):
         right_is_aggregate = tree.get_right_child().get_node_type() in [
             'aggregate1', 'aggregate2', 'aggregate3']
 
-        lquery = generateSQL(tree.get_left_child(), db)
-        rquery = generateSQL(tree.get_right_child(), db)
+        lquery = generateSQL(tree.get_left_child(), db, ctes)
+        rquery = generateSQL(tree.get_right_child(), db, ctes)
 
         if left_is_aggregate or right_is_aggregate:
             lquery = f"({lquery})"
@@ -921,11 +2468,11 @@ def generateSQL(tree, db):
         right_is_aggregate = tree.get_right_child().get_node_type() in [
             'aggregate1', 'aggregate2', 'aggregate3']
 
-        lquery = generateSQL(tree.get_left_child(), db)
+        lquery = generateSQL(tree.get_left_child(), db, ctes)
         if tree.get_left_child().get_node_type() == "union":
             lquery = f"({lquery})"
 
-        rquery = generateSQL(tree.get_right_child(), db)
+        rquery = generateSQL(tree.get_right_child(), db, ctes)
         if tree.get_right_child().get_node_type() == "union":
             rquery = f"({rquery})"
 
@@ -949,13 +2496,31 @@ def generateSQL(tree, db):
                 select_cols.append(f"{right_alias}.\"{attr}\" AS {attr}_R")
             else:
                 select_cols.append(f"{right_alias}.\"{attr}\" AS {attr}")
+        # A reordered chain keeps the column order of the query as written
+        if tree.get_output_order() is not None:
+            by_name = {col.rsplit(" AS ", 1)[1]: col for col in select_cols}
+            select_cols = [by_name[attr] for attr in tree.get_attributes()]
         select_clause = ", ".join(select_cols)
 
         query = f"SELECT {select_clause} FROM ({lquery}) {left_alias}, ({rquery}) {right_alias}"
+
+        # Conditions moved into the product by the optimizer (a theta join),
+        # written against the output column names of the times node
+        if tree.get_conditions():
+            out_attrs = tree.get_attributes()
+            column_sql = {}
+            for i, attr in enumerate(left_attrs):
+                column_sql[out_attrs[i]] = f"{left_alias}.\"{attr}\""
+            for i, attr in enumerate(right_attrs):
+                column_sql[out_attrs[len(left_attrs) + i]] = f"{right_alias}.\"{attr}\""
+            query += " WHERE " + " AND ".join(
+                condition_to_sql(condition, column_sql.get,
+                                 lambda col: column_affinity(tree, col, db))
+                for condition in tree.get_conditions())
         return query
 
     elif tree.get_node_type() == "project":
-        lquery = generateSQL(tree.get_left_child(), db)
+        lquery = generateSQL(tree.get_left_child(), db, ctes)
         query = "SELECT "
 
         # Check if we're projecting from a join that includes an aggregate
@@ -1011,7 +2576,7 @@ def generateSQL(tree, db):
         return query
 
     elif tree.get_node_type() == "rename":
-        lquery = generateSQL(tree.get_left_child(), db)
+        lquery = generateSQL(tree.get_left_child(), db, ctes)
         if tree.get_left_child().get_node_type() == "union":
             lquery = f"({lquery})"
         query = "SELECT "
@@ -1023,37 +2588,16 @@ def generateSQL(tree, db):
         return query
 
     elif tree.get_node_type() == "select":
-        lquery = generateSQL(tree.get_left_child(), db)
+        lquery = generateSQL(tree.get_left_child(), db, ctes)
         left_is_aggregate = tree.get_left_child().get_node_type() in [
             'aggregate1', 'aggregate2', 'aggregate3']
         if tree.get_left_child().get_node_type() == "union" or left_is_aggregate:
             lquery = f"({lquery})"
         query = f"SELECT * FROM ({lquery}) {tree.get_left_child().get_relation_name()} WHERE "
+        child = tree.get_left_child()
         for condition in tree.get_conditions():
-            c1 = condition[1]
-            c4 = condition[4]
-            op = condition[2]
-            left_type = condition[0]
-            right_type = condition[3]
-
-            # Case-insensitive string comparison for ALL operators if either side is string or column
-            if (left_type == 'col' or left_type == 'str') and (right_type == 'col' or right_type == 'str'):
-                if left_type == 'col':
-                    c1_sql = f"LOWER({c1})"
-                else:
-                    c1_sql = f"LOWER('{c1}')"
-                if right_type == 'col':
-                    c4_sql = f"LOWER({c4})"
-                else:
-                    c4_sql = f"LOWER('{c4}')"
-                query += f"{c1_sql} {op} {c4_sql} AND "
-            else:
-                # Fallback: original logic
-                if left_type == 'str':
-                    c1 = f"'{c1}'"
-                if right_type == 'str':
-                    c4 = f"'{c4}'"
-                query += f"{c1} {op} {c4} AND "
+            query += condition_to_sql(
+                condition, column_affinity=lambda col: column_affinity(child, col, db)) + " AND "
 
         query = query[:-5]
         # print("Generated SQL Query (select):", query)
@@ -1065,11 +2609,11 @@ def generateSQL(tree, db):
         right_is_aggregate = tree.get_right_child().get_node_type() in [
             'aggregate1', 'aggregate2', 'aggregate3']
 
-        lquery = generateSQL(tree.get_left_child(), db)
+        lquery = generateSQL(tree.get_left_child(), db, ctes)
         if tree.get_left_child().get_node_type() == "union" or left_is_aggregate:
             lquery = f"({lquery})"
 
-        rquery = generateSQL(tree.get_right_child(), db)
+        rquery = generateSQL(tree.get_right_child(), db, ctes)
         if tree.get_right_child().get_node_type() == "union" or right_is_aggregate:
             rquery = f"({rquery})"
 
@@ -1111,10 +2655,10 @@ def generateSQL(tree, db):
         return query
 
     elif tree.get_node_type() == "intersect":
-        lquery = generateSQL(tree.get_left_child(), db)
+        lquery = generateSQL(tree.get_left_child(), db, ctes)
         if tree.get_left_child().get_node_type() == "union":
             lquery = f"({lquery})"
-        rquery = generateSQL(tree.get_right_child(), db)
+        rquery = generateSQL(tree.get_right_child(), db, ctes)
         if tree.get_right_child().get_node_type() == "union":
             rquery = f"({rquery})"
         query = f"SELECT * FROM ({lquery}) {tree.get_left_child().get_relation_name()} WHERE ("
@@ -1126,7 +2670,7 @@ def generateSQL(tree, db):
         return query
 
     elif tree.get_node_type() == "aggregate1":
-        lquery = generateSQL(tree.get_left_child(), db)
+        lquery = generateSQL(tree.get_left_child(), db, ctes)
         query = "SELECT "
 
         for i, attr in enumerate(tree.get_aggregate_project_list()):
@@ -1143,7 +2687,7 @@ def generateSQL(tree, db):
         return query
 
     elif tree.get_node_type() == "aggregate2":
-        lquery = generateSQL(tree.get_left_child(), db)
+        lquery = generateSQL(tree.get_left_child(), db, ctes)
         query = "SELECT "
 
         for i, attr in enumerate(tree.get_aggregate_project_list()):
@@ -1164,7 +2708,7 @@ def generateSQL(tree, db):
         return query
 
     elif tree.get_node_type() == "aggregate3":
-        lquery = generateSQL(tree.get_left_child(), db)
+        lquery = generateSQL(tree.get_left_child(), db, ctes)
         query = "SELECT "
 
         for i, attr in enumerate(tree.get_aggregate_project_list()):
@@ -1203,10 +2747,10 @@ def generateSQL(tree, db):
         return query
 
     else:
-        lquery = generateSQL(tree.get_left_child(), db)
+        lquery = generateSQL(tree.get_left_child(), db, ctes)
         if tree.get_left_child().get_node_type() == "union":
             lquery = f"({lquery})"
-        rquery = generateSQL(tree.get_right_child(), db)
+        rquery = generateSQL(tree.get_right_child(), db, ctes)
         if tree.get_right_child().get_node_type() == "union":
             rquery = f"({rquery})"
         query = f"SELECT * FROM ({lquery}) {tree.get_left_child().get_relation_name()} WHERE ("
@@ -1219,9 +2763,11 @@ def generateSQL(tree, db):
 
 
 # ------------------------ Dash app Functions -------------------------------
-def tree_to_json(node, db, node_counter=[0]):
+def tree_to_json(node, db, node_counter=None):
     if node is None:
         return None
+    if node_counter is None:
+        node_counter = [0]
 
     relation_name = node.get_relation_name() if node.get_relation_name() else "UNKNOWN"
     node_id = f"node_{node_counter[0]}"
@@ -1246,6 +2792,10 @@ def tree_to_json(node, db, node_counter=[0]):
     # Always include join_columns if present
     if node.get_join_columns() is not None:
         node_json['join_columns'] = node.get_join_columns()
+    if node.get_output_order() is not None:
+        node_json['output_order'] = node.get_output_order()
+    if node.get_sample_limit() is not None:
+        node_json['sample_limit'] = node.get_sample_limit()
 
     # For rename, also include new_columns for compatibility
     if node.get_node_type() == 'rename' and node.get_columns() is not None:
@@ -1260,26 +2810,128 @@ def tree_to_json(node, db, node_counter=[0]):
     return node_json
 
 
-def generate_tree_from_query(query, db, node_counter=[0]):
-    try:
-        tree = rap_parser.parse(query)
+# ---------------------- Compiled query cache ----------------------
+# Checked (and optionally optimized) trees of submitted queries, so the same
+# query submitted again skips parsing, semantic checks and the optimizer.
+# Keys are the query's token stream, which already ignores whitespace,
+# comments and the case of keywords and names, plus the database file and
+# version: a changed file may have a different schema or statistics.
+
+class CompiledQueryCache():
+
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    # Entries are copied on the way in and out, since callers annotate and
+    # rewrite the trees they are given
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return copy.deepcopy(entry)
+
+    def put(self, key, value):
+        value = copy.deepcopy(value)
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self.entries),
+                    'max_entries': self.max_entries}
+
+
+compiled_query_cache = CompiledQueryCache()
+
+
+# Token values are already upper case except keywords, which the lexer
+# matches case-insensitively, and string literals, whose case matters
+def normalized_tokens(tokens):
+    return tuple((tok.type, tok.value if tok.type == 'STRING' else tok.value.upper())
+                 for tok in tokens)
+
+
+# Parse, check and optionally optimize a query. Returns (tree, None), or
+# (None, msg) if a semantic check fails; syntax errors are raised as by
+# rap_parser.parse. Every call gets a tree of its own.
+def compile_query(query, db, optimize=False):
+    tokens = rap_parser.tokenize(query)
+    key = (db.dbfile, db.version, optimize, normalized_tokens(tokens))
+    cached = compiled_query_cache.get(key)
+    if cached is not None:
+        return cached
+
+    tree = rap_parser.parse_tokens(tokens)
+    set_temp_table_names(tree)
+    msg = semantic_checks(tree, db)
+    if msg != 'OK':
+        result = (None, msg)
+    else:
+        if optimize:
+            tree = optimize_tree(tree, db)
+        result = (tree, None)
+    compiled_query_cache.put(key, result)
+    return result
 
-        set_temp_table_names(tree)
 
-        validation_msg = semantic_checks(tree, db)
-        if validation_msg != 'OK':
+def generate_tree_from_query(query, db, node_counter=None, optimize=False):
+    try:
+        tree, validation_msg = compile_query(query, db, optimize)
+        if tree is None:
             return {'error': f"Semantic check failed: {validation_msg}"}
 
+        notes = limit_products(tree, db)
+
         # print("Generated Tree Structure:")
         # tree.print_tree(0)
 
         json_tree = tree_to_json(tree, db, node_counter)
+        if notes:
+            json_tree['limit_notes'] = notes
+        tree_registry.register(tree, json_tree, db)
 
         return json_tree
     except Exception as e:
         return {'error': str(e)}
 
 
+# Build both the tree as written and the optimized tree, for side-by-side
+# display. Returns {'original': json, 'optimized': json} or {'error': msg}.
+def generate_optimizer_comparison(query, db):
+    try:
+        tree, validation_msg = compile_query(query, db)
+        if tree is None:
+            return {'error': f"Semantic check failed: {validation_msg}"}
+
+        optimized, _ = compile_query(query, db, optimize=True)
+        trees = {}
+        for name, checked in [('original', tree), ('optimized', optimized)]:
+            notes = limit_products(checked, db)
+            trees[name] = tree_to_json(checked, db, [0])
+            if notes:
+                trees[name]['limit_notes'] = notes
+            tree_registry.register(checked, trees[name], db)
+        return trees
+    except Exception as e:
+        return {'error': str(e)}
+
+
 # Recursively traverse the JSON tree to find the node with the given node_id.
 def get_node_by_id(json_tree, node_id):
     if json_tree is None:
@@ -1318,6 +2970,10 @@ def json_to_node(json_node):
         node.set_conditions(json_node['conditions'])
     if 'join_columns' in json_node:
         node.set_join_columns(json_node.get('join_columns', []))
+    if 'output_order' in json_node:
+        node.set_output_order(json_node['output_order'])
+    if 'sample_limit' in json_node:
+        node.set_sample_limit(json_node['sample_limit'])
 
     if node.get_node_type() in ['aggregate1', 'aggregate2', 'aggregate3']:
         node.set_aggregate_project_list(
@@ -1330,30 +2986,872 @@ def json_to_node(json_node):
     return node
 
 
-def get_node_info_from_db(node_id, json_tree, db):
-    try:
+# ---------------------- Compiled node registry ----------------------
+# A submitted tree is compiled once, node by node, into what a click on a
+# node needs: its SQL, its column domains and the keys of its cached
+# results. The compiled nodes are kept under a tree id that is stored
+# in the root of the tree's JSON, so a click looks its node up by node_id
+# instead of searching the JSON and generating SQL again.
+#
+# The registry also keeps the JSON itself, so the app only has to send the
+# tree id to the browser and back. A tree is therefore only usable while it
+# is registered: trees not used for TREE_TTL seconds are evicted, as are the
+# least recently used ones once the registry holds about TREE_REGISTRY_BYTES,
+# and a restart forgets them all.
+
+TREE_REGISTRY_BYTES = int(float(os.environ.get('RAV_TREE_REGISTRY_MB', '256')) * 1024 * 1024)
+TREE_TTL = float(os.environ.get('RAV_TREE_TTL', '3600'))
+
+
+class CompiledNode():
+
+    def __init__(self, node, node_json, db):
+        self.node = node
+        self.sql = generateSQL(node, db)
+        self.domains = node.get_domains()
+        self.fingerprint = query_fingerprint(node)
+        self.subtree = canonical_subtree(node_json)
+        self.sql_columns = None
+
+    # Column names of the node's SQL as SQLite reports them, which views
+    # filter and sort on. They are not always the RA attribute names: an
+    # aggregate outputs AVG(SALARY) under its alias, and repeated names get
+    # a ':1' suffix. Looked up on first use.
+    def view_columns(self, db):
+        if self.sql_columns is None:
+            c = db.conn.cursor()
+            c.execute(f"SELECT * FROM ({self.sql}) LIMIT 0")
+            self.sql_columns = [desc[0] for desc in c.description]
+            c.close()
+        return self.sql_columns
+
+
+class RegisteredTree():
+
+    def __init__(self, dbfile, json_tree, nodes):
+        self.dbfile = dbfile
+        self.json_tree = json_tree
+        self.nodes = nodes
+        self.used = time.monotonic()
+        self.nodes_bytes = sum(sys.getsizeof(n.sql) + sys.getsizeof(n.subtree)
+                               for n in nodes.values())
+        self.size = self.nodes_bytes + estimate_size(json_tree)
+
+
+class TreeRegistry():
+
+    def __init__(self, max_bytes=TREE_REGISTRY_BYTES, ttl=TREE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    # Entries are kept in order of use, so expired ones are at the front.
+    # Called with the lock held.
+    def evict(self):
+        now = time.monotonic()
+        while self.entries:
+            tree_id, entry = next(iter(self.entries.items()))
+            if not (self.max_bytes and self.total_bytes > self.max_bytes) and \
+                    not (self.ttl and now - entry.used > self.ttl):
+                break
+            del self.entries[tree_id]
+            self.total_bytes -= entry.size
+
+    def get(self, tree_id):
+        with self.lock:
+            self.evict()
+            entry = self.entries.get(tree_id)
+            if entry is None:
+                return None
+            entry.used = time.monotonic()
+            self.entries.move_to_end(tree_id)
+            return entry
+
+    # Compile every node of tree, whose JSON is json_tree, and store them
+    # under a new tree id, which is also set as json_tree['tree_id']. The
+    # registry keeps json_tree itself, annotations added later included.
+    def register(self, tree, json_tree, db):
+        nodes = {}
+
+        def visit(node, node_json):
+            if node is None:
+                return
+            nodes[node_json['node_id']] = CompiledNode(node, node_json, db)
+            visit(node.get_left_child(), node_json.get('left_child'))
+            visit(node.get_right_child(), node_json.get('right_child'))
+
+        visit(tree, json_tree)
+        tree_id = uuid.uuid4().hex
+        json_tree['tree_id'] = tree_id
+        entry = RegisteredTree(db.dbfile, json_tree, nodes)
+        with self.lock:
+            self.entries[tree_id] = entry
+            self.total_bytes += entry.size
+            self.evict()
+        return tree_id
+
+    # The JSON of a registered tree, or None if it has been evicted
+    def get_tree(self, tree_id):
+        entry = self.get(tree_id)
+        return entry.json_tree if entry is not None else None
+
+    # Replace the JSON of a registered tree with an annotated copy of it
+    def update_tree(self, json_tree):
+        entry = self.get(json_tree.get('tree_id'))
+        if entry is None:
+            return
+        size = entry.nodes_bytes + estimate_size(json_tree)
+        with self.lock:
+            entry.json_tree = json_tree
+            if self.entries.get(json_tree['tree_id']) is entry:
+                self.total_bytes += size - entry.size
+            entry.size = size
+            self.evict()
+
+    # The CompiledNode for node_id of the tree json_tree, or None if the
+    # tree is not registered for db
+    def lookup(self, json_tree, node_id, db):
+        entry = self.get(json_tree.get('tree_id') if json_tree else None)
+        if entry is None or entry.dbfile != db.dbfile:
+            return None
+        return entry.nodes.get(node_id)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+
+tree_registry = TreeRegistry()
+
+
+# The CompiledNode for a click on node_id, or None if there is no such node.
+# The app reads a tree from the registry and then runs the click as a
+# background job, by which time the tree may have been evicted; the job still
+# holds the JSON, so the node is compiled from it. Trees that were never
+# registered, e.g. built by scripts with tree_to_json, are compiled the same
+# way.
+def compiled_node(json_tree, node_id, db):
+    compiled = tree_registry.lookup(json_tree, node_id, db)
+    if compiled is None:
         node_json = get_node_by_id(json_tree, node_id)
+        if node_json is not None:
+            compiled = CompiledNode(json_to_node(node_json), node_json, db)
+    return compiled
+
+
+# LRU cache of evaluated subtree results, bounded by an approximate byte
+# budget. Keys start with the database path and file version, so results are
+# never served for a database file that has changed since they were computed.
+class ResultCache():
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self.entries), 'bytes': self.total_bytes,
+                    'max_bytes': self.max_bytes}
+
+
+# Approximate memory footprint of a cached value (nested lists/tuples/dicts)
+def estimate_size(value):
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for k, v in value.items():
+            size += estimate_size(k) + estimate_size(v)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            size += estimate_size(item)
+    return size
+
+
+result_cache = ResultCache()
+
+
+# ---------------------- Query fingerprints ----------------------
+# A fingerprint identifies what a subtree computes rather than how it was
+# written: TEMP_n names are left out, inputs of commutative operators are
+# sorted (when that does not change their output column names), select
+# conditions are put in a normal form, and project lists are sorted, with the
+# output column order recorded once at the top. Queries that differ only in
+# these ways share result cache entries.
+
+# Operators whose result does not depend on the order of their inputs
+COMMUTATIVE_TYPES = ['union', 'intersect', 'join', 'times']
+# Operators that pair up the columns of their inputs by position
+POSITIONAL_TYPES = ['rename', 'union', 'intersect', 'minus']
+
+FLIPPED_COMPARISON = {'=': '=', '<>': '<>', '<': '>', '>': '<', '<=': '>=', '>=': '<='}
+ASCII_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+
+
+# Comparison with its operands in a fixed order. Numbers are compared as
+# numbers, and string literals compared case-insensitively (see
+# condition_to_sql) are case folded the way NOCASE and LOWER() fold them.
+def normalize_condition(condition):
+    ltype, lval, op, rtype, rval = condition
+    nocase = ltype in ['col', 'str'] and rtype in ['col', 'str']
+
+    def operand(otype, value):
+        if otype == 'num':
+            try:
+                return (otype, repr(float(value)))
+            except ValueError:
+                return (otype, str(value))
+        if otype == 'str' and nocase:
+            return (otype, str(value).translate(ASCII_LOWER))
+        return (otype, str(value))
+
+    left = operand(ltype, lval)
+    right = operand(rtype, rval)
+    if right < left:
+        left, right, op = right, left, FLIPPED_COMPARISON[op]
+    return (left, op, right)
+
+
+# Whether the inputs of a commutative node can be swapped without changing
+# which values its output columns are named after. A product names columns
+# that both inputs have X_L and X_R by side, and a union or intersect takes
+# its column names from its left input.
+def inputs_swappable(tree):
+    left = tree.get_left_child().get_attributes()
+    right = tree.get_right_child().get_attributes()
+    if tree.get_node_type() == 'times':
+        return not set(left) & set(right)
+    if tree.get_node_type() in ['union', 'intersect']:
+        return list(left) == list(right)
+    return True
+
+
+# Order-free form of a checked subtree. Attribute names are kept as a set;
+# inputs that are consumed by position also keep their column order.
+def canonical_form(tree):
+    ntype = tree.get_node_type()
+    if ntype == 'relation':
+        return ('relation', tree.get_relation_name())
+
+    children = []
+    for child in [tree.get_left_child(), tree.get_right_child()]:
+        if child is None:
+            continue
+        form = canonical_form(child)
+        if ntype in POSITIONAL_TYPES:
+            form = (form, tuple(child.get_attributes()))
+        children.append(form)
+    if ntype in COMMUTATIVE_TYPES and inputs_swappable(tree):
+        children.sort(key=repr)
+
+    conditions = None
+    if ntype == 'select' or (ntype == 'times' and tree.get_conditions()):
+        conditions = tuple(sorted(set(normalize_condition(condition)
+                                      for condition in tree.get_conditions())))
+
+    columns = tree.get_columns()
+    if columns is not None:
+        columns = tuple(sorted(columns)) if ntype == 'project' else tuple(columns)
+    join_columns = tree.get_join_columns()
+    if join_columns is not None:
+        join_columns = tuple(sorted(join_columns))
+
+    aggregate = None
+    if ntype in AGGREGATE_TYPES:
+        aggregate = repr((tree.get_aggregate_project_list(),
+                          tree.get_aggregate_groupby_list(),
+                          tree.get_aggregate_having_condition()))
+
+    return (ntype, tuple(sorted(tree.get_attributes())), columns, conditions,
+            join_columns, aggregate, tree.get_sample_limit(), tuple(children))
+
+
+def query_fingerprint(tree):
+    form = (canonical_form(tree), tuple(tree.get_attributes()))
+    return hashlib.sha256(repr(form).encode()).hexdigest()
+
+
+# Display-only fields attached to JSON nodes; they do not change a node's result
+TREE_ANNOTATIONS = ('node_id', 'plan', 'plan_badges', 'profile', 'limit_notes', 'tree_id')
+
+
+# Canonical text of a JSON subtree for cache keys. Node ids and the TEMP_n
+# names of interior nodes only label the tree and do not change the result.
+def canonical_subtree(node_json):
+    def strip(n):
+        if n is None:
+            return None
+        stripped = {k: v for k, v in n.items() if k not in TREE_ANNOTATIONS}
+        if n.get('node_type') != 'relation':
+            stripped.pop('relation_name', None)
+        stripped['left_child'] = strip(n.get('left_child'))
+        stripped['right_child'] = strip(n.get('right_child'))
+        return stripped
+    return json.dumps(strip(node_json), sort_keys=True)
+
+
+# ---------------------- Node table views ----------------------
+# The app's node table can be sorted on a column and filtered on any number
+# of columns. Both are compiled into SQL around the node's query, so SQLite
+# sorts and filters and only the visible page is fetched:
+#   SELECT * FROM (<node query>) WHERE <filters> ORDER BY <column> LIMIT ...
+# order is (column index, 'asc' or 'desc') and filters is a list of (column
+# index, text); columns are the names SQLite gives the node's output. A
+# filter is a comparison such as '>= 30000' or '<> Houston', a number to
+# match exactly, or else text the value must contain; strings are compared
+# ignoring case, as in select conditions.
+
+FILTER_OPERATORS = ['<=', '>=', '<>', '!=', '=', '<', '>']
+SORT_DIRECTIONS = ['asc', 'desc']
+
+
+# SQL condition and parameter for one column filter. On a numeric column a
+# number is compared as a number; anything else is matched as text.
+def filter_clause(column, domain, text):
+    text = text.strip()
+    op = next((op for op in FILTER_OPERATORS if text.startswith(op)), None)
+    value = text[len(op):].strip() if op else text
+    if op == '!=':
+        op = '<>'
+    if domain != 'VARCHAR':
+        try:
+            number = float(value)
+            number = int(number) if number.is_integer() else number
+            return f'"{column}" {op or "="} ?', number
+        except ValueError:
+            pass
+    if op is None:
+        pattern = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        return f'"{column}" LIKE ? ESCAPE \'\\\'', f"%{pattern}%"
+    return f'"{column}" {op} ? COLLATE NOCASE', value
+
+
+# Wrap a node's query in the filters and sort order of a view. Returns
+# (query, parameters).
+def view_query(query, columns, domains, order=None, filters=None):
+    def check_index(index):
+        if not 0 <= index < len(columns):
+            raise ValueError(f"No column {index}; the node has {len(columns)} columns")
+
+    clauses = []
+    params = []
+    for index, text in filters or []:
+        if not text or not text.strip():
+            continue
+        check_index(index)
+        clause, param = filter_clause(columns[index], domains[index], text)
+        clauses.append(clause)
+        params.append(param)
+    if not clauses and not order:
+        return query, params
+    query = f"SELECT * FROM ({query})"
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    if order:
+        index, direction = order
+        check_index(index)
+        if direction not in SORT_DIRECTIONS:
+            raise ValueError(f"Unknown sort direction '{direction}'")
+        collate = " COLLATE NOCASE" if domains[index] == 'VARCHAR' else ""
+        query += f' ORDER BY "{columns[index]}"{collate} {direction.upper()}'
+    return query, params
+
+
+# Count the rows of a generated query without transferring them to Python.
+def count_query_rows(query, db, params=()):
+    c = db.conn.cursor()
+    c.execute(f"SELECT COUNT(*) FROM ({query})", tuple(params))
+    total_rows = c.fetchone()[0]
+    c.close()
+    return total_rows
+
+
+# Fetch one page of a generated query. LIMIT/OFFSET is applied by SQLite, so
+# rows before the page are skipped inside the engine and only the visible
+# page is returned. Returns (columns, rows).
+def fetch_query_page(query, db, page, rows_per_page, params=()):
+    c = db.conn.cursor()
+    c.execute(f"{query} LIMIT ? OFFSET ?",
+              tuple(params) + (rows_per_page, page * rows_per_page))
+    records = c.fetchall()
+    columns = [desc[0] for desc in c.description]
+    c.close()
+    return columns, records
+
+
+# Without a page the whole result is returned, up to QUERY_ROW_LIMIT rows
+# ('truncated' is set if there were more). With a page, only that page is
+# fetched and 'total_rows' holds the size of the full result; the page number
+# is clamped to the last page and returned as 'page'. backend is one of
+# BACKENDS. Pages can be sorted and filtered by order and filters (see
+# view_query), which are returned as 'order' and 'filters'; such pages are
+# always computed by SQLite.
+def get_node_info_from_db(node_id, json_tree, db, page=None, rows_per_page=8,
+                          backend='sqlite', order=None, filters=None):
+    if QUERY_ROW_LIMIT:
+        rows_per_page = min(rows_per_page, QUERY_ROW_LIMIT)
+    order = tuple(order) if order else None
+    filters = tuple((int(index), text) for index, text in filters or []
+                    if text and text.strip())
+    if page is not None and (order or filters):
+        backend = 'sqlite'
+    try:
+        compiled = compiled_node(json_tree, node_id, db)
 
-        if node_json is None:
+        if compiled is None:
             return {'error': 'Node not found in the tree.'}
 
-        node = json_to_node(node_json)
-        query = generateSQL(node, db)
+        # Counts and whole results are shared by every query with the same
+        # fingerprint. Pages are keyed by the subtree as written, since the
+        # order rows come back in (and so what is on each page) depends on
+        # the generated SQL, and on the backend.
+        cache_key = None
+        page_base_key = None
+        if db.version is not None:
+            cache_key = (db.dbfile, db.version, backend, compiled.fingerprint)
+            page_base_key = (db.dbfile, db.version, backend, compiled.subtree)
+
+        query = compiled.sql
+        table = None
+        if page is not None:
+            count_key = cache_key + ('count', filters) if cache_key else None
+            total_rows = result_cache.get(count_key) if count_key else None
+            if total_rows is None:
+                if backend == 'numpy':
+                    table = evaluate_columnar(compiled.node, db)
+                    total_rows = len(table)
+                else:
+                    count_query, params = view_query(
+                        query, compiled.view_columns(db), compiled.domains, None, filters)
+                    total_rows = count_query_rows(count_query, db, params)
+                if count_key:
+                    result_cache.put(count_key, total_rows)
+            max_page = max(0, (total_rows - 1) // rows_per_page)
+            page = max(0, min(page, max_page))
+
+            page_key = page_base_key + ('page', page, rows_per_page, order, filters) \
+                if page_base_key else None
+            cached = result_cache.get(page_key) if page_key else None
+            if cached is None:
+                if backend == 'numpy':
+                    if table is None:
+                        table = evaluate_columnar(compiled.node, db)
+                    cached = (list(table.display),
+                              table.rows(page * rows_per_page, (page + 1) * rows_per_page))
+                else:
+                    page_query, params = view_query(
+                        query, compiled.view_columns(db), compiled.domains, order, filters)
+                    cached = fetch_query_page(page_query, db, page, rows_per_page, params)
+                if page_key:
+                    result_cache.put(page_key, cached)
+            columns, records = cached
+            return {'columns': columns, 'rows': records,
+                    'total_rows': total_rows, 'page': page,
+                    'order': list(order) if order else None,
+                    'filters': [list(f) for f in filters]}
+
+        all_key = cache_key + ('all',) if cache_key else None
+        cached = result_cache.get(all_key) if all_key else None
+        if cached is not None:
+            columns, records, truncated = cached
+            return {'columns': columns, 'rows': records, 'truncated': truncated}
+
+        if backend == 'numpy':
+            table = evaluate_columnar(compiled.node, db)
+            limit = QUERY_ROW_LIMIT or len(table)
+            records = table.rows(0, limit)
+            truncated = len(table) > limit
+            columns = list(table.display)
+            if all_key:
+                result_cache.put(all_key, (columns, records, truncated))
+            return {'columns': columns, 'rows': records, 'truncated': truncated}
 
         c = db.conn.cursor()
         c.execute(query)
-        records = c.fetchall()
+        # Results over QUERY_ROW_LIMIT rows are cut off and flagged
+        if QUERY_ROW_LIMIT:
+            records = c.fetchmany(QUERY_ROW_LIMIT + 1)
+            truncated = len(records) > QUERY_ROW_LIMIT
+            records = records[:QUERY_ROW_LIMIT]
+        else:
+            records = c.fetchall()
+            truncated = False
 
         # Always use the SQL cursor's column order for display
         sql_columns = [desc[0] for desc in c.description]
         columns = sql_columns
+        c.close()
+
+        if all_key:
+            result_cache.put(all_key, (columns, records, truncated))
 
-        return {'columns': columns, 'rows': records}
+        return {'columns': columns, 'rows': records, 'truncated': truncated}
 
     except Exception as e:
         return {'error': f"Error: {str(e)}"}
 
 
+# ---------------------- Profiling ----------------------
+# Evaluate every node's subtree and attach a 'profile' to its JSON node:
+#   time_ms: wall time to run the node's generated SQL and fetch every row
+#   self_ms: time_ms less the time_ms of its children, the operator's share
+#   rows:    rows produced
+#   rows_in: rows produced by its children (rows consumed)
+#   heat:    self_ms relative to the slowest operator in the tree, 0 to 1
+# Each subtree runs on its own, so children are evaluated again inside their
+# parent's query and self_ms is an estimate rather than a measurement.
+
+def profile_query(query, db):
+    c = db.conn.cursor()
+    start = time.perf_counter()
+    c.execute(query)
+    rows = 0
+    while True:
+        batch = c.fetchmany(1000)
+        if not batch:
+            break
+        rows += len(batch)
+    elapsed = (time.perf_counter() - start) * 1000
+    c.close()
+    return elapsed, rows
+
+
+def profile_tree(json_tree, db):
+    profiles = []
+
+    def profile(json_node):
+        if json_node is None:
+            return None
+        children = [profile(json_node.get('left_child')),
+                    profile(json_node.get('right_child'))]
+        children = [child for child in children if child is not None]
+        try:
+            elapsed, rows = profile_query(
+                generateSQL(json_to_node(json_node), db), db)
+        except sqlite3.Error as e:
+            json_node['profile'] = {'error': str(e)}
+            return None
+        child_ms = sum(child['time_ms'] for child in children)
+        json_node['profile'] = {
+            'time_ms': round(elapsed, 3),
+            'self_ms': round(max(0.0, elapsed - child_ms), 3),
+            'rows': rows,
+            'rows_in': sum(child['rows'] for child in children),
+        }
+        profiles.append(json_node['profile'])
+        # Row counts are what paging asks for first when a node is clicked
+        if db.version is not None:
+            result_cache.put((db.dbfile, db.version,
+                              query_fingerprint(json_to_node(json_node)), 'count'), rows)
+        return json_node['profile']
+
+    profile(json_tree)
+    slowest = max([p['self_ms'] for p in profiles] + [0])
+    for p in profiles:
+        p['heat'] = round(p['self_ms'] / slowest, 3) if slowest > 0 else 0.0
+    return json_tree
+
+
+def print_profile(json_tree, indent=0):
+    if json_tree is None:
+        return
+    name = json_tree['node_type']
+    if json_tree['node_type'] == 'relation':
+        name = json_tree['relation_name']
+    p = json_tree.get('profile', {})
+    if 'error' in p:
+        print(" " * indent + f"{name}: {p['error']}")
+    else:
+        print(" " * indent + f"{name}: {p['time_ms']:.3f} ms (self {p['self_ms']:.3f} ms), "
+              f"{p['rows']} rows out, {p['rows_in']} rows in")
+    print_profile(json_tree.get('left_child'), indent + 4)
+    print_profile(json_tree.get('right_child'), indent + 4)
+
+
+# ---------------------- Resource limits ----------------------
+# Limits that keep one query from taking over the machine:
+#   QUERY_TIME_LIMIT:     seconds a query may run before it is stopped
+#   QUERY_ROW_LIMIT:      rows of one node result fetched into Python for
+#                         the app (the CLI streams results instead)
+#   PRODUCT_ROW_LIMIT:    estimated rows of one product (times, or a join
+#                         without common columns), checked before running
+#   PRODUCT_LIMIT_ACTION: 'refuse' to reject such a query, or 'sample' to
+#                         run it on the first PRODUCT_ROW_LIMIT rows
+# A limit of 0 turns it off.
+
+QUERY_TIME_LIMIT = float(os.environ.get('RAV_QUERY_TIME_LIMIT', '30'))
+QUERY_ROW_LIMIT = int(os.environ.get('RAV_QUERY_ROW_LIMIT', '100000'))
+PRODUCT_ROW_LIMIT = int(os.environ.get('RAV_PRODUCT_ROW_LIMIT', '5000000'))
+PRODUCT_LIMIT_ACTION = os.environ.get('RAV_PRODUCT_LIMIT_ACTION', 'refuse')
+
+
+class QueryLimitExceeded(Exception):
+    pass
+
+
+def time_limit_message(time_limit=None):
+    if time_limit is None:
+        time_limit = QUERY_TIME_LIMIT
+    return f"Query stopped after {time_limit:g} seconds, the time limit for one query."
+
+
+# Check the estimated size of every product in a checked tree. Oversized
+# products raise QueryLimitExceeded, or are sampled when PRODUCT_LIMIT_ACTION
+# is 'sample'. Returns a note for each sampled product.
+def limit_products(tree, db):
+    notes = []
+    if not PRODUCT_ROW_LIMIT:
+        return notes
+    stats = get_table_statistics(db)
+
+    def visit(node):
+        if node is None or node.get_node_type() == 'relation':
+            return
+        visit(node.get_left_child())
+        visit(node.get_right_child())
+        is_product = node.get_node_type() == 'times' or \
+            (node.get_node_type() == 'join' and not node.get_join_columns())
+        if not is_product:
+            return
+        rows = estimate_rows(node, stats, db)
+        if rows <= PRODUCT_ROW_LIMIT:
+            return
+        if PRODUCT_LIMIT_ACTION == 'sample':
+            node.set_sample_limit(PRODUCT_ROW_LIMIT)
+            notes.append(f"The product at {node.get_relation_name()} would produce about "
+                         f"{rows:,.0f} rows, so only its first {PRODUCT_ROW_LIMIT:,} are used "
+                         f"and results above it are partial.")
+        else:
+            raise QueryLimitExceeded(
+                f"The product at {node.get_relation_name()} would produce about {rows:,.0f} rows, "
+                f"more than the limit of {PRODUCT_ROW_LIMIT:,}. Add a selection or join "
+                f"condition to make it smaller")
+
+    visit(tree)
+    return notes
+
+
+# Run fn(*args) on db's connection under time_limit seconds (by default the
+# query time limit; 0 for none), raising QueryLimitExceeded if it is stopped
+def run_with_time_limit(db, fn, *args, time_limit=None):
+    if time_limit is None:
+        time_limit = QUERY_TIME_LIMIT
+    job = QueryJob(None, time_limit)
+    job.attach(db)
+    try:
+        return fn(*args)
+    except sqlite3.OperationalError:
+        if job.timed_out:
+            raise QueryLimitExceeded(time_limit_message(time_limit))
+        raise
+    finally:
+        job.detach(db)
+
+
+# ---------------------- Background queries ----------------------
+# SQL that may run for a long time is run on a small pool of worker threads,
+# so the web request that started it returns at once and its thread is free
+# for other users. SQLite calls a job's progress handler every PROGRESS_STEP
+# virtual machine instructions, which counts the work done so far, and a job
+# is cancelled by interrupting the connections it is running on.
+
+PROGRESS_STEP = 10000
+# Seconds a finished job's result is kept for a poll that may never come,
+# e.g. after its browser tab was closed
+JOB_TTL = float(os.environ.get('RAV_JOB_TTL', '600'))
+
+# The job attached on each thread, for work that runs outside SQLite and so
+# has no progress handler to stop it
+running_job = threading.local()
+
+
+class QueryJob():
+
+    def __init__(self, job_id, time_limit=None):
+        self.job_id = job_id
+        self.started = time.perf_counter()
+        self.steps = 0
+        self.cancelled = False
+        self.time_limit = time_limit
+        self.timed_out = False
+        self.connections = []
+        self.future = None
+        self.finished = None
+        self.lock = threading.Lock()
+
+    def progress(self):
+        self.steps += 1
+        if self.time_limit and self.elapsed() > self.time_limit:
+            self.timed_out = True
+        return 1 if self.cancelled or self.timed_out else 0
+
+    def attach(self, db):
+        db.conn.set_progress_handler(self.progress, PROGRESS_STEP)
+        with self.lock:
+            self.connections.append(db.conn)
+        running_job.job = self
+
+    # Connections go back to the pool, so the handler must not stay behind
+    def detach(self, db):
+        db.conn.set_progress_handler(None, PROGRESS_STEP)
+        with self.lock:
+            self.connections.remove(db.conn)
+        running_job.job = None
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            for conn in self.connections:
+                conn.interrupt()
+        if self.future is not None:
+            self.future.cancel()
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+class QueryJobs():
+
+    def __init__(self, max_workers=4, ttl=JOB_TTL):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix='rav-query')
+        self.ttl = ttl
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    # Forget jobs that finished more than ttl seconds ago without being
+    # polled. Called with the lock held.
+    def evict(self):
+        if not self.ttl:
+            return
+        now = time.monotonic()
+        expired = [job_id for job_id, job in self.jobs.items()
+                   if job.finished is not None and now - job.finished > self.ttl]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    # Run fn(db, *args) on a worker with db opened on dbfile. Returns the id
+    # used to poll and cancel the job.
+    def submit(self, dbfile, fn, *args):
+        job = QueryJob(uuid.uuid4().hex, QUERY_TIME_LIMIT)
+
+        def run():
+            db = open_db(dbfile)
+            job.attach(db)
+            try:
+                return fn(db, *args)
+            finally:
+                job.detach(db)
+                db.close()
+
+        def finish(future):
+            job.finished = time.monotonic()
+
+        with self.lock:
+            self.evict()
+            self.jobs[job.job_id] = job
+        job.future = self.executor.submit(run)
+        job.future.add_done_callback(finish)
+        return job.job_id
+
+    # State of a job: 'running', 'done' (with 'result'), 'error' (with
+    # 'error'), 'cancelled' or 'unknown', after waiting up to timeout seconds
+    # for it to finish. A finished job is forgotten once its state is read,
+    # or JOB_TTL seconds after it finished if it is never read.
+    def status(self, job_id, timeout=0):
+        with self.lock:
+            self.evict()
+            job = self.jobs.get(job_id)
+        if job is None:
+            return {'state': 'unknown'}
+        try:
+            result = job.future.result(timeout=timeout)
+            state = {'state': 'done', 'result': result}
+        except FutureTimeout:
+            return {'state': 'running', 'elapsed': job.elapsed(), 'steps': job.steps}
+        except Exception as e:
+            state = {'state': 'error', 'error': str(e)}
+        if job.cancelled:
+            state = {'state': 'cancelled'}
+        elif job.timed_out:
+            state = {'state': 'error', 'error': time_limit_message()}
+        with self.lock:
+            self.jobs.pop(job_id, None)
+        state['elapsed'] = job.elapsed()
+        return state
+
+    def cancel(self, job_id):
+        with self.lock:
+            job = self.jobs.pop(job_id, None)
+        if job is not None:
+            job.cancel()
+
+
+query_jobs = QueryJobs(int(os.environ.get('RAV_QUERY_WORKERS', '4')))
+
+
+# ---------------------- Columnar backend ----------------------
+# Node results can be computed by the columnar engine in columnar.py instead
+# of SQLite. It evaluates the tree in process on numpy arrays and gives the
+# same rows and column names as the generated SQL, though not always in the
+# same order. Query plans and profiles always come from SQLite.
+
+BACKENDS = ['sqlite'] + (['numpy'] if columnar is not None else [])
+
+
+# Stop the columnar engine, between operators, once the job running on this
+# thread is cancelled or over its time limit
+def check_running_job():
+    job = getattr(running_job, 'job', None)
+    if job is None or not job.progress():
+        return
+    if job.cancelled:
+        raise QueryLimitExceeded("Query cancelled.")
+    raise QueryLimitExceeded(time_limit_message(job.time_limit))
+
+
+# Evaluate a checked tree with the columnar engine. Returns a columnar.Table,
+# whose display names are the column names SQLite would report.
+def evaluate_columnar(tree, db):
+    if columnar is None:
+        raise Exception("The numpy backend needs numpy installed")
+    return columnar.evaluate(tree, db, check_running_job)
+
+
 def fetch_schema_info(db_path):
     try:
         conn = sqlite3.connect(db_path)
@@ -1385,21 +3883,100 @@ def fetch_schema_info(db_path):
 
 # ---------------------- Main  ----------------------
 def main():
+    parser = argparse.ArgumentParser(
+        description="Run relational algebra queries against a SQLite database")
+    parser.add_argument("database", help="SQLite database file")
+    parser.add_argument("--format", choices=sorted(RESULT_FORMATS),
+                        default='table', help="format of query results")
+    parser.add_argument("--output", help="write query results to this file "
+                        "instead of stdout")
+    parser.add_argument("--batch", nargs='+', metavar='FILE',
+                        help="run every query in these files on a pool of "
+                        "worker processes and write a summary of each")
+    parser.add_argument("--workers", type=int,
+                        help="worker processes for --batch (default: one per CPU)")
+    parser.add_argument("--optimize", action="store_true",
+                        help="optimize --batch queries before generating SQL")
+    parser.add_argument("--backend", choices=BACKENDS, default='sqlite',
+                        help="engine that computes query results (--batch "
+                        "always uses SQLite)")
+    parser.add_argument("--time-limit", type=float, default=0, metavar="SECONDS",
+                        help="stop a query after this many seconds (default: "
+                        "no limit; --batch uses RAV_QUERY_TIME_LIMIT)")
+    args = parser.parse_args()
+
+    if args.batch:
+        # Patterns are expanded here too, for shells that do not
+        filenames = []
+        for pattern in args.batch:
+            filenames.extend(sorted(glob.glob(pattern)) or [pattern])
+        out = sys.stdout
+        if args.output:
+            out = open(args.output, 'w', newline='', buffering=OUTPUT_BUFFER)
+        try:
+            run_batch(filenames, args.database, out, args.format,
+                      args.workers, args.optimize)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        return
+
     db = SQLite3()
-    db.open(sys.argv[1])
+    db.open(args.database)
+    fmt = args.format
+    if args.output:
+        out = open(args.output, 'w', newline='', buffering=OUTPUT_BUFFER)
+    else:
+        out = sys.stdout
+    # Set when a query is stopped by a limit, so scripts can tell that
+    # --output holds partial results
+    stopped = False
 
     while True:
-        data = read_input()
+        try:
+            data = read_input()
+        except EOFError:
+            break
         if data == 'schema;':
             db.displayDatabaseSchema()
             continue
         if data.strip().split()[0] == "source":
             filename = data.strip().split()[1][:-1]
-            execute_file(filename, db)
+            if not execute_file(filename, db, out, fmt, args.backend, args.time_limit):
+                stopped = True
+            continue
+        if data.strip().split()[0] == "indexes":
+            # report which predicates of the query can use an index
+            try:
+                tree = rap_parser.parse(data.strip()[len("indexes"):])
+                set_temp_table_names(tree)
+                msg = semantic_checks(tree, db)
+                if msg == 'OK':
+                    print_index_report(index_eligibility_report(tree, db))
+                else:
+                    print(msg)
+            except Exception as inst:
+                print(inst.args[0])
+            continue
+        if data.strip().split()[0] == "profile":
+            # time every operator and count the rows it consumes and produces
+            json_tree = generate_tree_from_query(
+                data.strip()[len("profile"):], db, [0])
+            if 'error' in json_tree:
+                print(json_tree['error'])
+            else:
+                try:
+                    print_profile(run_with_time_limit(
+                        db, profile_tree, json_tree, db, time_limit=args.time_limit))
+                except QueryLimitExceeded as e:
+                    print(e, file=sys.stderr)
+                    stopped = True
             continue
         if data == 'help;' or data == "h;":
             print("\nschema; 		# to see schema")
             print("source filename; 	# to run query in file")
+            print("indexes query;		# to see which predicates can use an index")
+            print("profile query;		# to time each operator and count its rows")
             print("query terminated with ;	# to run query")
             print("exit; or quit; or q; 	# to exit\n")
             continue
@@ -1420,11 +3997,16 @@ def main():
         # print("********************************")
         if msg == 'OK':
             # print('Passed semantic checks')
-            query = generateSQL(tree, db)
-            db.displayQueryResults(query, tree)
+            if not display_limited_results(tree, db, out, fmt, args.backend,
+                                           args.time_limit):
+                stopped = True
         else:
             print(msg)
+    if out is not sys.stdout:
+        out.close()
     db.close()
+    if stopped:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -7,9 +7,16 @@ import dash_cytoscape as cyto
 import os
 from RAP import *
 import re
+import copy
 import traceback
 
 DB_FOLDER = 'databases'
+ROWS_PER_PAGE = 8
+# How long a node click waits for its query before showing it as running
+# and polling for the result in the background
+QUICK_RESULT_WAIT = 0.2
+BACKEND_LABELS = {'sqlite': 'SQLite', 'numpy': 'NumPy'}
+SORT_ARROWS = {'asc': ' \u25b2', 'desc': ' \u25bc'}
 
 app = dash.Dash(__name__)
 
@@ -35,9 +42,11 @@ def get_db_files():
     return [{'label': f, 'value': f} for f in db_files]
 
 
-def json_to_cytoscape_elements(json_tree, parent_id=None, elements=None, node_counter=[0], x=0, y=0, x_offset=150, y_offset=100, min_separation=50, level_positions=None):
+def json_to_cytoscape_elements(json_tree, parent_id=None, elements=None, node_counter=None, x=0, y=0, x_offset=150, y_offset=100, min_separation=50, level_positions=None):
     if elements is None:
         elements = []
+    if node_counter is None:
+        node_counter = [0]
 
     if json_tree is None:
         return elements
@@ -55,6 +64,12 @@ def json_to_cytoscape_elements(json_tree, parent_id=None, elements=None, node_co
             f"{cond[1]} {cond[2]} {cond[4]}" for cond in json_tree.get('conditions', [])
         ]
         node_label = f"Select\n{' and '.join(conditions)}"
+    elif json_tree.get('node_type') == 'times' and json_tree.get('conditions'):
+        # Product whose predicates were turned into join conditions by the optimizer
+        conditions = [
+            f"{cond[1]} {cond[2]} {cond[4]}" for cond in json_tree.get('conditions', [])
+        ]
+        node_label = f"Join\n{' and '.join(conditions)}"
     elif json_tree.get('node_type') == 'rename':
         new_columns = ', '.join(json_tree.get('new_columns', []))
         node_label = f"Rename\n{new_columns}"
@@ -99,15 +114,38 @@ def json_to_cytoscape_elements(json_tree, parent_id=None, elements=None, node_co
             lines.append(current)
         return '\n'.join(lines)
 
+    # Products cut down by the resource limits
+    if json_tree.get('sample_limit'):
+        node_label += f"\n(first {json_tree['sample_limit']:,} rows only)"
+
+    # Query plan badges, most expensive first
+    plan_badges = json_tree.get('plan_badges', [])
+    if plan_badges:
+        node_label += '\n' + \
+            '\n'.join(f"[{badge['text']}]" for badge in plan_badges)
+
     node_label = '\n'.join([insert_newlines(line)
                            for line in node_label.split('\n')])
 
+    node_data = {
+        'id': node_id,
+        'label': node_label,
+        'node_type': json_tree.get('node_type', 'Unknown')
+    }
+    if plan_badges:
+        node_data['plan_badge'] = plan_badges[0]['kind']
+
+    # Profiled trees show the operator's time and rows and are colored by heat
+    profile = json_tree.get('profile')
+    if profile and 'error' not in profile:
+        rows = f"{profile['rows']} rows"
+        if json_tree.get('node_type') != 'relation':
+            rows = f"{profile['rows_in']} \u2192 {rows}"
+        node_data['label'] += f"\n{profile['self_ms']:.2f} ms\n{rows}"
+        node_data['heat'] = profile['heat']
+
     elements.append({
-        'data': {
-            'id': node_id,
-            'label': node_label,
-            'node_type': json_tree.get('node_type', 'Unknown')
-        }
+        'data': node_data
     })
 
     if parent_id:
@@ -136,23 +174,69 @@ def json_to_cytoscape_elements(json_tree, parent_id=None, elements=None, node_co
     return elements
 
 
+# Header cells sort the table when clicked, and the row under them holds a
+# filter for each column (see view_query)
 def create_table_from_node_info(node_info):
     columns = node_info['columns']
     rows = node_info['rows']
+    order = node_info.get('order')
+    filters = dict(node_info.get('filters') or [])
 
     # Do not deduplicate columns; preserve order and duplicates as returned
-    table_header = [html.Th(col) for col in columns]
+    table_header = []
+    for i, col in enumerate(columns):
+        arrow = ""
+        if order and order[0] == i:
+            arrow = SORT_ARROWS[order[1]]
+        table_header.append(html.Th(col + arrow, id={'type': 'sort-column', 'index': i},
+                                    className="sortable", n_clicks=0))
+    filter_row = [html.Th(dcc.Input(id={'type': 'filter-column', 'index': i},
+                                    value=filters.get(i, ''), debounce=True,
+                                    placeholder="filter"))
+                  for i in range(len(columns))]
     table_body = [html.Tr([html.Td(cell) for cell in row]) for row in rows]
 
     return html.Table(
         className='classic-table',
         children=[
-            html.Thead(html.Tr(table_header)),
+            html.Thead([html.Tr(table_header),
+                        html.Tr(filter_row, className="filter-row")]),
             html.Tbody(table_body)
         ]
     )
 
 
+# Node table for a get_node_info_from_db result. Returns (children, total rows).
+def node_info_view(node_info):
+    if 'error' in node_info:
+        return html.Div([html.P(f"Error: {node_info['error']}")]), 0
+
+    total_rows = node_info['total_rows']
+    count_text = f"Number of tuples: {total_rows}"
+    if node_info.get('filters'):
+        count_text += " matching the filters"
+    return html.Div([
+        html.P(count_text, className="tuple-count"),
+        create_table_from_node_info(node_info)
+    ]), total_rows
+
+
+def profile_trees(db, trees):
+    for tree in trees.values():
+        profile_tree(tree, db)
+    return trees
+
+
+def cancel_jobs(*job_ids):
+    for job_id in job_ids:
+        if job_id:
+            query_jobs.cancel(job_id)
+
+
+def job_progress_text(status):
+    return f"{status['elapsed']:.1f} s, {status['steps'] * PROGRESS_STEP / 1e6:.1f}M steps"
+
+
 # linn was here 042325
 cytoscape_stylesheet = [
     {
@@ -174,6 +258,30 @@ cytoscape_stylesheet = [
             'background-color': '#2ecc40',  # green for root data nodes
         }
     },
+    # Heatmap of operator time in profiled trees, pale yellow to orange
+    {
+        'selector': 'node[heat]',
+        'style': {
+            'background-color': 'mapData(heat, 0, 1, #FFF3B0, #FF6F00)',
+        }
+    },
+    # Border colors for the most expensive step of a node's query plan
+    {
+        'selector': "node[plan_badge='index']",
+        'style': {'border-width': 4, 'border-color': '#2ecc40'}
+    },
+    {
+        'selector': "node[plan_badge='temp-btree']",
+        'style': {'border-width': 4, 'border-color': '#B10DC9'}
+    },
+    {
+        'selector': "node[plan_badge='scan']",
+        'style': {'border-width': 4, 'border-color': '#FF851B'}
+    },
+    {
+        'selector': "node[plan_badge='automatic-index']",
+        'style': {'border-width': 4, 'border-color': '#FF4136'}
+    },
     {
         'selector': 'edge',
         'style': {
@@ -242,17 +350,60 @@ layout = html.Div([
                     dcc.Textarea(id="query-input",
                                  placeholder="Enter relational algebra query"),
                     html.Button("Submit", id="submit-btn"),
+                    dcc.Checklist(
+                        id="optimizer-options",
+                        className="optimizer-options",
+                        options=[
+                            {'label': 'Optimize', 'value': 'optimize'},
+                            {'label': 'Compare with original',
+                             'value': 'compare'},
+                            {'label': 'Query plan', 'value': 'plan'},
+                            {'label': 'Profile', 'value': 'profile'},
+                        ],
+                        value=[],
+                        inline=True,
+                    ),
+                    # Engine that computes node results
+                    dcc.RadioItems(
+                        id="backend-options",
+                        className="optimizer-options",
+                        options=[{'label': BACKEND_LABELS[b], 'value': b}
+                                 for b in BACKENDS],
+                        value='sqlite',
+                        inline=True,
+                    ),
                 ]),
 
             dcc.Store(id='tree-store'),
             dcc.Store(id='db-path-store'),
             dcc.Store(id="current-page", data=0),
+            # Sort order and filters of the node table, for one node
+            dcc.Store(id="table-view", data=None),
             dcc.Store(id="prev-clicks", data=0),
             dcc.Store(id="next-clicks", data=0),
             dcc.Store(id="row-count", data=0),
+            # Background query jobs in progress, polled by job-poll
+            dcc.Store(id="node-job", data=None),
+            dcc.Store(id="profile-job", data=None),
+            dcc.Interval(id="job-poll", interval=500, disabled=True),
 
 
             html.Div(className="tree-table-container", children=[
+                # Tree as written; shown next to the optimized tree in compare mode
+                cyto.Cytoscape(
+                    id='cytoscape-tree-original',
+                    layout={
+                        'name': 'dagre',
+                        'rankSep': 120,
+                        'nodeSep': 200,
+                        'edgeSep': 50,
+                        'rankDir': 'TB',
+                        'padding': 50
+                    },
+                    elements=[],
+                    stylesheet=cytoscape_stylesheet,
+                    style={'display': 'none'}
+                ),
                 cyto.Cytoscape(
                     id='cytoscape-tree',
                     layout={
@@ -271,8 +422,15 @@ layout = html.Div([
                 html.Div(
                     className="table-and-pagination",
                     children=[
+                        html.Div(id="job-status", className="job-status",
+                                 style={'display': 'none'}, children=[
+                                     html.Span(id="job-progress"),
+                                     html.Button("Cancel", id="cancel-btn", n_clicks=0),
+                                 ]),
                         html.Div(id="node-table-placeholder",
                                  children="Click node to see info"),
+                        html.Div(id="node-plan-placeholder",
+                                 className="plan-panel"),
                         html.Div(
                             [
                                 html.Button(
@@ -487,47 +645,94 @@ def display_schema_info(selected_db):
      Output('node-table-placeholder', 'children', allow_duplicate=True),
      Output('row-count', 'data', allow_duplicate=True),
      Output('current-page', 'data', allow_duplicate=True),
-     Output('reset-tap-data', 'data', allow_duplicate=True)],
+     Output('reset-tap-data', 'data', allow_duplicate=True),
+     Output('cytoscape-tree-original', 'elements', allow_duplicate=True),
+     Output('cytoscape-tree-original', 'style'),
+     Output('node-job', 'data', allow_duplicate=True),
+     Output('profile-job', 'data', allow_duplicate=True)],
     [Input('submit-btn', 'n_clicks'),
      Input('db-dropdown', 'value')],
     [State('query-input', 'value'),
-     State('reset-tap-data', 'data')],
+     State('reset-tap-data', 'data'),
+     State('optimizer-options', 'value'),
+     State('node-job', 'data'),
+     State('profile-job', 'data')],
     prevent_initial_call=True
 )
-def update_tree(n_clicks, selected_db, query, reset_counter):
+def update_tree(n_clicks, selected_db, query, reset_counter, optimizer_options, node_job, profile_job):
     ctx = dash.callback_context
+    # Results of queries for the previous tree are no longer wanted
+    cancel_jobs(node_job, profile_job)
+
     if ctx.triggered and ctx.triggered[0]['prop_id'].startswith('db-dropdown'):
-        return [], None, {}, "", "", {'display': 'none'}, "Click node to see info.", 0, 0, reset_counter + 1
+        return [], None, None, "", "", {'display': 'none'}, "Click node to see info.", 0, 0, reset_counter + 1, [], {'display': 'none'}, None, None
 
     if n_clicks is None:
-        return [], None, {}, "", "", {'display': 'none'}, "Click node to see info.", 0, 0, reset_counter + 1
+        return [], None, None, "", "", {'display': 'none'}, "Click node to see info.", 0, 0, reset_counter + 1, [], {'display': 'none'}, None, None
 
     if not selected_db:
-        return [], None, {}, "", "Please select a database.", {'display': 'block'}, "Click node to see info.", 0, 0, reset_counter + 1
+        return [], None, None, "", "Please select a database.", {'display': 'block'}, "Click node to see info.", 0, 0, reset_counter + 1, [], {'display': 'none'}, None, None
 
     if not query:
-        return [], None, {}, "", "Please enter a query.", {'display': 'block'}, "Click node to see info.", 0, 0, reset_counter + 1
+        return [], None, None, "", "Please enter a query.", {'display': 'block'}, "Click node to see info.", 0, 0, reset_counter + 1, [], {'display': 'none'}, None, None
 
     if n_clicks and selected_db and query:
         try:
             db_path = os.path.join(DB_FOLDER, selected_db)
-            db = SQLite3()
-            db.open(db_path)
-
-            json_tree = generate_tree_from_query(query, db, node_counter=[0])
+            optimizer_options = optimizer_options or []
+            original_elements = []
+            original_style = {'display': 'none'}
+            db = open_db(db_path)
+            try:
+                if 'compare' in optimizer_options:
+                    trees = generate_optimizer_comparison(query, db)
+                    json_tree = trees.get('optimized', trees)
+                    if 'original' in trees:
+                        if 'plan' in optimizer_options:
+                            annotate_query_plans(trees['original'], db)
+                        original_elements = json_to_cytoscape_elements(
+                            trees['original'])
+                        original_style = {'display': 'block'}
+                else:
+                    json_tree = generate_tree_from_query(
+                        query, db, node_counter=[0],
+                        optimize='optimize' in optimizer_options)
+                if 'plan' in optimizer_options and 'error' not in json_tree:
+                    annotate_query_plans(json_tree, db)
+            finally:
+                db.close()
 
             if 'error' in json_tree:
-                return [], None, {}, "", f"Error in query: {json_tree['error']}.", {'display': 'block'}, "Click node to see info.", 0, 0, reset_counter + 1
+                return [], None, None, "", f"Error in query: {json_tree['error']}.", {'display': 'block'}, "Click node to see info.", 0, 0, reset_counter + 1, [], {'display': 'none'}, None, None
 
             elements = json_to_cytoscape_elements(json_tree)
 
-            db.close()
-            return elements, None, json_tree, db_path, "", {'display': 'none'}, "Click node to see info.", 0, 0, reset_counter + 1
+            # Products sampled by the resource limits are reported up front
+            notes = json_tree.get('limit_notes', [])
+            if original_elements:
+                notes = notes + [note for note in trees['original'].get('limit_notes', [])
+                                 if note not in notes]
+            error_text = " ".join(notes)
+            error_style = {'display': 'block'} if notes else {'display': 'none'}
+
+            # Profiling runs every node, so it happens in the background and
+            # the tree is redrawn with the profile once it is done
+            new_profile_job = None
+            if 'profile' in optimizer_options:
+                trees_to_profile = {'tree': copy.deepcopy(json_tree)}
+                if original_elements:
+                    trees_to_profile['original'] = copy.deepcopy(
+                        trees['original'])
+                new_profile_job = query_jobs.submit(
+                    db_path, profile_trees, trees_to_profile)
+
+            # The tree stays on the server; the browser only holds its id
+            return elements, None, json_tree['tree_id'], db_path, error_text, error_style, "Click node to see info.", 0, 0, reset_counter + 1, original_elements, original_style, None, new_profile_job
 
         except Exception as e:
             # Add this line to print the full stack trace to the server log
             print(traceback.format_exc())
-            return [], None, {}, "", str(e), {'display': 'block'}, "Click node to see info.", 0, 0, reset_counter + 1
+            return [], None, None, "", str(e), {'display': 'block'}, "Click node to see info.", 0, 0, reset_counter + 1, [], {'display': 'none'}, None, None
 
 
 @callback(
@@ -541,70 +746,197 @@ def reset_tap_node_data(reset_counter):
 
 @callback(
     [Output('node-table-placeholder', 'children', allow_duplicate=True),
-     Output('row-count', 'data')],
+     Output('row-count', 'data'),
+     Output('node-plan-placeholder', 'children'),
+     Output('node-job', 'data', allow_duplicate=True),
+     Output('error-div', 'children', allow_duplicate=True),
+     Output('error-div', 'style', allow_duplicate=True)],
     [Input('cytoscape-tree', 'tapNodeData'),
      Input('db-dropdown', 'value'),
      Input('current-page', 'data'),
-     Input('reset-tap-data', 'data')],
-    [State('tree-store', 'data'), State('db-path-store', 'data')],
+     Input('reset-tap-data', 'data'),
+     Input('table-view', 'data')],
+    [State('tree-store', 'data'), State('db-path-store', 'data'),
+     State('node-job', 'data'), State('backend-options', 'value')],
     prevent_initial_call=True
 )
-def display_node_info(node_data, selected_db, current_page, reset_counter, json_tree, db_path):
+def display_node_info(node_data, selected_db, current_page, reset_counter, view, tree_id, db_path,
+                      node_job, backend):
     ctx = dash.callback_context
+    cancel_jobs(node_job)
 
     if ctx.triggered and ctx.triggered[0]['prop_id'].startswith('db-dropdown'):
-        return "Click node to see info.", 0
+        return "Click node to see info.", 0, None, None, dash.no_update, dash.no_update
 
     trigger = ctx.triggered[0]['prop_id'].split(
         '.')[0] if ctx.triggered else None
 
     if trigger == 'reset-tap-data':
-        return "Click node to see info.", 0
+        return "Click node to see info.", 0, None, None, dash.no_update, dash.no_update
 
     if node_data:
         try:
             node_id = node_data['id']
-            db = SQLite3()
-            db.open(db_path)
-
-            node_info = get_node_info_from_db(node_id, json_tree, db)
-            db.close()
-
-            if 'error' in node_info:
-                return html.Div([html.P(f"Error: {node_info['error']}")]), 0
-
-            rows_per_page = 8
-            total_rows = len(node_info['rows'])
-            max_page = (total_rows - 1) // rows_per_page
-
-            current_page = min(current_page, max_page)
-            start_index = current_page * rows_per_page
-            end_index = start_index + rows_per_page
-            visible_rows = node_info['rows'][start_index:end_index]
-
-            columns = node_info['columns']
-            table_header = [html.Th(col) for col in columns]
-            table_body = [html.Tr([html.Td(cell) for cell in row])
-                          for row in visible_rows]
-
-            result_table = html.Table(
-                className='classic-table',
-                children=[
-                    html.Thead(html.Tr(table_header)),
-                    html.Tbody(table_body)
-                ]
-            )
+            json_tree = tree_registry.get_tree(tree_id)
+            if json_tree is None:
+                return "This tree has expired. Submit the query again.", 0, None, None, dash.no_update, dash.no_update
+            # A sort order or filters set on this node
+            order, filters = None, None
+            if view and view['node'] == node_id and view['tree'] == tree_id:
+                order, filters = view['order'], view['filters']
+
+            # Plan of the node's generated SQL, when the tree was annotated
+            plan_panel = None
+            node_json = get_node_by_id(json_tree, node_id) if json_tree.get('plan') else None
+            if node_json and node_json.get('plan'):
+                plan_panel = html.Div([
+                    html.P("Query plan", className="plan-title"),
+                    html.Pre('\n'.join(node_json['plan']))
+                ])
 
-            return html.Div([
-                html.P(f"Number of tuples: {total_rows}",
-                       className="tuple-count"),
-                result_table
-            ]), total_rows
+            # The query runs in the background; quick ones are answered
+            # right away, slow ones are picked up by poll_jobs
+            job_id = query_jobs.submit(
+                db_path, lambda db: get_node_info_from_db(
+                    node_id, json_tree, db, page=current_page, rows_per_page=ROWS_PER_PAGE,
+                    backend=backend, order=order, filters=filters))
+            status = query_jobs.status(job_id, timeout=QUICK_RESULT_WAIT)
+            if status['state'] == 'running':
+                return "Running query...", dash.no_update, plan_panel, job_id, dash.no_update, dash.no_update
+            if status['state'] == 'error':
+                return "Query stopped.", 0, plan_panel, None, status['error'], {'display': 'block'}
+
+            table, total_rows = node_info_view(status['result'])
+            return table, total_rows, plan_panel, None, dash.no_update, dash.no_update
 
         except Exception as e:
-            return f"Error occurred: {str(e)}", 0
+            return f"Error occurred: {str(e)}", 0, None, None, dash.no_update, dash.no_update
+
+    return "Click node to see info.", 0, None, None, dash.no_update, dash.no_update
+
+
+@callback(
+    [Output('node-table-placeholder', 'children', allow_duplicate=True),
+     Output('row-count', 'data', allow_duplicate=True),
+     Output('node-job', 'data', allow_duplicate=True),
+     Output('cytoscape-tree', 'elements', allow_duplicate=True),
+     Output('cytoscape-tree-original', 'elements', allow_duplicate=True),
+     Output('profile-job', 'data', allow_duplicate=True),
+     Output('job-progress', 'children'),
+     Output('error-div', 'children', allow_duplicate=True),
+     Output('error-div', 'style', allow_duplicate=True)],
+    [Input('job-poll', 'n_intervals')],
+    [State('node-job', 'data'), State('profile-job', 'data')],
+    prevent_initial_call=True
+)
+def poll_jobs(n_intervals, node_job, profile_job):
+    table, row_count, tree_elements, original_elements = (
+        dash.no_update,) * 4
+    error_text, error_style = dash.no_update, dash.no_update
+    progress = []
+
+    if node_job:
+        status = query_jobs.status(node_job)
+        if status['state'] == 'running':
+            progress.append(f"Running query... {job_progress_text(status)}")
+        else:
+            node_job = None
+            row_count = 0
+            if status['state'] == 'done':
+                table, row_count = node_info_view(status['result'])
+            elif status['state'] == 'error':
+                table = "Query stopped."
+                error_text, error_style = status['error'], {'display': 'block'}
+            elif status['state'] == 'unknown':
+                table = "The query result has expired. Click the node again."
+            else:
+                table = "Query cancelled."
+
+    if profile_job:
+        status = query_jobs.status(profile_job)
+        if status['state'] == 'running':
+            progress.append(f"Profiling... {job_progress_text(status)}")
+        else:
+            profile_job = None
+            if status['state'] == 'done':
+                tree = status['result']['tree']
+                tree_registry.update_tree(tree)
+                tree_elements = json_to_cytoscape_elements(tree)
+                if 'original' in status['result']:
+                    original_elements = json_to_cytoscape_elements(
+                        status['result']['original'])
+            elif status['state'] == 'error':
+                error_text = f"Profiling stopped: {status['error']}"
+                error_style = {'display': 'block'}
+
+    return table, row_count, node_job, tree_elements, original_elements, profile_job, " ".join(progress), error_text, error_style
+
 
-    return "Click node to see info.", 0
+@callback(
+    [Output('node-table-placeholder', 'children', allow_duplicate=True),
+     Output('node-job', 'data', allow_duplicate=True),
+     Output('profile-job', 'data', allow_duplicate=True)],
+    [Input('cancel-btn', 'n_clicks')],
+    [State('node-job', 'data'), State('profile-job', 'data')],
+    prevent_initial_call=True
+)
+def cancel_running_jobs(n_clicks, node_job, profile_job):
+    cancel_jobs(node_job, profile_job)
+    table = "Query cancelled." if node_job else dash.no_update
+    return table, None, None
+
+
+# Poll for results and show the Cancel button only while a job is running
+clientside_callback(
+    """
+    function(nodeJob, profileJob) {
+        const running = Boolean(nodeJob || profileJob);
+        return [!running, running ? {'display': 'flex'} : {'display': 'none'}];
+    }
+    """,
+    [Output("job-poll", "disabled"), Output("job-status", "style")],
+    [Input("node-job", "data"), Input("profile-job", "data")]
+)
+
+
+# Clicking a column header sorts the node table on it, ascending, then
+# descending, then unsorted; filters apply once they are entered. Either goes
+# back to the first page.
+@callback(
+    [Output('table-view', 'data'),
+     Output('current-page', 'data', allow_duplicate=True)],
+    [Input({'type': 'sort-column', 'index': ALL}, 'n_clicks'),
+     Input({'type': 'filter-column', 'index': ALL}, 'value')],
+    [State('table-view', 'data'),
+     State('cytoscape-tree', 'tapNodeData'),
+     State('tree-store', 'data')],
+    prevent_initial_call=True
+)
+def update_table_view(sort_clicks, filter_values, view, node_data, tree_id):
+    ctx = dash.callback_context
+    trigger = ctx.triggered_id
+    if not trigger or not node_data:
+        return dash.no_update, dash.no_update
+
+    if not view or view['node'] != node_data['id'] or view['tree'] != tree_id:
+        view = {'node': node_data['id'], 'tree': tree_id, 'order': None, 'filters': []}
+    new_view = dict(view)
+    if trigger['type'] == 'sort-column':
+        # A table that has just been drawn has no clicks yet
+        if not ctx.triggered[0]['value']:
+            return dash.no_update, dash.no_update
+        index = trigger['index']
+        order = view['order']
+        if order and order[0] == index:
+            new_view['order'] = [index, 'desc'] if order[1] == 'asc' else None
+        else:
+            new_view['order'] = [index, 'asc']
+    new_view['filters'] = [[item['id']['index'], item['value']]
+                           for item in ctx.inputs_list[1]
+                           if item.get('value') and item['value'].strip()]
+    if new_view == view:
+        return dash.no_update, dash.no_update
+    return new_view, 0
 
 
 @callback(
@@ -630,8 +962,7 @@ def update_page(prev_clicks, next_clicks, node_data, submit_clicks,
     if trigger in ['cytoscape-tree', 'submit-btn']:
         return 0, 0, 0
 
-    rows_per_page = 8
-    max_page = max(0, (row_count - 1) // rows_per_page) if row_count else 0
+    max_page = max(0, (row_count - 1) // ROWS_PER_PAGE) if row_count else 0
 
     if trigger == 'prev-page-btn' and prev_clicks > last_prev_clicks:
         new_page = max(0, current_page - 1)
@@ -661,5 +992,8 @@ clientside_callback(
 
 if __name__ == '__main__':
     app.layout = layout
+    if DB_MODE not in DB_MODES:
+        sys.exit(f"RAV_DB_MODE must be one of {', '.join(DB_MODES)}")
+    print_memory_report(load_databases(DB_FOLDER))
     # app.run_server(debug=True)
     app.run(host='0.0.0.0', port=5020)
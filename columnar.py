@@ -0,0 +1,1079 @@
+import re
+import math
+import threading
+from collections import OrderedDict, Counter
+import numpy as np
+
+# Columnar execution engine: evaluates a checked RA tree in process with
+# NumPy instead of generating SQL for SQLite. Base relations are loaded once
+# into column arrays, with strings dictionary-encoded, and operators work on
+# whole columns: selections compare a column against a literal (strings are
+# compared once per dictionary entry), joins and set operations match rows
+# on factorized key codes, and aggregates reduce over group codes.
+#
+# Results follow the SQL that generateSQL writes for the same tree, quirks
+# included: column names, duplicate rows, case-insensitive string
+# comparisons, SQLite's type ordering (NULL < numbers < text < blobs) and
+# type affinity, and its NULL semantics for joins, IN and NOT IN. Rows may
+# come back in a different order, as SQLite itself does not promise one.
+
+AGGREGATE_TYPES = ['aggregate1', 'aggregate2', 'aggregate3']
+ASCII_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+NUMERIC_AFFINITIES = ('INTEGER', 'REAL', 'NUMERIC')
+NUMBER_TEXT = re.compile(r'^\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*$')
+AGGREGATE_EXPR = re.compile(r'^(COUNT|SUM|AVG|MIN|MAX)\((.*)\)$', re.IGNORECASE)
+
+# Rows of a product whose conditions are checked at once, which bounds the
+# memory a theta join needs
+PRODUCT_CHUNK = 1 << 20
+# Base relations kept loaded, across all databases
+TABLE_CACHE_SIZE = 64
+
+COMPARISONS = {
+    '=': lambda c: c == 0, '<>': lambda c: c != 0,
+    '<': lambda c: c < 0, '>': lambda c: c > 0,
+    '<=': lambda c: c <= 0, '>=': lambda c: c >= 0,
+}
+ARRAY_COMPARISONS = {
+    '=': np.equal, '<>': np.not_equal, '<': np.less, '>': np.greater,
+    '<=': np.less_equal, '>=': np.greater_equal,
+}
+FLIPPED_COMPARISON = {'=': '=', '<>': '<>', '<': '>', '>': '<', '<=': '>=', '>=': '<='}
+
+
+class EngineError(Exception):
+    pass
+
+
+# ---------------------- Values ----------------------
+
+# Affinity of a declared column type, by SQLite's rules. None is no affinity.
+def declared_affinity(decl):
+    decl = (decl or '').upper()
+    if 'INT' in decl:
+        return 'INTEGER'
+    if 'CHAR' in decl or 'CLOB' in decl or 'TEXT' in decl:
+        return 'TEXT'
+    if 'BLOB' in decl or decl == '':
+        return None
+    if 'REAL' in decl or 'FLOA' in decl or 'DOUB' in decl:
+        return 'REAL'
+    return 'NUMERIC'
+
+
+def type_rank(value):
+    if isinstance(value, (int, float)):
+        return 1
+    if isinstance(value, str):
+        return 2
+    return 3
+
+
+# Compare two non-NULL values the way SQLite does, returning <0, 0 or >0
+def compare_values(a, b, nocase=False):
+    ra, rb = type_rank(a), type_rank(b)
+    if ra != rb:
+        return ra - rb
+    if nocase and ra == 2:
+        a, b = a.translate(ASCII_LOWER), b.translate(ASCII_LOWER)
+    return (a > b) - (a < b)
+
+
+def to_numeric(value):
+    if isinstance(value, str) and NUMBER_TEXT.match(value):
+        number = float(value)
+        return int(number) if number.is_integer() and abs(number) < 2 ** 63 else number
+    return value
+
+
+def to_text(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return value
+    if isinstance(value, float):
+        return repr(value) if not value.is_integer() or abs(value) >= 1e15 else f"{value:.1f}"
+    return str(value)
+
+
+def apply_affinity(value, affinity):
+    if value is None:
+        return None
+    if affinity in NUMERIC_AFFINITIES:
+        return to_numeric(value)
+    if affinity == 'TEXT':
+        return to_text(value)
+    return value
+
+
+# Affinity to apply to each side of a comparison between operands with
+# affinities a and b (a literal has none), by SQLite's rules
+def comparison_affinities(a, b):
+    if a in NUMERIC_AFFINITIES and b not in NUMERIC_AFFINITIES:
+        return None, 'NUMERIC'
+    if b in NUMERIC_AFFINITIES and a not in NUMERIC_AFFINITIES:
+        return 'NUMERIC', None
+    if a == 'TEXT' and b is None:
+        return None, 'TEXT'
+    if b == 'TEXT' and a is None:
+        return 'TEXT', None
+    return None, None
+
+
+# ---------------------- Columns ----------------------
+# A column holds its values in one of four layouts:
+#   'int', 'real': an int64/float64 array, with a mask of NULLs (or None)
+#   'str':         int64 codes into a sorted dictionary of strings, -1 NULL
+#   'obj':         an object array, for columns mixing types
+# along with the SQLite affinity of the expression it came from.
+
+class Column():
+
+    def __init__(self, kind, data, nulls=None, dictionary=None, affinity=None):
+        self.kind = kind
+        self.data = data
+        self.nulls = nulls
+        self.dictionary = dictionary
+        self.affinity = affinity
+
+    def __len__(self):
+        return len(self.data)
+
+    def null_mask(self):
+        if self.kind == 'str':
+            return self.data < 0
+        if self.kind == 'obj':
+            return np.array([v is None for v in self.data], dtype=bool)
+        if self.nulls is None:
+            return np.zeros(len(self.data), dtype=bool)
+        return self.nulls
+
+    def take(self, index):
+        nulls = self.nulls[index] if self.nulls is not None else None
+        return Column(self.kind, self.data[index], nulls, self.dictionary, self.affinity)
+
+    def with_affinity(self, affinity):
+        return Column(self.kind, self.data, self.nulls, self.dictionary, affinity)
+
+    def values(self):
+        if self.kind == 'str':
+            lookup = np.append(self.dictionary, None) if len(self.dictionary) else \
+                np.array([None], dtype=object)
+            return lookup[self.data].tolist()
+        if self.kind == 'obj':
+            return list(self.data)
+        values = self.data.tolist()
+        if self.nulls is not None and self.nulls.any():
+            for i in np.flatnonzero(self.nulls).tolist():
+                values[i] = None
+        return values
+
+
+def column_from_values(values, affinity=None):
+    kinds = set(type(v) for v in values if v is not None)
+    if kinds <= {int} and kinds:
+        nulls = np.array([v is None for v in values], dtype=bool)
+        data = np.array([0 if v is None else v for v in values], dtype=np.int64)
+        return Column('int', data, nulls if nulls.any() else None, affinity=affinity)
+    if kinds == {float}:
+        nulls = np.array([v is None for v in values], dtype=bool)
+        data = np.array([0.0 if v is None else v for v in values], dtype=np.float64)
+        return Column('real', data, nulls if nulls.any() else None, affinity=affinity)
+    if kinds == {str}:
+        present = [v for v in values if v is not None]
+        dictionary, codes = np.unique(np.array(present, dtype=object), return_inverse=True)
+        data = np.full(len(values), -1, dtype=np.int64)
+        data[[i for i, v in enumerate(values) if v is not None]] = codes.reshape(-1)
+        return Column('str', data, dictionary=dictionary, affinity=affinity)
+    data = np.empty(len(values), dtype=object)
+    data[:] = values
+    return Column('obj', data, affinity=affinity)
+
+
+def null_column(n, affinity=None):
+    data = np.empty(n, dtype=object)
+    return Column('obj', data, affinity=affinity)
+
+
+def concat_columns(columns):
+    kinds = set(col.kind for col in columns)
+    if kinds == {'int'} or kinds == {'real'}:
+        data = np.concatenate([col.data for col in columns])
+        nulls = np.concatenate([col.null_mask() for col in columns])
+        return Column(kinds.pop(), data, nulls if nulls.any() else None,
+                      affinity=columns[0].affinity)
+    if kinds == {'str'}:
+        dictionary, offsets = np.unique(
+            np.concatenate([col.dictionary for col in columns]), return_inverse=True)
+        offsets = offsets.reshape(-1)
+        parts = []
+        start = 0
+        for col in columns:
+            remap = np.append(offsets[start:start + len(col.dictionary)], -1)
+            parts.append(remap[col.data])
+            start += len(col.dictionary)
+        return Column('str', np.concatenate(parts).astype(np.int64),
+                      dictionary=dictionary, affinity=columns[0].affinity)
+    values = []
+    for col in columns:
+        values.extend(col.values())
+    return column_from_values(values, columns[0].affinity)
+
+
+# Codes for the values of several columns, in one array over all of them,
+# such that two values get the same code exactly when SQLite considers them
+# equal. NULL is -1. Codes follow SQLite's sort order except in the 'obj'
+# layout.
+def factorize(columns):
+    kinds = set(col.kind for col in columns)
+    nulls = np.concatenate([col.null_mask() for col in columns])
+    if kinds == {'str'}:
+        merged = concat_columns(columns)
+        return merged.data
+    if kinds <= {'int', 'real'}:
+        if kinds == {'int'}:
+            data = np.concatenate([col.data for col in columns])
+        else:
+            data = np.concatenate([col.data.astype(np.float64) for col in columns])
+            exact = all(col.kind == 'real' or not len(col.data) or
+                        np.abs(col.data).max() < 2 ** 53 for col in columns)
+            if not exact:
+                return factorize_objects(columns)
+        if not len(data):
+            return np.zeros(0, dtype=np.int64)
+        _, codes = np.unique(data, return_inverse=True)
+        codes = codes.reshape(-1).astype(np.int64)
+        codes[nulls] = -1
+        return codes
+    return factorize_objects(columns)
+
+
+def factorize_objects(columns):
+    codes = {}
+    result = []
+    for col in columns:
+        for value in col.values():
+            if value is None:
+                result.append(-1)
+            else:
+                # 1 and 1.0 are equal and hash alike, as in SQLite
+                result.append(codes.setdefault(value, len(codes)))
+    return np.array(result, dtype=np.int64)
+
+
+# One key per row over several columns of one or more tables. sides is a
+# list of column lists, one per table, with matching columns in the same
+# positions. Returns a (keys, has_null) pair of arrays per side.
+def row_keys(sides):
+    sizes = [len(cols[0]) for cols in sides]
+    codes = [factorize([cols[j] for cols in sides]) for j in range(len(sides[0]))]
+    if len(codes) == 1:
+        keys = codes[0]
+    else:
+        stacked = np.stack(codes, axis=1)
+        if len(stacked):
+            _, keys = np.unique(stacked, axis=0, return_inverse=True)
+            keys = keys.reshape(-1)
+        else:
+            keys = np.zeros(0, dtype=np.int64)
+    has_null = np.zeros(sum(sizes), dtype=bool)
+    for c in codes:
+        has_null |= c < 0
+    result = []
+    start = 0
+    for size in sizes:
+        result.append((keys[start:start + size], has_null[start:start + size]))
+        start += size
+    return result
+
+
+# Group number of every row, numbered in sort order, and the group count
+def group_rows(columns, n):
+    if not columns:
+        return np.zeros(n, dtype=np.int64), 1
+    keys, _ = row_keys([columns])[0]
+    if not len(keys):
+        return keys, 0
+    _, groups = np.unique(keys, return_inverse=True)
+    groups = groups.reshape(-1)
+    return groups, int(groups.max()) + 1
+
+
+# ---------------------- Comparisons ----------------------
+
+# Rows where `col op literal` is true
+def compare_to_literal(col, op, literal, nocase):
+    compare = COMPARISONS[op]
+    _, affinity = comparison_affinities(col.affinity, None)
+    literal = apply_affinity(literal, affinity)
+    if literal is None:
+        return np.zeros(len(col), dtype=bool)
+    rank = type_rank(literal)
+    if col.kind in ('int', 'real'):
+        if rank == 1:
+            mask = ARRAY_COMPARISONS[op](col.data, literal)
+        else:
+            mask = np.full(len(col), compare(1 - rank))
+        return mask & ~col.null_mask()
+    if col.kind == 'str':
+        if rank == 2:
+            hits = np.array([compare(compare_values(v, literal, nocase))
+                             for v in col.dictionary.tolist()] + [False], dtype=bool)
+            return hits[col.data]
+        return np.full(len(col), compare(2 - rank)) & (col.data >= 0)
+    return np.array([v is not None and compare(compare_values(v, literal, nocase))
+                     for v in col.data], dtype=bool)
+
+
+# Rows where `left op right` is true, for two columns of one table
+def compare_columns(left, op, right, nocase):
+    compare = COMPARISONS[op]
+    la, ra = comparison_affinities(left.affinity, right.affinity)
+    if la is None and ra is None:
+        if left.kind in ('int', 'real') and right.kind in ('int', 'real'):
+            return ARRAY_COMPARISONS[op](left.data, right.data) & \
+                ~left.null_mask() & ~right.null_mask()
+        if left.kind == 'str' and right.kind == 'str':
+            # Rank both dictionaries in one sorted order and compare ranks
+            words = np.concatenate([left.dictionary, right.dictionary])
+            if nocase:
+                words = np.array([w.translate(ASCII_LOWER) for w in words.tolist()],
+                                 dtype=object)
+            if not len(words):
+                return np.zeros(len(left), dtype=bool)
+            _, ranks = np.unique(words, return_inverse=True)
+            ranks = ranks.reshape(-1)
+            lranks = ranks[:len(left.dictionary)]
+            rranks = ranks[len(left.dictionary):]
+            valid = (left.data >= 0) & (right.data >= 0)
+            lvals = np.where(valid, lranks[np.maximum(left.data, 0)] if len(lranks) else 0, 0)
+            rvals = np.where(valid, rranks[np.maximum(right.data, 0)] if len(rranks) else 0, 0)
+            return ARRAY_COMPARISONS[op](lvals, rvals) & valid
+    lvalues = [apply_affinity(v, la) for v in left.values()]
+    rvalues = [apply_affinity(v, ra) for v in right.values()]
+    return np.array([a is not None and b is not None and compare(compare_values(a, b, nocase))
+                     for a, b in zip(lvalues, rvalues)], dtype=bool)
+
+
+# Rows where `LOWER(left) op LOWER(right)` is true; operands are columns or
+# string literals, and every value is compared as lower case text
+def compare_lowered(lot, lop, op, rot, rop, column, n):
+    compare = COMPARISONS[op]
+
+    def lowered(otype, value):
+        if otype == 'str':
+            return [value.translate(ASCII_LOWER)] * n
+        return [None if v is None else to_text(v).translate(ASCII_LOWER)
+                for v in column(value).values()]
+
+    return np.array([a is not None and b is not None and compare(compare_values(a, b))
+                     for a, b in zip(lowered(lot, lop), lowered(rot, rop))], dtype=bool)
+
+
+# Rows of table where one select condition [lot, lop, op, rot, rop] holds.
+# column maps a name in the condition to a column of the table; mode is how
+# condition_to_sql compares it (see comparison_mode).
+def condition_mask(condition, column, n, mode):
+    lot, lop, op, rot, rop = condition
+    if mode == 'lower':
+        return compare_lowered(lot, lop, op, rot, rop, column, n)
+    nocase = mode == 'nocase'
+    if lot == 'col' and rot == 'col':
+        return compare_columns(column(lop), op, column(rop), nocase)
+    if lot == 'col':
+        return compare_to_literal(column(lop), op, rop, nocase)
+    if rot == 'col':
+        return compare_to_literal(column(rop), FLIPPED_COMPARISON[op], lop, nocase)
+    return np.full(n, COMPARISONS[op](compare_values(lop, rop, nocase)))
+
+
+# How condition_to_sql compares a condition: 'nocase' with COLLATE NOCASE
+# when every column has TEXT affinity, 'lower' as text with LOWER() when one
+# may not (a date column has NUMERIC affinity), or None for an ordinary
+# comparison with a number. affinity maps a column name to its affinity.
+def comparison_mode(condition, affinity):
+    lot, lop, op, rot, rop = condition
+    if lot not in ('col', 'str') or rot not in ('col', 'str'):
+        return None
+    cols = [c for t, c in ((lot, lop), (rot, rop)) if t == 'col']
+    if all(affinity(c) == 'TEXT' for c in cols):
+        return 'nocase'
+    return 'lower'
+
+
+# ---------------------- Tables ----------------------
+
+# A table's names are those its columns have when it is used as a subquery
+# (the alias, or the expression as written). As the outermost query, SQLite
+# names a bare column reference after the column it refers to instead, and
+# display holds those names.
+class Table():
+
+    def __init__(self, names, columns, nrows=None, display=None):
+        self.names = names
+        self.columns = columns
+        self.nrows = len(columns[0]) if columns else (nrows or 0)
+        self.display = display if display is not None else names
+
+    def as_subquery(self):
+        return Table(self.names, self.columns, self.nrows)
+
+    def __len__(self):
+        return self.nrows
+
+    # Columns are looked up by name case-insensitively, as in SQL
+    def column(self, name, label=None):
+        matches = [i for i, n in enumerate(self.names) if n.upper() == str(name).upper()]
+        if not matches:
+            raise EngineError(f"no such column: {label or name}")
+        return self.columns[matches[0]]
+
+    # Name SQLite gives a bare reference to a column: the column's own name
+    def name_of(self, name):
+        matches = [n for n in self.names if n.upper() == str(name).upper()]
+        return matches[0] if matches else name
+
+    def take(self, index):
+        return Table(self.names, [col.take(index) for col in self.columns], len(index),
+                     self.display)
+
+    def head(self, n):
+        if n >= self.nrows:
+            return self
+        return self.take(np.arange(n))
+
+    def rows(self, start=0, stop=None):
+        part = self if start == 0 and stop is None else \
+            self.take(np.arange(start, min(stop, self.nrows)))
+        return list(zip(*[col.values() for col in part.columns]))
+
+
+# Base relations, loaded once per version of a database file
+class TableCache():
+
+    def __init__(self, max_entries=TABLE_CACHE_SIZE):
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+    def get(self, db, rname):
+        key = (db.dbfile, db.version, rname.upper())
+        with self.lock:
+            table = self.entries.get(key)
+            if table is not None:
+                self.entries.move_to_end(key)
+                return table
+        table = load_relation(db.conn, rname)
+        with self.lock:
+            self.entries[key] = table
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return table
+
+
+table_cache = TableCache()
+
+
+def load_relation(conn, rname):
+    decls = {row[1].upper(): row[2] for row in conn.execute(f"PRAGMA table_info('{rname}')")}
+    c = conn.execute(f"SELECT * FROM {rname}")
+    names = [desc[0] for desc in c.description]
+    records = c.fetchall()
+    c.close()
+    values = list(zip(*records)) if records else [()] * len(names)
+    columns = [column_from_values(list(vals), declared_affinity(decls.get(name.upper())))
+               for name, vals in zip(names, values)]
+    return Table(names, columns, len(records))
+
+
+# ---------------------- Select lists ----------------------
+# Expressions of a SELECT list are ('col', name) or ('agg', FUNC, name).
+
+def parse_expr(text):
+    match = AGGREGATE_EXPR.match(text)
+    if match:
+        return ('agg', match.group(1).upper(), match.group(2))
+    return ('col', text)
+
+
+def aggregate_column(func, col, groups, ngroups):
+    valid = ~col.null_mask()
+    counts = np.bincount(groups[valid], minlength=ngroups)
+    if func == 'COUNT':
+        return Column('int', counts.astype(np.int64))
+    empty = counts == 0
+    if func in ('SUM', 'AVG') and col.kind in ('int', 'real'):
+        if func == 'SUM' and col.kind == 'int':
+            sums = np.zeros(ngroups, dtype=np.int64)
+            np.add.at(sums, groups[valid], col.data[valid])
+            return Column('int', sums, empty if empty.any() else None)
+        # Floating point sums are accumulated in row order, as SQLite does
+        sums = np.zeros(ngroups, dtype=np.float64)
+        np.add.at(sums, groups[valid], col.data[valid].astype(np.float64))
+        if func == 'AVG':
+            sums = sums / np.maximum(counts, 1)
+        return Column('real', sums, empty if empty.any() else None)
+    if func in ('MIN', 'MAX') and col.kind in ('int', 'real', 'str'):
+        data = col.data
+        if col.kind == 'int' or col.kind == 'str':
+            fill = np.iinfo(np.int64).max if func == 'MIN' else np.iinfo(np.int64).min
+        else:
+            fill = np.inf if func == 'MIN' else -np.inf
+        result = np.full(ngroups, fill, dtype=data.dtype)
+        reduce = np.minimum if func == 'MIN' else np.maximum
+        reduce.at(result, groups[valid], data[valid])
+        if col.kind == 'str':
+            result[empty] = -1
+            return Column('str', result.astype(np.int64), dictionary=col.dictionary)
+        result[empty] = 0
+        return Column(col.kind, result, empty if empty.any() else None)
+    return aggregate_objects(func, col, groups, ngroups)
+
+
+# Aggregates over columns mixing types, one value at a time
+def aggregate_objects(func, col, groups, ngroups):
+    results = [None] * ngroups
+    counts = [0] * ngroups
+    exact = [True] * ngroups
+    for g, value in zip(groups.tolist(), col.values()):
+        if value is None:
+            continue
+        counts[g] += 1
+        if func in ('SUM', 'AVG'):
+            number = to_numeric(value) if isinstance(value, str) else value
+            if not isinstance(number, (int, float)):
+                number = 0
+            if not isinstance(value, int):
+                exact[g] = False
+            results[g] = number if results[g] is None else results[g] + number
+        elif results[g] is None:
+            results[g] = value
+        else:
+            cmp = compare_values(value, results[g])
+            if (func == 'MIN' and cmp < 0) or (func == 'MAX' and cmp > 0):
+                results[g] = value
+    if func == 'SUM':
+        results = [r if r is None or exact[g] else float(r) for g, r in enumerate(results)]
+    elif func == 'AVG':
+        results = [None if r is None else float(r) / counts[g] for g, r in enumerate(results)]
+    return column_from_values(results)
+
+
+# Row of each group that bare columns take their values from: the row with
+# the extreme value when there is a single min() or max(), as in SQLite, and
+# otherwise the group's last row
+def bare_rows(table, exprs, groups, ngroups):
+    extremes = [e for e in exprs if e[0] == 'agg' and e[1] in ('MIN', 'MAX')]
+    index = np.arange(len(table))
+    if len(extremes) == 1 and len(table):
+        func, name = extremes[0][1], extremes[0][2]
+        col = table.column(name)
+        best = aggregate_column(func, col, groups, ngroups)
+        rows = np.full(ngroups, len(table), dtype=np.int64)
+        if col.kind in ('int', 'real', 'str'):
+            hit = (col.data == best.data[groups]) & ~col.null_mask()
+            np.minimum.at(rows, groups[hit], index[hit])
+            if (rows < len(table)).all():
+                return rows
+    rows = np.full(ngroups, -1, dtype=np.int64)
+    np.maximum.at(rows, groups, index)
+    return rows
+
+
+def pick_rows(col, rows, n):
+    if (rows >= 0).all() and (rows < n).all():
+        return col.take(rows)
+    values = col.values()
+    return column_from_values([values[r] if 0 <= r < n else None for r in rows.tolist()],
+                              col.affinity)
+
+
+# Evaluate a SELECT list over table, with GROUP BY group_by (a list of
+# names, or None) and HAVING conditions. Aggregates without a GROUP BY make
+# a single group, as in SQL.
+def evaluate_select_list(table, exprs, names, group_by=None, having=None):
+    aggregate = group_by is not None or any(e[0] == 'agg' for e in exprs)
+    if not aggregate:
+        return Table(names, [table.column(e[1]) for e in exprs], len(table))
+
+    n = len(table)
+    groups, ngroups = group_rows([table.column(g) for g in group_by or []], n)
+    if not group_by:
+        ngroups = 1
+    rows = bare_rows(table, exprs, groups, ngroups)
+
+    def operand(kind, value):
+        if kind == 'agg':
+            func, name = value
+            return aggregate_column(func.upper(), table.column(name), groups, ngroups)
+        if kind in ('col', 'id'):
+            # A name is looked up among the input columns first and then
+            # among the output aliases, as SQLite does, so HAVING can refer
+            # to an aggregate by its alias
+            try:
+                return pick_rows(table.column(value), rows, n)
+            except EngineError:
+                return result.column(value)
+        return value
+
+    columns = []
+    for e in exprs:
+        if e[0] == 'agg':
+            columns.append(aggregate_column(e[1], table.column(e[2]), groups, ngroups))
+        else:
+            columns.append(pick_rows(table.column(e[1]), rows, n))
+    result = Table(names, columns, ngroups)
+
+    if having:
+        keep = np.ones(ngroups, dtype=bool)
+        for lot, lop, op, rot, rop in having:
+            left, right = operand(lot, lop), operand(rot, rop)
+            if isinstance(left, Column) and isinstance(right, Column):
+                keep &= compare_columns(left, op, right, False)
+            elif isinstance(left, Column):
+                keep &= compare_to_literal(left, op, right, False)
+            elif isinstance(right, Column):
+                keep &= compare_to_literal(right, FLIPPED_COMPARISON[op], left, False)
+            else:
+                keep &= COMPARISONS[op](compare_values(left, right))
+        result = result.take(np.flatnonzero(keep))
+    return result
+
+
+# ---------------------- Operators ----------------------
+
+def product_indices(nleft, nright, start, stop):
+    index = np.arange(start, stop, dtype=np.int64)
+    return index // nright, index % nright
+
+
+# Pairs of matching rows of two tables on equal keys. Rows with a NULL in a
+# key never match.
+def hash_join(left_cols, right_cols):
+    (lkeys, lnull), (rkeys, rnull) = row_keys([left_cols, right_cols])
+    rindex = np.flatnonzero(~rnull)
+    order = rindex[np.argsort(rkeys[rindex], kind='stable')]
+    sorted_keys = rkeys[order]
+    lindex = np.flatnonzero(~lnull)
+    lo = np.searchsorted(sorted_keys, lkeys[lindex], side='left')
+    hi = np.searchsorted(sorted_keys, lkeys[lindex], side='right')
+    counts = hi - lo
+    left = np.repeat(lindex, counts)
+    # Position of every output row within the run of its left row's matches
+    offsets = np.arange(len(left)) - np.repeat(np.cumsum(counts) - counts, counts)
+    right = order[np.repeat(lo, counts) + offsets]
+    return left, right
+
+
+# Row-value IN: whether each row of left equals some row of right, with
+# SQL's three-valued result folded to True/False for IN (is_in) or NOT IN
+def membership(left_cols, right_cols, negate):
+    nleft = len(left_cols[0])
+    if not len(right_cols[0]):
+        return np.full(nleft, negate)
+    (lkeys, lnull), (rkeys, rnull) = row_keys([left_cols, right_cols])
+    found = np.isin(lkeys, rkeys[~rnull]) & ~lnull
+    if not negate:
+        return found
+    if not lnull.any() and not rnull.any():
+        return ~found
+    # With NULLs about, a row is only kept when it differs from every right
+    # row in some position where both are non-NULL
+    lrows = list(zip(*[col.values() for col in left_cols]))
+    rrows = [row for row in zip(*[col.values() for col in right_cols])]
+    keep = np.zeros(nleft, dtype=bool)
+    for i, row in enumerate(lrows):
+        if found[i]:
+            continue
+        keep[i] = all(any(a is not None and b is not None and compare_values(a, b) != 0
+                          for a, b in zip(row, other)) for other in rrows)
+    return keep
+
+
+def is_aggregate(node):
+    return node is not None and node.get_node_type() in AGGREGATE_TYPES
+
+
+def node_key(node):
+    if node is None:
+        return None
+    return (node.get_node_type(), node.get_relation_name(), repr(node.get_columns()),
+            repr(node.get_conditions()), repr(node.get_attributes()),
+            repr(node.get_join_columns()), repr(node.get_aggregate_project_list()),
+            repr(node.get_aggregate_groupby_list()),
+            repr(node.get_aggregate_having_condition()), node.get_sample_limit(),
+            repr(node.get_output_order()),
+            node_key(node.get_left_child()), node_key(node.get_right_child()))
+
+
+class Evaluator():
+
+    def __init__(self, db, check=None):
+        self.db = db
+        self.check = check
+        self.memo = {}
+
+    # Every distinct subtree is evaluated once per evaluation
+    def evaluate(self, node):
+        key = node_key(node)
+        table = self.memo.get(key)
+        if table is None:
+            if self.check is not None:
+                self.check()
+            table = self.evaluate_node(node)
+            if node.get_sample_limit() is not None:
+                table = table.head(int(node.get_sample_limit())).as_subquery()
+            self.memo[key] = table
+        return table
+
+    def evaluate_node(self, node):
+        ntype = node.get_node_type()
+        if ntype == 'relation':
+            return table_cache.get(self.db, node.get_relation_name())
+        if ntype == 'select':
+            return self.select(node)
+        if ntype == 'project':
+            return self.project(node)
+        if ntype == 'rename':
+            return self.rename(node)
+        if ntype == 'union':
+            return self.union(node)
+        if ntype == 'times':
+            return self.times(node)
+        if ntype == 'join':
+            return self.join(node)
+        if ntype in AGGREGATE_TYPES:
+            return self.aggregate(node)
+        return self.set_membership(node, ntype != 'intersect')
+
+    def select(self, node):
+        child = node.get_left_child()
+        table = self.evaluate(child)
+        keep = np.ones(len(table), dtype=bool)
+        for condition in node.get_conditions():
+            keep &= condition_mask(condition, table.column, len(table), comparison_mode(
+                condition, lambda name: table.column(name).affinity))
+        return table.as_subquery().take(np.flatnonzero(keep))
+
+    def project(self, node):
+        child = node.get_left_child()
+        table = self.evaluate(child)
+        columns = node.get_columns()
+        if child.get_node_type() == 'join' and (
+                is_aggregate(child.get_left_child()) or is_aggregate(child.get_right_child())):
+            # Columns of an aggregate under the join are found by name
+            lnode, rnode = child.get_left_child(), child.get_right_child()
+            lcolumns = lnode.get_columns() if is_aggregate(lnode) else lnode.get_attributes()
+            rcolumns = rnode.get_columns() if is_aggregate(rnode) else rnode.get_attributes()
+            display = [table.name_of(attr) if attr in lcolumns or attr in rcolumns
+                       or attr.upper() not in [n.upper() for n in table.names] else attr
+                       for attr in columns]
+            result = evaluate_select_list(table, [('col', attr) for attr in columns],
+                                          list(columns))
+            result.display = display
+            return result
+        exprs = [parse_expr(attr) for attr in columns]
+        group_by = None
+        if not is_aggregate(child):
+            group_by = [attr for attr in columns if '(' not in attr] or None
+        result = evaluate_select_list(table, exprs, list(columns), group_by)
+        result.display = [attr if e[0] == 'agg' else table.name_of(attr)
+                          for attr, e in zip(columns, exprs)]
+        return result
+
+    def rename(self, node):
+        child = node.get_left_child()
+        table = self.evaluate(child)
+        exprs = [parse_expr(attr) for attr in child.get_attributes()]
+        return evaluate_select_list(table, exprs, list(node.get_attributes()))
+
+    def union(self, node):
+        left = self.evaluate(node.get_left_child())
+        right = self.evaluate(node.get_right_child())
+        if len(left.columns) != len(right.columns):
+            raise EngineError("SELECTs to the left and right of UNION do not have "
+                              "the same number of result columns")
+        merged = Table(left.names, [concat_columns([lc, rc]).with_affinity(lc.affinity)
+                                    for lc, rc in zip(left.columns, right.columns)],
+                       len(left) + len(right), left.display)
+        # UNION keeps one row of each distinct row, in sorted order
+        keys, _ = row_keys([merged.columns])[0]
+        _, first = np.unique(keys, return_index=True)
+        return merged.take(first)
+
+    # Output columns of a product, as (name, side, column) in output order
+    def product_columns(self, node, left, right):
+        lnode, rnode = node.get_left_child(), node.get_right_child()
+        lattrs, rattrs = lnode.get_attributes(), rnode.get_attributes()
+        duplicates = set(lattrs) & set(rattrs)
+        lalias, ralias = lnode.get_relation_name() + "_L", rnode.get_relation_name() + "_R"
+        out = []
+        for attr in lattrs:
+            name = attr + "_L" if attr in duplicates else attr
+            out.append((name, 0, left.column(attr, f'{lalias}.{attr}')))
+        for attr in rattrs:
+            name = attr + "_R" if attr in duplicates else attr
+            out.append((name, 1, right.column(attr, f'{ralias}.{attr}')))
+        if node.get_output_order() is not None:
+            by_name = {entry[0]: entry for entry in out}
+            out = [by_name[attr] for attr in node.get_attributes()]
+        return out
+
+    # Columns that theta join conditions refer to. As in generateSQL, the
+    # output names of the node are paired with the inputs' columns by position.
+    def condition_columns(self, node, left, right):
+        lnode, rnode = node.get_left_child(), node.get_right_child()
+        lattrs, rattrs = lnode.get_attributes(), rnode.get_attributes()
+        names = node.get_attributes()
+        by_name = {}
+        for i, attr in enumerate(lattrs):
+            by_name[names[i]] = (0, left.column(attr))
+        for i, attr in enumerate(rattrs):
+            by_name[names[len(lattrs) + i]] = (1, right.column(attr))
+        return by_name
+
+    def times(self, node):
+        left = self.evaluate(node.get_left_child())
+        right = self.evaluate(node.get_right_child())
+        out = self.product_columns(node, left, right)
+        nleft, nright = len(left), len(right)
+        total = nleft * nright
+        limit = node.get_sample_limit()
+        conditions = node.get_conditions()
+        if not conditions:
+            stop = total if limit is None else min(total, int(limit))
+            li, ri = product_indices(nleft, nright, 0, stop)
+        else:
+            # Conditions are checked a chunk of the product at a time
+            by_name = self.condition_columns(node, left, right)
+
+            def affinity(name):
+                return by_name[name][1].affinity if name in by_name else None
+
+            lparts, rparts = [], []
+            found = 0
+            for start in range(0, total, PRODUCT_CHUNK):
+                if self.check is not None:
+                    self.check()
+                li, ri = product_indices(nleft, nright, start, min(total, start + PRODUCT_CHUNK))
+
+                def column(name):
+                    if name not in by_name:
+                        raise EngineError(f"no such column: {name}")
+                    side, col = by_name[name]
+                    return col.take(li if side == 0 else ri)
+
+                keep = np.ones(len(li), dtype=bool)
+                for condition in conditions:
+                    keep &= condition_mask(condition, column, len(li),
+                                           comparison_mode(condition, affinity))
+                lparts.append(li[keep])
+                rparts.append(ri[keep])
+                found += int(keep.sum())
+                if limit is not None and found >= int(limit):
+                    break
+            li = np.concatenate(lparts) if lparts else np.zeros(0, dtype=np.int64)
+            ri = np.concatenate(rparts) if rparts else np.zeros(0, dtype=np.int64)
+        return Table([name for name, side, col in out],
+                     [col.take(li if side == 0 else ri) for name, side, col in out], len(li))
+
+    def join(self, node):
+        lnode, rnode = node.get_left_child(), node.get_right_child()
+        left = self.evaluate(lnode)
+        right = self.evaluate(rnode)
+        lalias, ralias = lnode.get_relation_name(), rnode.get_relation_name()
+        lcolumns = lnode.get_columns() if is_aggregate(lnode) else lnode.get_attributes()
+        rcolumns = rnode.get_columns() if is_aggregate(rnode) else rnode.get_attributes()
+        join_cols = [col for col in node.get_join_columns()
+                     if col in lcolumns and col in rcolumns]
+
+        if join_cols and not (is_aggregate(lnode) and is_aggregate(rnode)):
+            lkeys = [left.column(col, f'{lalias}.{col}') for col in join_cols]
+            rkeys = [right.column(col, f'{ralias}.{col}') for col in join_cols]
+            lkeys, rkeys = zip(*[comparable_pair(lc, rc) for lc, rc in zip(lkeys, rkeys)])
+            li, ri = hash_join(list(lkeys), list(rkeys))
+        else:
+            li, ri = product_indices(len(left), len(right), 0, len(left) * len(right))
+
+        names, columns = [], []
+        for attr in node.get_attributes():
+            names.append(attr)
+            if attr in lcolumns:
+                columns.append(left.column(attr, f'{lalias}.{attr}').take(li))
+            elif attr in rcolumns:
+                columns.append(right.column(attr, f'{ralias}.{attr}').take(ri))
+            else:
+                raise EngineError(f"no such column: {attr}")
+        return Table(names, columns, len(li))
+
+    def set_membership(self, node, negate):
+        left = self.evaluate(node.get_left_child())
+        right = self.evaluate(node.get_right_child())
+        attrs = node.get_attributes()
+        if len(right.columns) != len(attrs):
+            raise EngineError(f"sub-select returns {len(right.columns)} columns - "
+                              f"expected {len(attrs)}")
+        lcols = [left.column(attr) for attr in attrs]
+        keep = membership(lcols, right.columns, negate)
+        return left.as_subquery().take(np.flatnonzero(keep))
+
+    def aggregate(self, node):
+        table = self.evaluate(node.get_left_child())
+        names = node.get_columns()
+        exprs = []
+        for i, item in enumerate(node.get_aggregate_project_list()):
+            if i < len(names):
+                exprs.append(('agg', item[1][0].upper(), item[1][1]) if item[0] == 'agg'
+                             else ('col', item[1]))
+        group_by = None
+        having = None
+        if node.get_node_type() != 'aggregate1':
+            group_by = node.get_aggregate_groupby_list() or None
+        if node.get_node_type() == 'aggregate3':
+            having = node.get_aggregate_having_condition()
+        return evaluate_select_list(table, exprs, list(names[:len(exprs)]), group_by, having)
+
+
+# Columns of a join condition, converted by affinity so equal keys mean
+# equal values in SQLite
+def comparable_pair(left, right):
+    la, ra = comparison_affinities(left.affinity, right.affinity)
+    if la is not None:
+        left = column_from_values([apply_affinity(v, la) for v in left.values()],
+                                  left.affinity)
+    if ra is not None:
+        right = column_from_values([apply_affinity(v, ra) for v in right.values()],
+                                   right.affinity)
+    return left, right
+
+
+# Evaluate a checked tree on db. check, if given, is called between
+# operators and may raise to stop the evaluation. Returns a Table.
+def evaluate(tree, db, check=None):
+    return Evaluator(db, check).evaluate(tree)
+
+
+# ---------------------- Differential check ----------------------
+# Evaluate every node of every example query, as written and optimized, with
+# both SQLite and this engine, and report any node where the two give
+# different column names or a different multiset of rows (values are compared
+# with their types, so 1, 1.0 and '1' all differ).
+
+def result_multiset(rows):
+    return Counter(tuple((type(v).__name__, v) for v in row) for row in rows)
+
+
+# Compare the results of node and all of its children. Returns (nodes
+# checked, list of mismatch descriptions).
+def check_node(node, db):
+    from RAP import generateSQL
+    checked = 0
+    mismatches = []
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if node is None:
+            continue
+        checked += 1
+        stack.extend([node.get_right_child(), node.get_left_child()])
+        where = f"{node.get_node_type()} {node.get_relation_name()}"
+        try:
+            c = db.conn.execute(generateSQL(node, db))
+            sql_rows = c.fetchall()
+            sql_columns = [desc[0] for desc in c.description]
+            sql_error = None
+        except Exception as e:
+            sql_error = str(e)
+        try:
+            table = evaluate(node, db)
+            rows = table.rows()
+            columns = list(table.display)
+            error = None
+        except Exception as e:
+            error = str(e)
+        if sql_error or error:
+            if not (sql_error and error):
+                mismatches.append(f"{where}: sqlite error {sql_error!r}, engine error {error!r}")
+        elif sql_columns != columns:
+            mismatches.append(f"{where}: columns {sql_columns} vs {columns}")
+        elif result_multiset(sql_rows) != result_multiset(rows):
+            missing = result_multiset(sql_rows) - result_multiset(rows)
+            extra = result_multiset(rows) - result_multiset(sql_rows)
+            mismatches.append(f"{where}: {len(sql_rows)} vs {len(rows)} rows, "
+                              f"missing {sum(missing.values())}, extra {sum(extra.values())}")
+    return checked, mismatches
+
+
+# Queries checked along with the example queries, for cases the examples do
+# not cover, as (database, query, reference SQL). When there is a reference,
+# the generated SQL must also give the same rows as it: the SQL the query was
+# translated to when every comparison used LOWER().
+CHECK_QUERIES = [
+    # HAVING on an aggregate's alias
+    ('company', "aggregate[(dno,a,m),(dno,avg(salary),max(lname)),(dno),(a>30000)](employee);",
+     None),
+    # Numeric columns compared as text
+    ('company', "select[hours<salary](employee times works_on);",
+     "SELECT * FROM EMPLOYEE, WORKS_ON WHERE LOWER(HOURS) < LOWER(SALARY)"),
+    # Date columns have NUMERIC affinity, and are compared as text too
+    ('company', "select[bdate<'1960'](employee);",
+     "SELECT * FROM EMPLOYEE WHERE LOWER(BDATE) < LOWER('1960')"),
+    ('company', "select[mgrstartdate>'1990'](department);",
+     "SELECT * FROM DEPARTMENT WHERE LOWER(MGRSTARTDATE) > LOWER('1990')"),
+]
+
+
+def main():
+    import os
+    import sys
+    import argparse
+    from RAP import open_db, compile_query, generateSQL
+    from query_benchmark import example_queries, QUERIES_FILE, DB_FOLDER
+
+    parser = argparse.ArgumentParser(
+        description="Check that the columnar engine gives the same result as "
+        "SQLite for every node of the example queries")
+    parser.add_argument("--queries", default=QUERIES_FILE, metavar="FILE",
+                        help="queries in the format of assets/queries.md")
+    parser.add_argument("--databases", default=DB_FOLDER, metavar="DIR",
+                        help="folder with the databases, e.g. copies made by scale_db.py")
+    args = parser.parse_args()
+
+    queries = example_queries(args.queries) + [
+        (dbname, f"extra {i + 1}", query) for i, (dbname, query, _) in enumerate(CHECK_QUERIES)]
+    references = {(dbname, f"extra {i + 1}"): sql
+                  for i, (dbname, _, sql) in enumerate(CHECK_QUERIES) if sql}
+    db_folder = os.path.abspath(args.databases)
+    # Paths in the repo are relative to its root
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    total = 0
+    failed = 0
+    for dbname, number, query in queries:
+        db = open_db(os.path.join(db_folder, dbname + '.db'))
+        try:
+            for optimize in (False, True):
+                try:
+                    tree, msg = compile_query(query, db, optimize)
+                except Exception as inst:
+                    tree, msg = None, inst.args[0]
+                if tree is None:
+                    print(f"{dbname}:{number}: {msg}")
+                    continue
+                checked, mismatches = check_node(tree, db)
+                reference = references.get((dbname, number))
+                if reference is not None:
+                    expected = result_multiset(db.conn.execute(reference).fetchall())
+                    if result_multiset(db.conn.execute(generateSQL(tree, db)).fetchall()) \
+                            != expected:
+                        mismatches.append(f"SQL rows differ from {reference}")
+                total += checked
+                failed += len(mismatches)
+                for mismatch in mismatches:
+                    label = 'optimized' if optimize else 'as written'
+                    print(f"{dbname}:{number} ({label}) {mismatch}")
+        finally:
+            db.close()
+    print(f"{total} nodes checked, {failed} mismatches")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import os
+import sys
+import argparse
+import sqlite3
+from collections import Counter
+from RAP import *
+from query_benchmark import example_queries, QUERIES_FILE, DB_FOLDER
+
+# Check of the query fingerprints that key shared result cache entries: two
+# subtrees with the same fingerprint must give the same columns and rows.
+# Every node of every example query, as written and optimized, is grouped by
+# fingerprint and each group is run through SQLite. FINGERPRINT_PAIRS are
+# queries whose fingerprints must (or must not) be equal.
+
+# (database, query, query, same fingerprint)
+FINGERPRINT_PAIRS = [
+    # Columns both inputs of a product have are named _L and _R by side
+    ('company', 'project[bdate_l](employee times dependent);',
+     'project[bdate_l](dependent times employee);', False),
+    ('company', 'project[lname,dname](employee times department);',
+     'project[lname,dname](department times employee);', True),
+    ('company', 'project[lname,hours](employee join works_on);',
+     'project[lname,hours](works_on join employee);', True),
+    ('company', 'select[salary>30000](employee);', 'select[30000<salary](employee);', True),
+]
+
+
+# Output columns and row multiset of node, or the error it fails with
+def result_of(node, db):
+    try:
+        c = db.conn.execute(generateSQL(node, db))
+    except sqlite3.Error as e:
+        return str(e)
+    rows = Counter(c.fetchall())
+    return [desc[0].upper() for desc in c.description], rows
+
+
+def collect_nodes(tree, nodes):
+    if tree is None:
+        return
+    nodes.append(tree)
+    collect_nodes(tree.get_left_child(), nodes)
+    collect_nodes(tree.get_right_child(), nodes)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check that subtrees with the same fingerprint give the same result")
+    parser.add_argument("--queries", default=QUERIES_FILE, metavar="FILE",
+                        help="queries in the format of assets/queries.md")
+    parser.add_argument("--databases", default=DB_FOLDER, metavar="DIR",
+                        help="folder with the databases")
+    args = parser.parse_args()
+
+    queries = example_queries(args.queries)
+    db_folder = os.path.abspath(args.databases)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    failed = 0
+
+    for dbname, first, second, same in FINGERPRINT_PAIRS:
+        db = open_db(os.path.join(db_folder, dbname + '.db'))
+        try:
+            trees = [compile_query(query, db)[0] for query in (first, second)]
+            equal = query_fingerprint(trees[0]) == query_fingerprint(trees[1])
+            if equal != same:
+                failed += 1
+                print(f"{dbname}: '{first}' and '{second}' should "
+                      f"{'share' if same else 'not share'} a fingerprint")
+            elif same and result_of(trees[0], db) != result_of(trees[1], db):
+                failed += 1
+                print(f"{dbname}: '{first}' and '{second}' share a fingerprint "
+                      f"but give different results")
+        finally:
+            db.close()
+
+    checked = 0
+    by_database = {}
+    for dbname, number, query in queries:
+        by_database.setdefault(dbname, []).append((number, query))
+    for dbname, numbered in by_database.items():
+        db = open_db(os.path.join(db_folder, dbname + '.db'))
+        try:
+            groups = {}
+            for number, query in numbered:
+                for optimize in (False, True):
+                    try:
+                        tree, _ = compile_query(query, db, optimize)
+                    except Exception:
+                        continue
+                    nodes = []
+                    collect_nodes(tree, nodes)
+                    for node in nodes:
+                        groups.setdefault(query_fingerprint(node), []).append((number, node))
+            for fingerprint, members in groups.items():
+                expected = result_of(members[0][1], db)
+                for number, node in members[1:]:
+                    checked += 1
+                    if result_of(node, db) != expected:
+                        failed += 1
+                        print(f"{dbname}:{number} {node.get_node_type()} shares a fingerprint "
+                              f"with {dbname}:{members[0][0]} but gives a different result")
+        finally:
+            db.close()
+
+    print(f"{len(FINGERPRINT_PAIRS)} pairs and {checked} shared fingerprints checked, "
+          f"{failed} failures")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+from RAP import *
+
+# Index advisor: runs EXPLAIN QUERY PLAN on the SQL generated for every
+# operator node of a query, finds full scans of base tables that are
+# filtered or joined on, and automatic indexes SQLite builds for joins, and
+# turns them into index recommendations. Every candidate is created in a
+# scratch copy of the database and only recommended if the planner actually
+# uses it there, with before/after timings of the node's query. With --apply
+# the recommended indexes are then created in the database itself; the app
+# never creates indexes while it serves queries.
+
+# Build and check the tree of a query. Returns (tree, None) or (None, msg).
+def build_checked_tree(query, db, optimize=False):
+    try:
+        return compile_query(query, db, optimize)
+    except Exception as inst:
+        return None, str(inst.args[0])
+
+
+def operator_nodes(tree, found=None):
+    if found is None:
+        found = []
+    if tree is None or tree.get_node_type() == 'relation':
+        return found
+    found.append(tree)
+    operator_nodes(tree.get_left_child(), found)
+    operator_nodes(tree.get_right_child(), found)
+    return found
+
+
+# Base columns that the subtree filters or joins on, as
+# {relation: [column, ...]} in first-seen order
+def predicate_columns(tree):
+    columns = {}
+
+    def add(origin):
+        if origin is not None and origin[1] not in columns.setdefault(origin[0], []):
+            columns[origin[0]].append(origin[1])
+
+    for node, condition, doms in tree_predicates(tree):
+        if condition[2] == '<>':
+            continue
+        for col in condition_columns(condition):
+            add(column_origin(node, col))
+
+    def add_join_columns(node):
+        if node is None:
+            return
+        if node.get_node_type() == 'join':
+            for col in node.get_join_columns():
+                add(column_origin(node.get_left_child(), col))
+                add(column_origin(node.get_right_child(), col))
+        add_join_columns(node.get_left_child())
+        add_join_columns(node.get_right_child())
+
+    add_join_columns(tree)
+    return columns
+
+
+# Candidate indexes for one node as (relation, columns, reason) triples
+def node_candidates(node, db):
+    query = generateSQL(node, db)
+    plan = explain_query_plan(query, db)
+    filtered = predicate_columns(node)
+    candidates = []
+    for row in plan:
+        if row['table'] is None:
+            continue
+        rname = row['table'].upper()
+        if not db.relationExists(rname):
+            continue
+        if row['kind'] == 'search' and row['automatic']:
+            candidates.append((rname, row['columns'],
+                               f"automatic index: {row['detail']}"))
+        elif row['kind'] == 'scan' and rname in filtered:
+            for col in filtered[rname]:
+                candidates.append((rname, [col], f"full scan: {row['detail']}"))
+    return query, candidates
+
+
+# Copy a database with the backup API so the original is never written to
+def make_scratch_copy(dbfile, scratch_path):
+    source = sqlite3.connect(f"file:{os.path.abspath(dbfile)}?mode=ro", uri=True)
+    target = sqlite3.connect(scratch_path)
+    source.backup(target)
+    source.close()
+    target.close()
+
+
+def time_query(conn, query, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        conn.execute(query).fetchall()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2] * 1000
+
+
+def index_name(rname, columns):
+    return "RAV_IDX_" + rname + "_" + "_".join(columns)
+
+
+# Try one candidate in the scratch database: create it with each plausible
+# collation until the planner uses it. Returns the recommendation dict, or
+# None if no variant is used.
+def evaluate_candidate(scratch, query, rname, columns, before_ms, runs, keep):
+    domains = dict(zip(scratch.getAttributes(rname), scratch.getDomains(rname)))
+    # Select predicates on strings compare with COLLATE NOCASE, natural join
+    # columns compare with the default BINARY collation
+    if any(domains.get(col) == 'VARCHAR' for col in columns):
+        collations = ['NOCASE', 'BINARY']
+    else:
+        collations = ['BINARY']
+    name = index_name(rname, columns)
+    for collation in collations:
+        terms = ", ".join(f"{col} COLLATE {collation}" for col in columns)
+        create_sql = f"CREATE INDEX {name} ON {rname}({terms})"
+        scratch.conn.execute(create_sql)
+        used = any(row['index'] == name
+                   for row in explain_query_plan(query, scratch))
+        if used:
+            after_ms = time_query(scratch.conn, query, runs)
+            if not keep:
+                scratch.conn.execute(f"DROP INDEX {name}")
+            return {'relation': rname, 'columns': columns,
+                    'collation': collation, 'create_sql': create_sql + ";",
+                    'before_ms': before_ms, 'after_ms': after_ms}
+        scratch.conn.execute(f"DROP INDEX {name}")
+    return None
+
+
+# Recommend indexes for a query. scratch_path keeps the scratch copy, with
+# every recommended index created in it; otherwise a temporary copy is used.
+# Returns {'recommendations': [...], 'rejected': [...]} or {'error': msg}.
+def advise_indexes(query, dbfile, scratch_path=None, runs=5, optimize=False):
+    db = open_db(dbfile)
+    try:
+        tree, msg = build_checked_tree(query, db, optimize)
+        if tree is None:
+            return {'error': msg}
+        per_node = []
+        for node in operator_nodes(tree):
+            node_query, candidates = node_candidates(node, db)
+            per_node.append((node, node_query, candidates))
+    finally:
+        db.close()
+
+    keep = scratch_path is not None
+    temp_dir = None
+    if scratch_path is None:
+        temp_dir = tempfile.mkdtemp()
+        scratch_path = os.path.join(temp_dir, "scratch.db")
+    make_scratch_copy(dbfile, scratch_path)
+
+    scratch = SQLite3()
+    scratch.open(scratch_path)
+    recommendations = []
+    rejected = []
+    seen = set()
+    try:
+        # Parents come before their children, so each candidate is measured
+        # on the largest query it was found in
+        for node, node_query, candidates in per_node:
+            before_ms = None
+            for rname, columns, reason in candidates:
+                key = (rname, tuple(columns))
+                if key in seen:
+                    continue
+                seen.add(key)
+                name = index_name(rname, columns)
+                if scratch.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' "
+                                        "AND name = ?", (name,)).fetchone():
+                    rejected.append({'relation': rname, 'columns': columns,
+                                     'reason': reason + f" ({name} already exists)"})
+                    continue
+                if before_ms is None:
+                    before_ms = time_query(scratch.conn, node_query, runs)
+                result = evaluate_candidate(
+                    scratch, node_query, rname, columns, before_ms, runs, keep)
+                if result is None:
+                    rejected.append({'relation': rname, 'columns': columns,
+                                     'reason': reason + " (index not used)"})
+                    continue
+                result['node'] = f"{node.get_node_type()} {node.get_relation_name()}"
+                result['reason'] = reason
+                recommendations.append(result)
+        scratch.conn.commit()
+    finally:
+        scratch.close()
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    return {'recommendations': recommendations, 'rejected': rejected}
+
+
+# Create recommended indexes in the database itself. Existing indexes with
+# the same name are left alone. Returns the names created.
+def apply_recommendations(dbfile, recommendations):
+    conn = sqlite3.connect(dbfile, timeout=10)
+    created = []
+    try:
+        for rec in recommendations:
+            create_sql = rec['create_sql'].replace("CREATE INDEX", "CREATE INDEX IF NOT EXISTS", 1)
+            conn.execute(create_sql)
+            created.append(index_name(rec['relation'], rec['columns']))
+        conn.commit()
+    finally:
+        conn.close()
+    return created
+
+
+def print_advice(advice):
+    if 'error' in advice:
+        print(advice['error'])
+        return
+    if not advice['recommendations']:
+        print("No index recommendations.")
+    for rec in advice['recommendations']:
+        print(rec['create_sql'])
+        print(f"    {rec['node']}: {rec['before_ms']:.3f} ms -> {rec['after_ms']:.3f} ms")
+        print(f"    {rec['reason']}")
+    for rej in advice['rejected']:
+        print(f"-- not recommended: {rej['relation']}({', '.join(rej['columns'])}): {rej['reason']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Recommend indexes for a relational algebra query")
+    parser.add_argument("database", help="SQLite database file")
+    parser.add_argument("query", help="query text, or a file containing it")
+    parser.add_argument("--scratch", help="keep a copy of the database with "
+                        "the recommended indexes at this path")
+    parser.add_argument("--runs", type=int, default=5,
+                        help="timed runs per measurement (median is reported)")
+    parser.add_argument("--optimize", action="store_true",
+                        help="optimize the tree before generating SQL")
+    parser.add_argument("--apply", action="store_true",
+                        help="create the recommended indexes in the database")
+    args = parser.parse_args()
+
+    query = args.query
+    if os.path.isfile(query):
+        with open(query) as f:
+            data = f.read().splitlines()
+        query = " ".join(filter(lambda x: len(x) > 0 and x[0] != "#", data))
+    if args.scratch and os.path.exists(args.scratch):
+        print(f"Scratch path '{args.scratch}' already exists")
+        sys.exit(1)
+    advice = advise_indexes(query, args.database, args.scratch,
+                            args.runs, args.optimize)
+    print_advice(advice)
+    if args.apply and advice.get('recommendations'):
+        for name in apply_recommendations(args.database, advice['recommendations']):
+            print(f"Created index {name} in {args.database}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+# Startup benchmark for the RA parser. Every measurement runs in a fresh
+# Python process, the way a CLI invocation or a new app worker starts:
+#   import:     importing RAP (the parser is built lazily, so no tables)
+#   cold parse: import + first parse with an empty parse table cache
+#   warm parse: import + first parse with the tables already cached
+#   no cache:   import + first parse generating tables in memory, which is
+#               what every process start did before tables were persisted
+
+STARTUP = """
+import time
+start = time.perf_counter()
+import RAP
+if MODE != 'import':
+    if MODE == 'nocache':
+        import ply.yacc as yacc
+        RAP.rap_parser.lexer = RAP.lex.lex(module=RAP.rap_parser)
+        RAP.rap_parser.parser = yacc.yacc(module=RAP.rap_parser, start='query',
+                                          debug=False, write_tables=False)
+    RAP.rap_parser.parse("project[fname](employee);")
+done = time.perf_counter()
+print((done - start) * 1000)
+"""
+
+
+def time_startup(mode, cache_dir):
+    env = dict(os.environ, RAV_PARSER_CACHE=cache_dir)
+    code = f"MODE = {mode!r}\n" + STARTUP
+    result = subprocess.run([sys.executable, "-c", code], env=env, check=True,
+                            capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def run_benchmark(runs):
+    cache_dir = tempfile.mkdtemp()
+    try:
+        timings = {'import': [], 'cold parse': [], 'warm parse': [], 'no cache': []}
+        for _ in range(runs):
+            timings['import'].append(time_startup('import', cache_dir))
+            timings['no cache'].append(time_startup('nocache', cache_dir))
+            shutil.rmtree(cache_dir)
+            os.makedirs(cache_dir)
+            timings['cold parse'].append(time_startup('parse', cache_dir))
+            timings['warm parse'].append(time_startup('parse', cache_dir))
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    return {name: median(values) for name, values in timings.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure RA parser startup time with and without cached parse tables")
+    parser.add_argument("--runs", type=int, default=7,
+                        help="fresh processes per measurement (median is reported)")
+    parser.add_argument("--json", action="store_true", help="print JSON")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.runs)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for name, ms in results.items():
+        print(f"{name:12} {ms:8.2f} ms")
+    print(f"first parse with cached tables is {results['no cache'] - results['warm parse']:.2f} ms "
+          f"faster than generating them")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+from RAP import *
+
+# End-to-end benchmark over the example queries in assets/queries.md. Every
+# query is run against the database of the data-db div it is listed under,
+# and each stage of turning it into a displayed tree is timed separately:
+#   lex:        tokenizing the query text
+#   parse:      building the tree from the tokens and naming its nodes
+#   semantic:   semantic_checks
+#   sql:        generateSQL for the whole tree
+#   execute:    running that SQL in SQLite and fetching every row
+#   json:       tree_to_json
+#   cytoscape:  json_to_cytoscape_elements
+# The compiled query cache is bypassed, so every run does the full work.
+
+QUERIES_FILE = os.path.join('assets', 'queries.md')
+DB_FOLDER = 'databases'
+STAGES = ['lex', 'parse', 'semantic', 'sql', 'execute', 'json', 'cytoscape']
+
+
+# Example queries as (database name, query number, query text) in file order
+def example_queries(path=QUERIES_FILE):
+    with open(path) as f:
+        content = f.read()
+    queries = []
+    for div in re.finditer(r'<div data-db="(\w+)">(.*?)</div>', content, re.DOTALL):
+        for i, query in enumerate(re.findall(r'```(.*?)```', div.group(2), re.DOTALL)):
+            queries.append((div.group(1), i + 1, query.strip()))
+    return queries
+
+
+# Time every stage of one query once. Returns {stage: ms}, or raises if a
+# stage fails.
+def time_stages(query, db):
+    # app builds its layout from the databases folder when it is imported
+    from app import json_to_cytoscape_elements
+    timings = {}
+    start = time.perf_counter()
+
+    def lap(stage):
+        nonlocal start
+        now = time.perf_counter()
+        timings[stage] = (now - start) * 1000
+        start = now
+
+    tokens = rap_parser.tokenize(query)
+    lap('lex')
+    tree = rap_parser.parse_tokens(tokens)
+    set_temp_table_names(tree)
+    lap('parse')
+    msg = semantic_checks(tree, db)
+    if msg != 'OK':
+        raise Exception(msg)
+    lap('semantic')
+    sql = generateSQL(tree, db)
+    lap('sql')
+    db.conn.execute(sql).fetchall()
+    lap('execute')
+    json_tree = tree_to_json(tree, db, [0])
+    lap('json')
+    json_to_cytoscape_elements(json_tree, node_counter=[0])
+    lap('cytoscape')
+    return timings
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def run_benchmark(runs, path=QUERIES_FILE, db_folder=DB_FOLDER):
+    results = []
+    for dbname, number, query in example_queries(path):
+        entry = {'db': dbname, 'query': number}
+        db = open_db(os.path.join(db_folder, dbname + '.db'))
+        try:
+            # One untimed run first, so the samples leave out one-time work:
+            # building the parser tables on the first parse, and loading the
+            # database's schema and pages on its first query
+            time_stages(query, db)
+            samples = [time_stages(query, db) for _ in range(runs)]
+            entry['stages'] = {stage: median([s[stage] for s in samples])
+                               for stage in STAGES}
+            entry['total'] = sum(entry['stages'].values())
+        except Exception as inst:
+            entry['error'] = str(inst.args[0]) if inst.args else str(inst)
+        finally:
+            db.close()
+        results.append(entry)
+    timed = [entry for entry in results if 'stages' in entry]
+    totals = {stage: sum(entry['stages'][stage] for entry in timed)
+              for stage in STAGES}
+    return {'runs': runs, 'queries': results, 'totals': totals,
+            'total': sum(totals.values())}
+
+
+def print_results(results):
+    print(f"{'query':14}" + "".join(f"{stage:>11}" for stage in STAGES) + f"{'total':>11}")
+    for entry in results['queries']:
+        name = f"{entry['db']}:{entry['query']}"
+        if 'error' in entry:
+            print(f"{name:14} error: {entry['error']}")
+            continue
+        print(f"{name:14}" + "".join(f"{entry['stages'][stage]:11.3f}" for stage in STAGES) +
+              f"{entry['total']:11.3f}")
+    print(f"{'total':14}" + "".join(f"{results['totals'][stage]:11.3f}" for stage in STAGES) +
+          f"{results['total']:11.3f}")
+
+
+# Print how the stage totals changed since an earlier --json run
+def print_comparison(results, baseline, out=None):
+    print(f"{'stage':10}{'baseline':>12}{'now':>12}{'change':>10}", file=out)
+    rows = [(stage, baseline['totals'].get(stage), results['totals'][stage])
+            for stage in STAGES]
+    rows.append(('total', baseline.get('total'), results['total']))
+    for stage, before, now in rows:
+        if not before:
+            print(f"{stage:10}{'-':>12}{now:12.3f}{'-':>10}", file=out)
+            continue
+        print(f"{stage:10}{before:12.3f}{now:12.3f}{(now - before) / before:+10.1%}",
+              file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time every stage of the example queries in assets/queries.md")
+    parser.add_argument("--runs", type=int, default=5,
+                        help="runs per query (median of each stage is reported)")
+    parser.add_argument("--json", action="store_true", help="print JSON")
+    parser.add_argument("--databases", default=DB_FOLDER, metavar="DIR",
+                        help="folder with the databases, e.g. copies made by scale_db.py")
+    parser.add_argument("--compare", metavar="BASELINE",
+                        help="compare the stage totals with a file saved from --json")
+    args = parser.parse_args()
+
+    db_folder = os.path.abspath(args.databases)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    # Paths in the repo are relative to its root
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    results = run_benchmark(args.runs, db_folder=db_folder)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+    if baseline is not None:
+        # Keep the comparison out of JSON output
+        print_comparison(results, baseline, sys.stderr if args.json else None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+import os
+import sys
+import time
+import sqlite3
+import argparse
+from RAP import load_catalog
+
+# Scale-factor generator for load testing: writes a copy of a database with
+# every table repeated N times. Each copy ("replica") of the data gets key
+# values of its own, remapped the same way in every table, so keys stay
+# unique, every foreign key and natural join column still finds exactly the
+# rows it found in the original, and the fan-out of each key (employees per
+# department, rows per room, ...) keeps its original distribution. Columns
+# that are not keys keep their values, so selections keep their selectivity.
+#
+# Key columns are found from the schema: primary keys, unique constraints
+# and foreign keys, plus every column with the same name as one of them,
+# because a natural join matches columns by name. A column name shared by two
+# or more relations is a join key even where no key is declared, as in
+# schemas without constraints; without a remap, natural joins on it would
+# grow by N^2 instead of N. Such columns lose the selectivity of their
+# values in the replicas, like any key. Columns that are linked this way
+# form one group and are remapped together: numbers are shifted by
+# replica * (span of the group), strings get a "_<replica>" suffix. The
+# first replica keeps the original values.
+
+INSERT_BATCH = 10000
+
+
+# Union-find over (relation, column) pairs
+def find(groups, col):
+    while groups.setdefault(col, col) != col:
+        groups[col] = groups[groups[col]]
+        col = groups[col]
+    return col
+
+
+def union(groups, a, b):
+    groups[find(groups, a)] = find(groups, b)
+
+
+# Key columns of the database, as {(RELATION, COLUMN): group}, where columns
+# of one group are remapped together, and the names of shared columns that
+# are remapped only because they are shared, with no key declared on them
+def key_groups(conn, relations, attributes):
+    groups = {}
+    keyed = set()
+    for rname in relations:
+        pk = [row[1].upper() for row in sorted(
+            conn.execute(f"PRAGMA table_info({rname})"), key=lambda r: r[5]) if row[5]]
+        key_sets = [pk] if pk else []
+        for index in conn.execute(f"PRAGMA index_list({rname})"):
+            if index[2]:
+                key_sets.append([row[2].upper() for row in
+                                 conn.execute(f"PRAGMA index_info('{index[1]}')")])
+        for fk in conn.execute(f"PRAGMA foreign_key_list({rname})"):
+            parent = fk[2].upper()
+            to = fk[4]
+            if to is None:
+                # References the parent's primary key, column by column
+                parent_pk = [row[1] for row in sorted(
+                    conn.execute(f"PRAGMA table_info({parent})"),
+                    key=lambda r: r[5]) if row[5]]
+                to = parent_pk[fk[1]]
+            union(groups, (rname, fk[3].upper()), (parent, to.upper()))
+            keyed.add((rname, fk[3].upper()))
+        for key in key_sets:
+            if len(key) == 1:
+                keyed.add((rname, key[0]))
+        # A composite key stays unique if any of its columns is remapped
+        for key in key_sets:
+            if len(key) > 1 and not any((rname, col) in keyed for col in key):
+                keyed.add((rname, key[0]))
+
+    by_name = {}
+    for rname in relations:
+        for col in attributes[rname]:
+            by_name.setdefault(col, []).append((rname, col))
+    for cols in by_name.values():
+        for col in cols[1:]:
+            union(groups, cols[0], col)
+
+    declared = set(find(groups, col) for col in keyed)
+    shared = set(find(groups, cols[0]) for cols in by_name.values() if len(cols) > 1)
+    undeclared = sorted(name for name, cols in by_name.items()
+                        if find(groups, cols[0]) in shared - declared)
+    remapped = declared | shared
+    return {(rname, col): find(groups, (rname, col))
+            for rname in relations for col in attributes[rname]
+            if find(groups, (rname, col)) in remapped}, undeclared
+
+
+# Span of the numeric values of every group, so shifted replicas never overlap
+def group_spans(conn, groups):
+    spans = {}
+    for (rname, col), group in groups.items():
+        low, high = conn.execute(
+            f"SELECT min({col}), max({col}) FROM {rname} "
+            f"WHERE typeof({col}) IN ('integer', 'real')").fetchone()
+        if low is None:
+            continue
+        span = int(high - low) + 1
+        spans[group] = max(spans.get(group, 0), span)
+    return spans
+
+
+def remap(value, replica, span):
+    if value is None or replica == 0:
+        return value
+    if isinstance(value, (int, float)):
+        return value + replica * span
+    if isinstance(value, str):
+        return f"{value}_{replica}"
+    return value
+
+
+# Write a copy of source scaled by scale to target. Returns ({relation:
+# rows}, names of shared columns remapped without a declared key).
+def scale_database(source, target, scale):
+    src = sqlite3.connect(f"file:{os.path.abspath(source)}?mode=ro", uri=True)
+    dst = sqlite3.connect(target)
+    dst.execute("PRAGMA journal_mode=OFF")
+    dst.execute("PRAGMA synchronous=OFF")
+    try:
+        relations, attributes, domains, affinities = load_catalog(src)
+        groups, undeclared = key_groups(src, relations, attributes)
+        spans = group_spans(src, groups)
+        schema = src.execute(
+            "SELECT type, sql FROM sqlite_schema WHERE sql IS NOT NULL "
+            "AND name NOT LIKE 'sqlite_%'").fetchall()
+        for kind, sql in schema:
+            if kind == 'table':
+                dst.execute(sql)
+
+        counts = {}
+        for rname in relations:
+            attrs = attributes[rname]
+            rows = src.execute(f"SELECT * FROM {rname}").fetchall()
+            columns = [(i, spans.get(groups[(rname, col)], 1))
+                       for i, col in enumerate(attrs) if (rname, col) in groups]
+            insert = (f"INSERT INTO {rname} VALUES (" +
+                      ", ".join("?" * len(attrs)) + ")")
+            batch = []
+            for replica in range(scale):
+                for row in rows:
+                    row = list(row)
+                    for i, span in columns:
+                        row[i] = remap(row[i], replica, span)
+                    batch.append(row)
+                    if len(batch) >= INSERT_BATCH:
+                        dst.executemany(insert, batch)
+                        batch = []
+            dst.executemany(insert, batch)
+            counts[rname] = len(rows) * scale
+        dst.commit()
+
+        # Indexes are built once the data is in, which is much faster
+        for kind, sql in schema:
+            if kind != 'table':
+                dst.execute(sql)
+        if src.execute("SELECT 1 FROM sqlite_schema WHERE name = 'sqlite_stat1'").fetchone():
+            dst.execute("ANALYZE")
+        dst.commit()
+    finally:
+        src.close()
+        dst.close()
+    return counts, undeclared
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write a copy of a database with every table scaled up N times")
+    parser.add_argument("source", help="SQLite database to scale")
+    parser.add_argument("target", help="database file to write")
+    parser.add_argument("--scale", type=int, default=10,
+                        help="scale factor (default 10)")
+    parser.add_argument("--force", action="store_true",
+                        help="overwrite the target if it exists")
+    args = parser.parse_args()
+
+    if args.scale < 1:
+        print("The scale factor must be at least 1")
+        sys.exit(1)
+    if os.path.exists(args.target):
+        if not args.force:
+            print(f"Target '{args.target}' already exists")
+            sys.exit(1)
+        os.remove(args.target)
+    start = time.perf_counter()
+    counts, undeclared = scale_database(args.source, args.target, args.scale)
+    for rname, rows in counts.items():
+        print(f"{rname:20} {rows:12,}")
+    if undeclared:
+        print(f"Warning: no key is declared on {', '.join(undeclared)}; they are "
+              f"remapped as join keys because more than one relation has them",
+              file=sys.stderr)
+    print(f"{sum(counts.values()):,} rows written to {args.target} "
+          f"in {time.perf_counter() - start:.2f} s")
+
+
+if __name__ == '__main__':
+    main()